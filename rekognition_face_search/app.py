@@ -1,9 +1,30 @@
+from importlib import import_module
 import os
 from queue import Queue
-from threading import Thread
+from threading import Thread, current_thread
+from time import monotonic, sleep
+import traceback
 
+from .async_worker import AsyncVXGClient, AsyncWorker
 from .aws_client import AWSClient, AWSClientBadConfig
-from .poller import PollingImageSource
+from .batcher import CameraBatcher
+from .coordinator import SQLiteCoordinator, VXGLeaseCoordinator
+from .dedup import DedupCache
+from .http_pool import HTTPPool
+from .hygiene import CollectionMaintainer, FaceAliasMap
+from .identity_store import IdentityStore
+from .image import ImageLoader
+from .journal import WorkJournal
+from .local_index import LocalFaceIndex, LocalIndexUnavailable, LocalMatcher
+from .metrics import EVENTS, QUEUE_SIZE
+from .multi_face import MultiFaceSearch, MultiFaceUnavailable
+from .pipeline import PipelineWorker
+from .poller import AdaptivePollController, PollCursor, PollingImageSource
+from .quality import QualityGate
+from .resilience import RetryQueue, create_breakers
+from .scheduler import FairQueue
+from .supervisor import ProcessSupervisor
+from .throttle import RateLimiter
 from .vxg_client import VXGClient, VXGClientBadConfig
 from .web import WebApplication
 from .worker import Worker
@@ -12,6 +33,65 @@ WEB_UI_PORT = 8080
 WORKERS_COUNT = 20
 QUEUE_MAX_SIZE = 5 * WORKERS_COUNT
 WORKERS_GRACE_STOP_TIMEOUT = 5
+DEFAULT_THRESHOLD = 0.8
+HTTP_POOL_HOSTS = 10
+HTTP_CONCURRENCY = 4  # Threads writing meta tags of a single event at once, shared by all the workers
+EXECUTION_MODE_THREADS = 'threads'
+EXECUTION_MODE_ASYNCIO = 'asyncio'
+EXECUTION_MODE_PIPELINE = 'pipeline'
+EXECUTION_MODE_PROCESSES = 'processes'
+WORKER_PROCESSES = os.cpu_count() or 1
+ASYNC_MAX_IN_FLIGHT = 200  # Events processed at once in asyncio mode
+AWS_CONCURRENCY = WORKERS_COUNT  # Max concurrent AWS Rekognition calls of a single API
+PIPELINE_DOWNLOAD_WORKERS = 10
+PIPELINE_WRITE_WORKERS = 10
+PIPELINE_QUEUE_SIZE = WORKERS_COUNT  # Tasks waiting between pipeline stages
+SCHEDULER_FAIR = 'fair'
+SCHEDULER_FIFO = 'fifo'
+PRIORITY_WEIGHT = 4  # Share of priority cameras given without explicit weight, the rest have 1
+EVENT_DEADLINE = 0  # Seconds, older events wait for the fresh ones or get dropped, 0 disables
+STALE_WEIGHT = 1  # Share of the workers given to events older than the deadline, relative to a regular camera
+POLL_MAX_BATCH = QUEUE_MAX_SIZE
+POLL_MAX_INTERVAL = 5
+DEDUP_CACHE_SIZE = 1000  # 0 disables the cache
+DEDUP_TTL = 30
+DEDUP_MAX_DISTANCE = 6
+LOCAL_MATCH_MODEL = 'rekognition_face_search.local_index:StandInEmbeddingModel'
+LOCAL_MATCH_THRESHOLD = 0.95
+LOCAL_MATCH_MARGIN = 0.05
+LOCAL_INDEX_MAX_SIZE = 100000
+BATCH_WINDOW = 0  # Seconds to group events from the same camera, 0 disables grouping
+BATCH_MAX_SIZE = 10
+AWS_SEARCH_RATE = 50  # Requests per second, default AWS Rekognition limit for us-east-1
+AWS_INDEX_RATE = 50
+AWS_DETECT_RATE = 50
+AWS_RETRIES = 5
+HYGIENE_INTERVAL = 3600  # Seconds between collection maintenance runs
+HYGIENE_RATE = 5  # Maintenance requests per second
+HYGIENE_DUPLICATE_THRESHOLD = 95
+HYGIENE_MIN_CONFIDENCE = 90
+HYGIENE_STALE_DAYS = 0  # Delete faces not reported for that many days, 0 disables
+INDEX_QUALITY_FILTER = 'AUTO'  # IndexFaces QualityFilter: NONE, AUTO, LOW, MEDIUM or HIGH
+INDEX_MAX_FACES = 0  # 0 for no limit
+MIN_FACE_SIZE = 0  # Pixels, 0 disables the check
+MIN_FACE_SHARPNESS = 0  # Variance of the Laplacian over the face, 0 disables the check
+MULTI_FACE_MAX_FACES = 10  # Faces searched at a single frame
+MULTI_FACE_PER_FRAME = 4  # Crops of a single frame searched at once
+MULTI_FACE_MIN_CONFIDENCE = 90
+COORDINATOR_SQLITE = 'sqlite'
+COORDINATOR_VXG = 'vxg'
+COORDINATOR_FILE = 'leases.db'
+LEASE_TTL = 60  # Seconds an event claimed by an instance waits for it to be queued and tagged
+IMAGE_MAX_BYTES = 5 * 1024 * 1024  # AWS Rekognition accepts up to 5MB images
+IMAGE_MAX_SIDE = 0  # Downscale bigger images, 0 disables
+IMAGE_QUALITY = 90
+DOWNLOAD_TIMEOUT = 10
+RETRY_MAX_ATTEMPTS = 5  # Attempts to process an event before it gets the error tag, 1 disables retries
+RETRY_BASE_DELAY = 1  # Seconds, max delay before the first retry, doubled for every next one
+RETRY_MAX_DELAY = 60
+RETRY_QUEUE_SIZE = 1000  # Failed events waiting for retry, the rest get the error tag right away
+BREAKER_FAILURES = 5  # Consecutive failures of a dependency opening its circuit breaker, 0 disables breakers
+BREAKER_RESET_TIMEOUT = 30  # Seconds before a failing dependency is called again
 
 
 class Application:
@@ -21,32 +101,149 @@ class Application:
         self.collection = os.environ.get('COLLECTION_ID', None)
         self.access_key = os.environ.get('ACCESS_KEY', None)
         self.secret_key = os.environ.get('SECRET_KEY', None)
+        # AWS Rekognition stand-in for tests and benchmarks
+        self.aws_endpoint_url = os.environ.get('AWS_ENDPOINT_URL', None) or None
+        self.threshold = float(os.environ.get('THRESHOLD', DEFAULT_THRESHOLD))
+        self.workers_count = int(os.environ.get('WORKERS', WORKERS_COUNT))
+        self.queue_size = int(os.environ.get('QUEUE_SIZE', QUEUE_MAX_SIZE))
+        self.execution_mode = os.environ.get('EXECUTION_MODE', EXECUTION_MODE_THREADS)
 
-        self.queue = Queue(maxsize=QUEUE_MAX_SIZE)
+        # Connections per host: every worker plus the poller, unless set explicitly
+        self.http_pool_size = int(os.environ.get('HTTP_POOL_SIZE', 0))
+        self.http = HTTPPool(pool_size=self.http_pool_size or self.workers_count + 1,
+                             pool_hosts=int(os.environ.get('HTTP_POOL_HOSTS', HTTP_POOL_HOSTS)),
+                             keep_alive=os.environ.get('HTTP_KEEP_ALIVE', '1') == '1',
+                             block=os.environ.get('HTTP_POOL_BLOCK', '0') == '1',
+                             concurrency=int(os.environ.get('HTTP_CONCURRENCY', HTTP_CONCURRENCY)))
+        # Shared by all the AWS clients of the process, so the limits are for the whole process
+        max_aws_concurrency = int(os.environ.get('AWS_CONCURRENCY', AWS_CONCURRENCY))
+        self.aws_limiters = {
+            'search': RateLimiter('search', rate=float(os.environ.get('AWS_SEARCH_RATE', AWS_SEARCH_RATE)),
+                                  max_concurrency=max_aws_concurrency,
+                                  retries=int(os.environ.get('AWS_RETRIES', AWS_RETRIES))),
+            'index': RateLimiter('index', rate=float(os.environ.get('AWS_INDEX_RATE', AWS_INDEX_RATE)),
+                                 max_concurrency=max_aws_concurrency,
+                                 retries=int(os.environ.get('AWS_RETRIES', AWS_RETRIES))),
+            'detect': RateLimiter('detect', rate=float(os.environ.get('AWS_DETECT_RATE', AWS_DETECT_RATE)),
+                                  max_concurrency=max_aws_concurrency,
+                                  retries=int(os.environ.get('AWS_RETRIES', AWS_RETRIES))),
+            'maintenance': RateLimiter('maintenance', rate=float(os.environ.get('HYGIENE_RATE', HYGIENE_RATE)),
+                                       max_concurrency=1, retries=int(os.environ.get('AWS_RETRIES', AWS_RETRIES))),
+        }
+        self.loader = ImageLoader(self.http,
+                                  max_bytes=int(os.environ.get('IMAGE_MAX_BYTES', IMAGE_MAX_BYTES)),
+                                  timeout=float(os.environ.get('DOWNLOAD_TIMEOUT', DOWNLOAD_TIMEOUT)),
+                                  max_side=int(os.environ.get('IMAGE_MAX_SIDE', IMAGE_MAX_SIDE)),
+                                  quality=int(os.environ.get('IMAGE_QUALITY', IMAGE_QUALITY)))
+        self.gate = QualityGate(min_face_size=int(os.environ.get('MIN_FACE_SIZE', MIN_FACE_SIZE)),
+                                min_sharpness=float(os.environ.get('MIN_FACE_SHARPNESS', MIN_FACE_SHARPNESS)),
+                                quality_filter=os.environ.get('INDEX_QUALITY_FILTER', INDEX_QUALITY_FILTER),
+                                max_faces=int(os.environ.get('INDEX_MAX_FACES', INDEX_MAX_FACES)) or None)
+        journal_path = os.environ.get('JOURNAL_FILE', None)
+        # Outlives restarts of the components, so events queued before the restart are completed at the same journal
+        self.journal = WorkJournal(journal_path) if journal_path else None
+        identity_store_path = os.environ.get('IDENTITY_STORE_FILE', None)
+        self.identities = IdentityStore(identity_store_path) if identity_store_path else None
+        # Grouping is done for thread workers only, in other modes the dedup cache does the same cheaper
+        self.batch_window = float(os.environ.get('BATCH_WINDOW', BATCH_WINDOW))
+        if self.execution_mode not in (EXECUTION_MODE_THREADS, EXECUTION_MODE_PROCESSES):
+            self.batch_window = 0
+        # Workers queue, differs from the poller one when events are grouped by camera. The batcher takes polled
+        # events right away, so the order workers get them in is decided by the workers queue
+        self.work_queue = self.create_queue()
+        self.queue = Queue(maxsize=self.queue_size) if self.batch_window > 0 else self.work_queue
+        QUEUE_SIZE.set_function(self.queued_count)
+        # Breakers and failed events waiting for retry outlive restarts of the workers
+        self.breakers = self.create_breakers()
+        self.retry = RetryQueue(self.work_queue, **self.retry_config())
+        self.retry_thread = None
+        self.drop_thread = None
         self.web = WebApplication(self)
         # Other components must be initialized at the runtime, because settings can be changed or even missing
         self.source = None
         self.source_thread = None
+        self.aws = None
         self.workers = None
         self.worker_threads = None
+        self.retired_threads = []  # Threads of the workers removed from the running pool
+        self.batcher = None
+        self.batcher_thread = None
+        self.dedup = None
+        self.local = None
+        self.multi_face = None
+        self.multi_face_error = None  # Why MULTI_FACE is set but the search of every face isn't made
+        self.aliases = None
+        self.maintenance = True  # Whether HYGIENE runs the collection maintainer or only merged FaceIds are resolved
+        self.maintainer = None
+        self.maintainer_thread = None
+        self.startup_thread = None
+        self.aws_error = None  # Why the workers aren't running, None while they are or are being started
+        self.aws_ready_in = None  # Seconds the client was made and the collection checked in
 
     def run(self):
         print('Starting..')
-        self.start_source_and_workers()
+        self.start_in_background()
         # This one runs forever
         self.web.routine(WEB_UI_PORT)
         print('Finished')
 
+    def start_in_background(self):
+        """
+        Start the poller and the workers at a thread of their own, so the web UI serves /status/ while the AWS
+        client is made and the collection is checked. Polled events wait at the queue meanwhile
+        """
+        self.startup_thread = Thread(name='Startup', target=self.startup)
+        self.startup_thread.start()
+
+    def startup(self):
+        try:
+            self.start_source_and_workers()
+        except Exception as ex:
+            print('Worker routines are not started: %s\n%s' % (ex, traceback.format_exc()))
+
+    def wait_started(self):
+        """
+        Wait for the background start, so components are not stopped or changed while they're being started
+        """
+        if self.startup_thread is not None and self.startup_thread is not current_thread():
+            self.startup_thread.join()
+
     def stop(self):
         self.stop_source_and_workers()
         print('Stopping web..')
         self.web.stop()
 
     def start_source_and_workers(self):
+        self.start_source()
+        self.start_workers()
+
+    def start_source(self):
         try:
-            self.source = PollingImageSource(VXGClient(server_uri=self.server_uri, token=self.token), self.queue)
+            cursor_path = os.environ.get('POLL_CURSOR_FILE', None)
+            vxg_client = VXGClient(server_uri=self.server_uri, token=self.token, http=self.http)
+            self.source = PollingImageSource(
+                vxg_client, self.queue,
+                cursor=PollCursor(cursor_path) if cursor_path else None,
+                mark_processing=os.environ.get('POLL_MARK_PROCESSING', '1') == '1',
+                controller=AdaptivePollController(
+                    min_batch=PollingImageSource.MAX_EVENT_BATCH,
+                    max_batch=int(os.environ.get('POLL_MAX_BATCH', POLL_MAX_BATCH)),
+                    max_interval=float(os.environ.get('POLL_MAX_INTERVAL', POLL_MAX_INTERVAL)),
+                    base_interval=PollingImageSource.POLL_INTERVAL
+                ) if os.environ.get('POLL_ADAPTIVE', '1') == '1' else None,
+                journal=self.journal,
+                coordinator=self.create_coordinator(vxg_client))
             self.source_thread = Thread(name='Source', target=self.source.routine)
             self.source_thread.start()
+            # Batcher keeps running when the poller is switched to another server and outlives restarts, so events
+            # of its open groups that didn't fit the workers queue on stop are passed on the next start
+            if self.batch_window > 0 and self.batcher is None:
+                self.batcher = CameraBatcher(self.queue, self.work_queue, window=self.batch_window,
+                                             max_batch=int(os.environ.get('BATCH_MAX_SIZE', BATCH_MAX_SIZE)))
+            if self.batcher is not None and not (self.batcher_thread and self.batcher_thread.is_alive()):
+                self.batcher.need_stop.clear()
+                self.batcher_thread = Thread(name='Batcher', target=self.batcher.routine)
+                self.batcher_thread.start()
             print('Polling VXG Server at "%s"' % self.server_uri)
         except VXGClientBadConfig:
             self.source = None
@@ -54,48 +251,556 @@ class Application:
             print('Polling routine is not started due to bad configuration. You should set SERVER_URI and TOKEN env '
                   'vars or use web config page')
 
+    def start_workers(self):
+        started = monotonic()
+        self.aws_error = None
         try:
-            aws = AWSClient(collection_id=self.collection, access_key=self.access_key, secret_key=self.secret_key)
+            # boto3 clients are thread safe, so the workers share a single one
+            aws = self.create_aws_client()
             aws.ensure_collection_exist()
-            self.workers = [
-                Worker(self.queue,
-                       AWSClient(collection_id=self.collection, access_key=self.access_key, secret_key=self.secret_key,
-                                 threshold=float(os.environ.get('THRESHOLD', 0.8))),
-                       VXGClient(server_uri=self.server_uri, token=self.token))
-                for _ in range(WORKERS_COUNT)
-            ]
-            self.worker_threads = [Thread(name='Worker %d' % idx, target=self.workers[idx].routine)
-                                   for idx in range(WORKERS_COUNT)]
-            for worker_thread in self.worker_threads:
-                worker_thread.start()
+            self.aws = aws
+            self.aws_ready_in = monotonic() - started
+            # Results are valid for the current collection only, so start with an empty cache
+            dedup_size = int(os.environ.get('DEDUP_CACHE_SIZE', DEDUP_CACHE_SIZE))
+            self.dedup = None
+            if dedup_size > 0:
+                self.dedup = DedupCache(max_size=dedup_size,
+                                        ttl=float(os.environ.get('DEDUP_TTL', DEDUP_TTL)),
+                                        max_distance=int(os.environ.get('DEDUP_MAX_DISTANCE', DEDUP_MAX_DISTANCE)))
+            self.local = self.create_local_matcher() if os.environ.get('LOCAL_MATCH', '0') == '1' else None
+            # Worker processes search crops at their own pools
+            self.multi_face = None
+            self.multi_face_error = None
+            if os.environ.get('MULTI_FACE', '0') == '1' and self.execution_mode != EXECUTION_MODE_PROCESSES:
+                self.multi_face = self.create_multi_face()
+            if os.environ.get('HYGIENE', '0') == '1':
+                self.start_maintainer()
+            self.start_drop()
+            if self.execution_mode != EXECUTION_MODE_PROCESSES:
+                # Worker processes retry their failed events themselves
+                self.start_retry()
+            if self.execution_mode == EXECUTION_MODE_ASYNCIO:
+                self.start_async_workers()
+            elif self.execution_mode == EXECUTION_MODE_PIPELINE:
+                self.start_pipeline_workers()
+            elif self.execution_mode == EXECUTION_MODE_PROCESSES:
+                self.start_worker_processes()
+            else:
+                self.start_thread_workers()
             print('Using AWS Rekognition collection "%s"' % self.collection)
         except (AWSClientBadConfig, VXGClientBadConfig):
             self.workers = None
             self.worker_threads = None
+            self.aws_error = 'not_configured'
             print('Worker routines are not started due to bad configuration. You should set SERVER_URI, TOKEN, '
                   'COLLECTION_ID, ACCESS_KEY and SECRET_KEY  env vars or use web config page')
+        except Exception as ex:
+            # AWS Rekognition refused the credentials or the collection, or it can't be reached
+            self.aws_error = '%s: %s' % (type(ex).__name__, ex)
+            raise
+
+    def create_aws_client(self, **settings) -> AWSClient:
+        """
+        Create AWS client shared by all the components of the process
+        :param settings: collection, access_key, secret_key or threshold to use instead of the current ones
+        :raises AWSClientBadConfig: settings are incomplete
+        """
+        settings = dict({'collection': self.collection, 'access_key': self.access_key, 'secret_key': self.secret_key,
+                         'threshold': self.threshold}, **settings)
+        return AWSClient(collection_id=settings['collection'], access_key=settings['access_key'],
+                         secret_key=settings['secret_key'], threshold=settings['threshold'],
+                         limiters=self.aws_limiters, endpoint_url=self.aws_endpoint_url,
+                         max_pool_connections=self.aws_pool_size())
+
+    def aws_pool_size(self, processes: int = 1) -> int:
+        """
+        :param processes: number of worker processes sharing the limits
+        :return: max threads calling AWS Rekognition at once with the client shared by the process
+        """
+        concurrency = max(1, int(os.environ.get('AWS_CONCURRENCY', AWS_CONCURRENCY)) // processes)
+        if self.execution_mode in (EXECUTION_MODE_ASYNCIO, EXECUTION_MODE_PIPELINE):
+            size = concurrency
+        else:
+            size = max(1, self.workers_count // processes)
+        if os.environ.get('MULTI_FACE', '0') == '1':
+            size += concurrency
+        # Collection maintenance
+        return size + 1
+
+    @staticmethod
+    def breakers_config() -> dict:
+        """
+        :return: arguments of `resilience.create_breakers`, None if breakers are disabled
+        """
+        failures = int(os.environ.get('BREAKER_FAILURES', BREAKER_FAILURES))
+        if failures <= 0:
+            return None
+        return {'failure_threshold': failures,
+                'reset_timeout': float(os.environ.get('BREAKER_RESET_TIMEOUT', BREAKER_RESET_TIMEOUT))}
+
+    def create_breakers(self) -> dict:
+        """
+        :return: dependency name -> CircuitBreaker, empty if breakers are disabled
+        """
+        config = self.breakers_config()
+        return create_breakers(**config) if config else {}
+
+    @staticmethod
+    def retry_config() -> dict:
+        """
+        :return: arguments of RetryQueue besides the queue
+        """
+        return {
+            'max_attempts': int(os.environ.get('RETRY_MAX_ATTEMPTS', RETRY_MAX_ATTEMPTS)),
+            'base_delay': float(os.environ.get('RETRY_BASE_DELAY', RETRY_BASE_DELAY)),
+            'max_delay': float(os.environ.get('RETRY_MAX_DELAY', RETRY_MAX_DELAY)),
+            'max_size': int(os.environ.get('RETRY_QUEUE_SIZE', RETRY_QUEUE_SIZE)),
+        }
+
+    def start_retry(self):
+        if self.retry_thread and self.retry_thread.is_alive():
+            return
+        self.retry.need_stop.clear()
+        self.retry_thread = Thread(name='Retry', target=self.retry.routine)
+        self.retry_thread.start()
+
+    def start_drop(self):
+        """
+        Start releasing events dropped by the scheduler, VXG Server is called apart from the workers getting events
+        """
+        if not (isinstance(self.work_queue, FairQueue) and self.work_queue.drop_expired):
+            return
+        if self.drop_thread and self.drop_thread.is_alive():
+            return
+        self.work_queue.need_stop.clear()
+        self.drop_thread = Thread(name='Drop', target=self.work_queue.routine)
+        self.drop_thread.start()
+
+    def aws_status(self) -> dict:
+        """
+        :return: readiness of AWS Rekognition client: whether the workers use it, are being started or why not
+        """
+        return {'ready': self.aws is not None and self.workers is not None,
+                'starting': self.startup_thread is not None and self.startup_thread.is_alive(),
+                'error': self.aws_error,
+                'ready_in': self.aws_ready_in}
+
+    def multi_face_status(self) -> dict:
+        """
+        :return: multi-face search stats, why it can't be used if it's enabled, None if it's disabled
+        """
+        if self.multi_face is not None:
+            return self.multi_face.stats()
+        return {'error': self.multi_face_error} if self.multi_face_error else None
+
+    def resilience_stats(self) -> dict:
+        """
+        :return: circuit breakers and retry queue state, None if they're not used by the main process
+        """
+        if self.execution_mode == EXECUTION_MODE_PROCESSES:
+            # Worker processes have their own ones, see their stats
+            return None
+        return {'breakers': {name: breaker.stats() for name, breaker in self.breakers.items()},
+                'retry': self.retry.stats()}
+
+    def create_queue(self) -> Queue:
+        """
+        Create processing queue as set at SCHEDULER env var
+        :return: FairQueue or plain FIFO Queue
+        """
+        if os.environ.get('SCHEDULER', SCHEDULER_FAIR) == SCHEDULER_FIFO:
+            return Queue(maxsize=self.queue_size)
+        # "1:8,2" gives camera 1 weight 8 and camera 2 the default priority weight
+        weights = {}
+        for camera in os.environ.get('PRIORITY_CAMERAS', '').split(','):
+            if camera.strip():
+                camid, _, weight = camera.partition(':')
+                weights[camid.strip()] = float(weight) if weight else PRIORITY_WEIGHT
+        return FairQueue(maxsize=self.queue_size, weights=weights,
+                         deadline=float(os.environ.get('EVENT_DEADLINE', EVENT_DEADLINE)),
+                         drop_expired=os.environ.get('DROP_EXPIRED', '0') == '1', on_drop=self.drop_expired,
+                         stale_weight=float(os.environ.get('STALE_WEIGHT', STALE_WEIGHT)))
+
+    def queued_count(self) -> int:
+        """
+        :return: events waiting for the workers, including the ones waiting to be grouped
+        """
+        if self.work_queue is self.queue:
+            return self.queue.qsize()
+        return self.queue.qsize() + self.work_queue.qsize()
+
+    def drop_expired(self, item: dict):
+        """
+        Release the event dropped by the scheduler for being too old
+        :param item: task from the queue, the events grouped with it are released too
+        """
+        vxg_client = VXGClient(server_uri=self.server_uri, token=self.token, http=self.http)
+        for event in [item] + item.get('group', []):
+            vxg_client.set_event_processed_error(event['id'], 'expired', clear_processing=event.get('processing', True))
+            EVENTS.labels('expired').inc()
+            if self.journal is not None:
+                self.journal.complete(event['id'])
+
+    @staticmethod
+    def create_coordinator(vxg_client: VXGClient):
+        """
+        Create coordinator of instances sharing VXG Server as set at COORDINATOR env var
+        :param vxg_client: VXG Server client
+        :return: Coordinator or None if this instance is the only one
+        """
+        kind = os.environ.get('COORDINATOR', '')
+        lease_ttl = float(os.environ.get('LEASE_TTL', LEASE_TTL))
+        spread = int(os.environ.get('COORDINATOR_SPREAD', 1))
+        if kind == COORDINATOR_SQLITE:
+            return SQLiteCoordinator(os.environ.get('COORDINATOR_FILE', COORDINATOR_FILE), lease_ttl=lease_ttl,
+                                     spread=spread)
+        if kind == COORDINATOR_VXG:
+            return VXGLeaseCoordinator(vxg_client, lease_ttl=lease_ttl, spread=spread)
+        return None
+
+    def create_local_matcher(self):
+        """
+        Create local matching stage with the model given as "module:Class" at LOCAL_MATCH_MODEL env var
+        :return: LocalMatcher or None if it can't be used
+        """
+        module_name, class_name = os.environ.get('LOCAL_MATCH_MODEL', LOCAL_MATCH_MODEL).split(':')
+        model = getattr(import_module(module_name), class_name)()
+        index_path = os.environ.get('LOCAL_INDEX_PATH', None)
+        try:
+            # FaceIds are valid for the single collection only
+            index = LocalFaceIndex(model.DIMENSIONS,
+                                   path='%s_%s' % (index_path, self.collection) if index_path else None,
+                                   max_size=int(os.environ.get('LOCAL_INDEX_MAX_SIZE', LOCAL_INDEX_MAX_SIZE)))
+        except LocalIndexUnavailable as ex:
+            print('Local matching is disabled: %s' % ex)
+            return None
+        print('Local matching is enabled, %d faces are known' % len(index))
+        return LocalMatcher(model, index,
+                            threshold=float(os.environ.get('LOCAL_MATCH_THRESHOLD', LOCAL_MATCH_THRESHOLD)),
+                            margin=float(os.environ.get('LOCAL_MATCH_MARGIN', LOCAL_MATCH_MARGIN)))
+
+    def multi_face_config(self) -> dict:
+        return {
+            'max_faces': int(os.environ.get('MULTI_FACE_MAX_FACES', MULTI_FACE_MAX_FACES)),
+            'per_frame': int(os.environ.get('MULTI_FACE_PER_FRAME', MULTI_FACE_PER_FRAME)),
+            'min_confidence': float(os.environ.get('MULTI_FACE_MIN_CONFIDENCE', MULTI_FACE_MIN_CONFIDENCE)),
+            'detect_always': os.environ.get('MULTI_FACE_DETECT_ALWAYS', '0') == '1',
+            'quality': int(os.environ.get('IMAGE_QUALITY', IMAGE_QUALITY)),
+        }
+
+    def create_multi_face(self):
+        """
+        Create search of all the faces of a frame
+        :return: MultiFaceSearch or None if it can't be used
+        """
+        try:
+            multi_face = MultiFaceSearch(
+                self.aws,
+                pool_size=int(os.environ.get('AWS_CONCURRENCY', AWS_CONCURRENCY)),
+                **self.multi_face_config())
+        except MultiFaceUnavailable as ex:
+            print('Multi-face search is disabled: %s' % ex)
+            self.multi_face_error = str(ex)
+            return None
+        print('Multi-face search is enabled, up to %d faces per frame' % multi_face.max_faces)
+        return multi_face
+
+    def start_maintainer(self):
+        aliases_path = os.environ.get('FACE_ALIASES_FILE', None)
+        # FaceIds are valid for the single collection only
+        self.aliases = FaceAliasMap('%s_%s' % (aliases_path, self.collection) if aliases_path else None)
+        if not self.maintenance:
+            return
+        stale_days = float(os.environ.get('HYGIENE_STALE_DAYS', HYGIENE_STALE_DAYS))
+        self.maintainer = CollectionMaintainer(
+            self.aws,
+            self.aliases,
+            duplicate_threshold=float(os.environ.get('HYGIENE_DUPLICATE_THRESHOLD', HYGIENE_DUPLICATE_THRESHOLD)),
+            min_confidence=float(os.environ.get('HYGIENE_MIN_CONFIDENCE', HYGIENE_MIN_CONFIDENCE)),
+            stale_after=stale_days * 24 * 3600,
+            interval=float(os.environ.get('HYGIENE_INTERVAL', HYGIENE_INTERVAL)))
+        self.maintainer_thread = Thread(name='Maintainer', target=self.maintainer.routine)
+        self.maintainer_thread.start()
+
+    def start_thread_workers(self):
+        self.workers = [
+            self.create_worker() for _ in range(self.workers_count)
+        ]
+        self.worker_threads = [Thread(name='Worker %d' % idx, target=self.workers[idx].routine)
+                               for idx in range(self.workers_count)]
+        for worker_thread in self.worker_threads:
+            worker_thread.start()
+
+    def create_worker(self) -> Worker:
+        return Worker(self.work_queue, self.aws,
+                      VXGClient(server_uri=self.server_uri, token=self.token, http=self.http),
+                      http=self.http, dedup=self.dedup, local=self.local, loader=self.loader, journal=self.journal,
+                      aliases=self.aliases, gate=self.gate, multi_face=self.multi_face, breakers=self.breakers,
+                      retry=self.retry, identities=self.identities)
+
+    def start_async_workers(self):
+        max_in_flight = int(os.environ.get('ASYNC_MAX_IN_FLIGHT', ASYNC_MAX_IN_FLIGHT))
+        # Single worker runs on the web application loop, boto3 client is thread safe so one is enough
+        self.workers = [
+            AsyncWorker(self.queue,
+                        self.aws,
+                        AsyncVXGClient(server_uri=self.server_uri, token=self.token, http=self.http,
+                                       max_clients=max_in_flight),
+                        max_in_flight=max_in_flight,
+                        aws_concurrency=int(os.environ.get('AWS_CONCURRENCY', AWS_CONCURRENCY)),
+                        dedup=self.dedup, local=self.local, loader=self.loader, journal=self.journal,
+                        aliases=self.aliases, gate=self.gate, multi_face=self.multi_face, identities=self.identities,
+                        breakers=self.breakers, retry=self.retry)
+        ]
+        self.worker_threads = None
+        for worker in self.workers:
+            self.web.add_callback(worker.routine)
+
+    def start_pipeline_workers(self):
+        worker = PipelineWorker(
+            self.queue,
+            self.aws,
+            VXGClient(server_uri=self.server_uri, token=self.token, http=self.http),
+            download_workers=int(os.environ.get('PIPELINE_DOWNLOAD_WORKERS', PIPELINE_DOWNLOAD_WORKERS)),
+            recognize_workers=int(os.environ.get('AWS_CONCURRENCY', AWS_CONCURRENCY)),
+            write_workers=int(os.environ.get('PIPELINE_WRITE_WORKERS', PIPELINE_WRITE_WORKERS)),
+            stage_queue_size=int(os.environ.get('PIPELINE_QUEUE_SIZE', PIPELINE_QUEUE_SIZE)),
+            dedup=self.dedup, local=self.local, loader=self.loader, journal=self.journal, aliases=self.aliases,
+            gate=self.gate, multi_face=self.multi_face, identities=self.identities, breakers=self.breakers,
+            retry=self.retry)
+        worker.start()
+        self.workers = [worker]
+        # Stages are stopped in order, so joining threads in that order gives them time to drain
+        self.worker_threads = worker.threads
+
+    def worker_process_config(self, processes: int) -> dict:
+        """
+        Settings of a single worker process, limits of the whole application are split between processes
+        :param processes: number of worker processes
+        :return: config for `supervisor.process_main`
+        """
+        dedup_size = int(os.environ.get('DEDUP_CACHE_SIZE', DEDUP_CACHE_SIZE))
+        return {
+            'server_uri': self.server_uri,
+            'token': self.token,
+            'collection': self.collection,
+            'access_key': self.access_key,
+            'secret_key': self.secret_key,
+            'endpoint_url': self.aws_endpoint_url,
+            'threshold': self.threshold,
+            'workers': max(1, self.workers_count // processes),
+            'aws_pool_size': self.aws_pool_size(processes),
+            'grace_stop_timeout': WORKERS_GRACE_STOP_TIMEOUT,
+            'http_pool_size': max(1, self.workers_count // processes) + 1,
+            'http_pool_hosts': int(os.environ.get('HTTP_POOL_HOSTS', HTTP_POOL_HOSTS)),
+            'http_keep_alive': os.environ.get('HTTP_KEEP_ALIVE', '1') == '1',
+            'http_pool_block': os.environ.get('HTTP_POOL_BLOCK', '0') == '1',
+            'aws_rates': {name: limiter.bucket.rate / processes for name, limiter in self.aws_limiters.items()},
+            'aws_concurrency': max(1, int(os.environ.get('AWS_CONCURRENCY', AWS_CONCURRENCY)) // processes),
+            'aws_retries': int(os.environ.get('AWS_RETRIES', AWS_RETRIES)),
+            'image': {
+                'max_bytes': self.loader.max_bytes,
+                'timeout': self.loader.timeout,
+                'max_side': self.loader.max_side,
+                'quality': self.loader.quality,
+            },
+            'gate': {
+                'min_face_size': self.gate.min_face_size,
+                'min_sharpness': self.gate.min_sharpness,
+                'quality_filter': self.gate.quality_filter,
+                'max_faces': self.gate.max_faces,
+            },
+            'dedup': {
+                'max_size': dedup_size,
+                'ttl': float(os.environ.get('DEDUP_TTL', DEDUP_TTL)),
+                'max_distance': int(os.environ.get('DEDUP_MAX_DISTANCE', DEDUP_MAX_DISTANCE)),
+            } if dedup_size > 0 else None,
+            'journal_path': self.journal.path if self.journal else None,
+            'identity_store_path': self.identities.path if self.identities else None,
+            'multi_face': dict(self.multi_face_config(),
+                               pool_size=max(1, int(os.environ.get('AWS_CONCURRENCY', AWS_CONCURRENCY)) // processes))
+            if os.environ.get('MULTI_FACE', '0') == '1' else None,
+            'breakers': self.breakers_config(),
+            'retry': self.retry_config(),
+            # Worker processes take merges from the file saved by the maintainer and report faces they see back
+            'aliases': {'path': self.aliases.path} if self.aliases is not None else None,
+        }
+
+    def start_worker_processes(self):
+        processes = int(os.environ.get('WORKER_PROCESSES', WORKER_PROCESSES))
+        supervisor = ProcessSupervisor(self.work_queue, processes, self.worker_process_config(processes),
+                                       queue_size=WORKERS_COUNT, aliases=self.aliases)
+        supervisor.start()
+        self.workers = [supervisor]
+        self.worker_threads = None
 
     def stop_source_and_workers(self):
+        self.wait_started()
         print('Setting stop events')
         if self.workers:
             for worker in self.workers:
                 worker.stop()
         if self.source:
             self.source.stop()
+        if self.batcher:
+            self.batcher.stop()
+        if self.maintainer:
+            self.maintainer.stop()
+        # Events waiting for retry or release are kept until the next start
+        self.retry.stop()
+        if isinstance(self.work_queue, FairQueue):
+            self.work_queue.stop()
 
         print('Waiting for threads..')
+        # All of them are stopping at once, so they share the grace period instead of waiting for each other in turn
+        deadline = monotonic() + WORKERS_GRACE_STOP_TIMEOUT
         if self.worker_threads:
-            for worker_thread in self.worker_threads:
-                worker_thread.join(timeout=WORKERS_GRACE_STOP_TIMEOUT)
-        if self.source_thread:
-            self.source_thread.join(timeout=WORKERS_GRACE_STOP_TIMEOUT)
+            for worker_thread in self.worker_threads + self.retired_threads:
+                worker_thread.join(timeout=max(0.0, deadline - monotonic()))
+        elif self.workers:
+            for worker in self.workers:
+                worker.join(timeout=max(0.0, deadline - monotonic()))
+        for thread in (self.source_thread, self.batcher_thread, self.maintainer_thread, self.retry_thread,
+                       self.drop_thread):
+            if thread:
+                thread.join(timeout=max(0.0, deadline - monotonic()))
+        if self.aliases and self.maintainer:
+            # Without the maintainer the file belongs to another instance
+            self.aliases.save()
+        if self.multi_face:
+            self.multi_face.close()
 
+        self.aws = None
         self.workers = None
         self.worker_threads = None
+        self.retired_threads = []
         self.source = None
         self.source_thread = None
+        self.multi_face = None
+        self.multi_face_error = None
+        self.aliases = None
+        self.maintainer = None
+        self.maintainer_thread = None
+        if self.journal is not None:
+            self.journal.flush()
+        if self.identities is not None:
+            self.identities.flush()
         print('Threads are stopped')
 
     def restart_source_and_workers(self):
         self.stop_source_and_workers()
         self.start_source_and_workers()
+
+    def apply_settings(self, settings: dict):
+        """
+        Apply settings changed at the web page, processing goes on while they're applied:
+            - VXG Server token and match threshold are changed at the running clients;
+            - new AWS credentials or collection get a new client shared by the running workers, events in flight
+              finish with the old one. Results cached for the old collection are dropped;
+            - number of thread workers is changed by starting new ones or letting the extra ones finish their events;
+            - new VXG Server is polled once events queued from the old one are done.
+        Components that are not running (ie the configuration was incomplete) and changes the execution mode can't
+        make in place are applied by restart.
+        New AWS credentials and collection are checked first, nothing is changed if they don't work.
+        :param settings: attributes of the application to change, unchanged ones may be given too
+        :raises ClientError: AWS Rekognition refused the new credentials or collection
+        """
+        self.wait_started()
+        changed = {key for key, value in settings.items() if getattr(self, key) != value}
+        if not changed:
+            return
+        aws = None
+        if changed & {'collection', 'access_key', 'secret_key'}:
+            try:
+                aws = self.create_aws_client(**{key: settings[key] for key in changed
+                                                if key in ('collection', 'access_key', 'secret_key', 'threshold')})
+            except AWSClientBadConfig:
+                # Incomplete settings stop the workers on restart
+                aws = None
+            else:
+                aws.ensure_collection_exist()
+        for key in changed:
+            setattr(self, key, settings[key])
+        if 'workers_count' in changed and not self.http_pool_size:
+            self.http.resize(self.workers_count + 1)
+        live = (self.source is not None and self.workers
+                and self.execution_mode in (EXECUTION_MODE_THREADS, EXECUTION_MODE_ASYNCIO, EXECUTION_MODE_PIPELINE)
+                and all((self.server_uri, self.token, self.collection, self.access_key, self.secret_key)))
+        # Server switch waits for the queued events and the pool size is known for thread workers only
+        if not live or (changed & {'server_uri', 'workers_count'} and self.execution_mode != EXECUTION_MODE_THREADS):
+            print('Restarting to apply the settings: %s' % ', '.join(sorted(changed)))
+            self.restart_source_and_workers()
+            return
+        if aws is not None:
+            self.swap_aws_client(aws, collection_changed='collection' in changed)
+        elif 'workers_count' in changed and self.aws_pool_size() > (self.aws.max_pool_connections or 0):
+            # More threads share the client than its connection pool has room for
+            self.swap_aws_client(self.create_aws_client(), collection_changed=False)
+        elif 'threshold' in changed:
+            self.aws.threshold = self.threshold
+        if 'server_uri' in changed:
+            self.switch_server()
+        elif 'token' in changed:
+            for client in [self.source.vxg_client] + [worker.vxg for worker in self.workers]:
+                client.token = self.token
+        if 'workers_count' in changed:
+            self.resize_workers()
+        print('Settings are applied in place: %s' % ', '.join(sorted(changed)))
+
+    def swap_aws_client(self, aws: AWSClient, collection_changed: bool):
+        """
+        Replace AWS client of the running components
+        :param aws: new client, checked already
+        :param collection_changed: faces known for the previous collection are not valid anymore
+        """
+        self.aws = aws
+        if collection_changed:
+            if self.dedup is not None:
+                self.dedup.clear()
+            if self.local is not None:
+                self.local = self.create_local_matcher()
+            if self.maintainer is not None:
+                self.maintainer.stop()
+                self.maintainer_thread.join(timeout=WORKERS_GRACE_STOP_TIMEOUT)
+                self.aliases.save()
+                self.start_maintainer()
+        if self.maintainer is not None:
+            self.maintainer.aws = aws
+        if self.multi_face is not None:
+            self.multi_face.aws = aws
+        for worker in self.workers:
+            worker.aws = aws
+            worker.local = self.local
+            worker.aliases = self.aliases
+
+    def switch_server(self):
+        """
+        Start polling another VXG Server once events queued from the current one are done
+        """
+        self.source.stop()
+        self.source_thread.join(timeout=WORKERS_GRACE_STOP_TIMEOUT)
+        print('Waiting for events of the previous VXG Server to be processed..')
+        while (self.queue.unfinished_tasks or self.work_queue.unfinished_tasks
+               or (self.batcher is not None and self.batcher.pending) or self.retry.pending()):
+            sleep(0.1)
+        for worker in self.workers:
+            worker.vxg.server_uri = self.server_uri
+            worker.vxg.token = self.token
+        self.start_source()
+
+    def resize_workers(self):
+        """
+        Start more thread workers or let the extra ones finish their events and exit
+        """
+        self.retired_threads = [thread for thread in self.retired_threads if thread.is_alive()]
+        while len(self.workers) < self.workers_count:
+            worker = self.create_worker()
+            worker_thread = Thread(name='Worker %d' % len(self.workers), target=worker.routine)
+            self.workers.append(worker)
+            self.worker_threads.append(worker_thread)
+            worker_thread.start()
+        for worker in self.workers[self.workers_count:]:
+            worker.stop()
+        self.retired_threads.extend(self.worker_threads[self.workers_count:])
+        self.workers = self.workers[:self.workers_count]
+        self.worker_threads = self.worker_threads[:self.workers_count]
@@ -0,0 +1,395 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import json
+from queue import Queue, Empty
+from threading import Event
+from time import time
+import traceback
+
+from tornado.httpclient import AsyncHTTPClient
+
+from .aws_client import AWSClient
+from .dedup import DedupCache, image_hash
+from .local_index import LocalMatcher
+from .metrics import ERRORS, EVENTS, IN_FLIGHT, STAGE_SECONDS
+from .multi_face import MultiFaceSearch, has_more_faces, merge_faces
+from .quality import FaceRejected, QualityGate
+from .http_pool import HTTPPool
+from .hygiene import FaceAliasMap
+from .identity_store import IdentityStore
+from .image import ImageError, ImageLoader
+from .journal import WorkJournal
+from .resilience import DEPENDENCY_DOWNLOAD, DEPENDENCY_REKOGNITION, DEPENDENCY_VXG, RetryQueue, failure_reason
+from .vxg_client import VXGClient
+from .worker import FailureHandler, matched_faces, indexed_faces, observe_dequeued
+
+
+class AsyncVXGClient(VXGClient):
+    """
+    Wrapper for VXG Server Web API running on the event loop.
+    Same as VXGClient, but write methods are coroutines using Tornado non-blocking HTTP client.
+    """
+    def __init__(self, server_uri: str, token: str, http: HTTPPool = None, max_clients: int = 100):
+        super(AsyncVXGClient, self).__init__(server_uri=server_uri, token=token, http=http)
+        self.max_clients = max_clients
+        self._http_client = None
+
+    @property
+    def http_client(self) -> AsyncHTTPClient:
+        # Must be created on the event loop it's used at
+        if self._http_client is None:
+            self._http_client = AsyncHTTPClient(force_instance=True, max_clients=self.max_clients)
+        return self._http_client
+
+    async def fetch(self, url: str, max_bytes: int = None, timeout: float = None) -> bytes:
+        """
+        Download arbitrary URL, used to get images from the storage
+        :param url: URL to download
+        :param max_bytes: abort download if response body is bigger
+        :param timeout: connect and read timeout in seconds
+        :raises ImageError: response body is too large
+        :return: response body
+        """
+        chunks = []
+        size = 0
+
+        def on_chunk(chunk: bytes):
+            nonlocal size
+            size += len(chunk)
+            if max_bytes is not None and size > max_bytes:
+                raise ImageError('image_too_large')
+            chunks.append(chunk)
+
+        try:
+            await self.http_client.fetch(url, streaming_callback=on_chunk, connect_timeout=timeout,
+                                         request_timeout=timeout)
+        except ImageError:
+            raise
+        except Exception:
+            # Client may wrap the exception raised by callback
+            if max_bytes is not None and size > max_bytes:
+                raise ImageError('image_too_large')
+            raise
+        return b''.join(chunks)
+
+    async def set_event_meta(self, event_id: int, tag: str, data: str = ''):
+        await self.http_client.fetch(self._get_url('event_metas', params={'id': event_id}), method='POST',
+                                     headers={'Content-Type': 'application/json'},
+                                     body=json.dumps({'data': data, 'tag': tag}))
+
+    async def delete_event_meta(self, event_id: int, tag: str):
+        await self.http_client.fetch(self._get_url('event_meta', params={'id': event_id, 'tag': tag}),
+                                     method='DELETE')
+
+    async def update_event_meta(self, event_id: int, tags: list, delete_tags: list = ()):
+        async def set_first_and_delete():
+            await self.set_event_meta(event_id, *tags[0])
+            for tag in delete_tags:
+                await self.delete_event_meta(event_id, tag)
+
+        await asyncio.gather(set_first_and_delete(), *(self.set_event_meta(event_id, tag, data)
+                                                       for tag, data in tags[1:]))
+
+    async def set_event_processed(self, event_id: int, faces: list, clear_processing: bool = False):
+        await self.update_event_meta(event_id, self._get_processed_tags(faces),
+                                     delete_tags=[self.TAG_PROCESSING] if clear_processing else [])
+
+    async def set_event_processed_error(self, event_id: int, message: str, clear_processing: bool = False):
+        await self.update_event_meta(event_id, [(self.TAG_ERROR, message)],
+                                     delete_tags=[self.TAG_PROCESSING] if clear_processing else [])
+
+    async def set_event_rejected(self, event_id: int, reason: str, clear_processing: bool = False):
+        await self.update_event_meta(event_id, [(self.TAG_REJECTED, reason)],
+                                     delete_tags=[self.TAG_PROCESSING] if clear_processing else [])
+
+    def close(self):
+        if self._http_client is not None:
+            self._http_client.close()
+            self._http_client = None
+
+
+class AsyncWorker(FailureHandler):
+    """
+    Same processing as Worker does, but running on the event loop, so hundreds of events can be in flight at once.
+    Network requests to VXG Server and storage are non-blocking, blocking boto3 calls to AWS Rekognition are
+    running at the dedicated thread pool limited by `aws_concurrency`.
+    Failed events are retried or given up the same way Worker does it.
+    """
+    QUEUE_TIMEOUT = 1
+
+    def __init__(self, queue: Queue, aws_client: AWSClient, vxg_client: AsyncVXGClient,
+                 max_in_flight: int = 200, aws_concurrency: int = 20, dedup: DedupCache = None,
+                 local: LocalMatcher = None, loader: ImageLoader = None, journal: WorkJournal = None,
+                 aliases: FaceAliasMap = None, gate: QualityGate = None, multi_face: MultiFaceSearch = None,
+                 identities: IdentityStore = None, breakers: dict = None, retry: RetryQueue = None):
+        self.queue = queue
+        self.aws = aws_client
+        self.vxg = vxg_client
+        self.dedup = dedup
+        self.local = local
+        self.journal = journal
+        self.aliases = aliases
+        self.gate = gate
+        # Only detection and cropping are used, crops are searched on the loop
+        self.multi_face = multi_face
+        self.identities = identities
+        self.breakers = breakers or {}
+        self.retry = retry
+        # Only limits and downscaling are used, download is made by the async client
+        self.loader = loader if loader is not None else ImageLoader(None)
+        self.max_in_flight = max_in_flight
+        self.aws_executor = ThreadPoolExecutor(max_workers=aws_concurrency, thread_name_prefix='Rekognition')
+        # Blocking queue reads are made at separate thread to not block the loop
+        self.queue_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='AsyncWorkerQueue')
+        self.in_flight = 0
+        self.need_stop = Event()
+        self.stopped = Event()
+
+    def stop(self):
+        self.need_stop.set()
+
+    def join(self, timeout: float):
+        """
+        Wait for the routine to finish all the events in flight
+        :param timeout: max time to wait
+        """
+        try:
+            asyncio.get_running_loop()
+            # Called from the loop thread itself (ie signal handler), waiting here would block the routine forever
+            return
+        except RuntimeError:
+            pass
+        self.stopped.wait(timeout=timeout)
+
+    async def routine(self):
+        loop = asyncio.get_event_loop()
+        slots = asyncio.Semaphore(self.max_in_flight)
+        tasks = set()
+
+        def on_done(task):
+            tasks.discard(task)
+            slots.release()
+
+        try:
+            while not self.need_stop.is_set():
+                await slots.acquire()
+                try:
+                    item = await loop.run_in_executor(self.queue_executor,
+                                                      partial(self.queue.get, timeout=self.QUEUE_TIMEOUT))
+                except Empty:
+                    slots.release()
+                    continue
+                task = asyncio.ensure_future(self.process(item))
+                tasks.add(task)
+                task.add_done_callback(on_done)
+            if tasks:
+                await asyncio.wait(tasks)
+        finally:
+            self.aws_executor.shutdown(wait=False)
+            self.queue_executor.shutdown(wait=False)
+            self.vxg.close()
+            self.stopped.set()
+
+    async def call_aws(self, func, *args):
+        return await asyncio.get_event_loop().run_in_executor(self.aws_executor, func, *args)
+
+    async def guard_async(self, dependency: str, func, *args, **kwargs):
+        """
+        Same as `guard` for coroutine functions
+        """
+        breaker = self.breakers.get(dependency)
+        if breaker is None:
+            return await func(*args, **kwargs)
+        return await breaker.call_async(func, *args, **kwargs)
+
+    async def fail_async(self, item: dict, ex: Exception):
+        """
+        Same as `fail` with the non-blocking VXG Server client
+        """
+        if self.retry_later(item, ex):
+            return
+        reason = failure_reason(ex)
+        try:
+            await self.guard_async(DEPENDENCY_VXG, self.vxg.set_event_processed_error, item['id'], reason,
+                                   clear_processing=item.get('processing', True))
+        except Exception as write_ex:
+            # Left "processing", the journal replays it on the next start if it's enabled
+            print('Event %s is given up, but its error is not written: %s' % (item['id'], write_ex))
+            return
+        await self.call_cpu(self.dead_letter, item, reason)
+
+    @staticmethod
+    async def call_cpu(func, *args):
+        """
+        Run CPU-bound or blocking call (image decoding, face embedding, SQLite writes) off the loop, it serves the
+        web UI too
+        """
+        return await asyncio.get_event_loop().run_in_executor(None, func, *args)
+
+    async def recognize(self, image: bytes) -> list:
+        """
+        Find familiar faces at the image or index new ones
+        :param image: encoded image
+        :raises FaceRejected: new face is not good enough to be indexed
+        :return: list of faces to report
+        """
+        if self.local is not None:
+            embedding = await self.call_cpu(self.local.embed, image)
+            faces = await self.call_cpu(self.local.match, embedding)
+            if faces is not None:
+                return self.aliases.apply(faces) if self.aliases is not None else faces
+        if self.multi_face is None:
+            faces = await self.search(image)
+        elif self.multi_face.detect_always:
+            split = await self.call_aws(self.multi_face.split, image)
+            if split is not None:
+                boxes, crops = split
+                faces = merge_faces(boxes, await self.recognize_crops(crops))
+            else:
+                faces = await self.search(image)
+        else:
+            faces = await self.search_frame(image)
+        if self.aliases is not None:
+            faces = self.aliases.apply(faces)
+        if self.local is not None:
+            await self.call_cpu(self.local.learn, embedding, faces)
+        return faces
+
+    async def search(self, image: bytes, max_faces: int = None) -> list:
+        """
+        Search the biggest face of the image at the collection, see `Worker.search`
+        """
+        search_resp = await self.guard_async(DEPENDENCY_REKOGNITION, self.call_aws, self.aws.search_face, image)
+        faces = matched_faces(search_resp)
+        if not faces:
+            faces = await self.index(image, search_resp, max_faces)
+        return faces
+
+    async def search_frame(self, image: bytes) -> list:
+        """
+        Search the biggest face of the frame, other faces are searched if indexing shows there are any,
+        see `Worker.search_frame`
+        """
+        search_resp = await self.guard_async(DEPENDENCY_REKOGNITION, self.call_aws, self.aws.search_face, image)
+        faces = matched_faces(search_resp)
+        if faces:
+            return faces
+        index_resp = await self.index_response(image, search_resp, max_faces=1)
+        split = await self.call_aws(self.multi_face.split, image) if has_more_faces(index_resp) else None
+        if split is None:
+            return self.indexed(index_resp)
+        boxes, crops = split
+        try:
+            first = self.indexed(index_resp)
+        except FaceRejected as ex:
+            first = ex
+        return merge_faces(boxes, [first] + await self.recognize_crops(crops[1:]))
+
+    async def recognize_crops(self, crops: list) -> list:
+        """
+        Search faces of a single frame, at most `per_frame` at once
+        :param crops: encoded crops of single faces
+        :return: list of faces or FaceRejected for every crop
+        """
+        slots = asyncio.Semaphore(self.multi_face.per_frame)
+
+        async def recognize_crop(crop: bytes):
+            async with slots:
+                try:
+                    return await self.search(crop, max_faces=1)
+                except FaceRejected as ex:
+                    return ex
+
+        return await asyncio.gather(*[recognize_crop(crop) for crop in crops])
+
+    async def index(self, image: bytes, search_resp: dict, max_faces: int = None) -> list:
+        """
+        Add new faces to the collection, see `Worker.index`
+        """
+        return self.indexed(await self.index_response(image, search_resp, max_faces))
+
+    async def index_response(self, image: bytes, search_resp: dict, max_faces: int = None) -> dict:
+        """
+        :return: "index_faces" response, see `Worker.index_response`
+        """
+        if self.gate is None:
+            return await self.guard_async(DEPENDENCY_REKOGNITION, self.call_aws,
+                                          partial(self.aws.index_faces, max_faces=max_faces), image)
+        await self.call_cpu(self.gate.check, image, search_resp)
+        return await self.guard_async(DEPENDENCY_REKOGNITION, self.call_aws,
+                                      partial(self.aws.index_faces, quality_filter=self.gate.quality_filter,
+                                              max_faces=max_faces or self.gate.max_faces), image)
+
+    def indexed(self, index_resp: dict) -> list:
+        """
+        :return: list of newly indexed faces, see `Worker.indexed`
+        """
+        if self.gate is not None:
+            self.gate.check_indexed(index_resp)
+        return indexed_faces(index_resp)
+
+    async def process(self, item: dict):
+        """
+        Process a single task from the queue, failed one is retried later or given up
+        :param item: task from the queue
+        """
+        observe_dequeued(item)
+        self.in_flight += 1
+        IN_FLIGHT.inc()
+        started = time()
+        try:
+            try:
+                await self.process_item(item)
+            except Exception as ex:
+                await self.fail_async(item, ex)
+        except Exception as ex:
+            ERRORS.labels('worker', type(ex).__name__).inc()
+            print('Unexpected exception at AsyncWorker.process: %s\n%s' % (ex, traceback.format_exc()))
+        finally:
+            STAGE_SECONDS.labels('total').observe(time() - started)
+            IN_FLIGHT.dec()
+            self.in_flight -= 1
+            self.queue.task_done()
+
+    async def process_item(self, item: dict):
+        """
+        Process a single event
+        :param item: task from the queue
+        """
+        try:
+            with STAGE_SECONDS.labels('download').time():
+                image = await self.guard_async(DEPENDENCY_DOWNLOAD, self.vxg.fetch, item['url'],
+                                               max_bytes=self.loader.max_bytes, timeout=self.loader.timeout)
+        except ImageError as ex:
+            await self.guard_async(DEPENDENCY_VXG, self.vxg.set_event_processed_error, item['id'], ex.reason,
+                                   clear_processing=item.get('processing', True))
+            if self.journal is not None:
+                await self.call_cpu(self.journal.complete, item['id'])
+            EVENTS.labels('error').inc()
+            return
+        image = await self.call_cpu(self.loader.downscale, image)
+        faces = None
+        if self.dedup is not None:
+            image_key = await self.call_cpu(image_hash, image)
+            faces = self.dedup.get(item.get('camid'), image_key)
+        if faces is None:
+            try:
+                faces = await self.recognize(image)
+            except FaceRejected as ex:
+                await self.guard_async(DEPENDENCY_VXG, self.vxg.set_event_rejected, item['id'], ex.reason,
+                                       clear_processing=item.get('processing', True))
+                if self.journal is not None:
+                    await self.call_cpu(self.journal.complete, item['id'])
+                EVENTS.labels('rejected').inc()
+                return
+            if self.dedup is not None:
+                self.dedup.put(item.get('camid'), image_key, faces)
+        with STAGE_SECONDS.labels('write').time():
+            await self.guard_async(DEPENDENCY_VXG, self.vxg.set_event_processed, item['id'], faces,
+                                   clear_processing=item.get('processing', True))
+        if self.identities is not None:
+            await self.call_cpu(self.identities.record, self.aws.collection_id, item, faces)
+        if self.journal is not None:
+            await self.call_cpu(self.journal.complete, item['id'])
+        EVENTS.labels('face' if faces else 'no_face').inc()
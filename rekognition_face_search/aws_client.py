@@ -1,26 +1,94 @@
+from collections import OrderedDict
+from threading import Lock
+
 import boto3
+from botocore.config import Config
 from botocore.exceptions import ClientError
 
+from .metrics import STAGE_SECONDS
+
+CLIENTS_CACHE_SIZE = 4  # boto3 clients kept for reuse, settings changes leave the previous ones behind
+
+_session = None
+_clients = OrderedDict()
+_clients_lock = Lock()
+
 
 class AWSClientBadConfig(Exception):
     pass
 
 
+def rekognition_client(access_key: str, secret_key: str, endpoint_url: str = None, max_pool_connections: int = None,
+                       retries: bool = True):
+    """
+    Get boto3 Rekognition client shared by all the AWSClient instances of the process made with the same settings.
+    Making a client loads the service model and resolves the credentials and the endpoint, so a client is made once
+    and reused by every worker of the process and by clients swapped for another collection or threshold.
+    Clients are thread safe, but making them isn't, so all of them are made one at a time at a single session.
+    :param access_key: AWS access key
+    :param secret_key: AWS secret key
+    :param endpoint_url: send requests there instead of AWS
+    :param max_pool_connections: size of the connection pool, should cover all the threads using the client
+    :param retries: False disables retries of botocore
+    :return: boto3 client
+    """
+    global _session
+    key = (access_key, secret_key, endpoint_url, max_pool_connections, retries)
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is not None:
+            _clients.move_to_end(key)
+            return client
+        if _session is None:
+            _session = boto3.session.Session()
+        config = {}
+        if not retries:
+            config['retries'] = {'max_attempts': 0}
+        if max_pool_connections:
+            config['max_pool_connections'] = max_pool_connections
+        client = _session.client('rekognition',
+                                 region_name='us-east-1',
+                                 endpoint_url=endpoint_url,
+                                 aws_access_key_id=access_key,
+                                 aws_secret_access_key=secret_key,
+                                 config=Config(**config) if config else None)
+        _clients[key] = client
+        while len(_clients) > CLIENTS_CACHE_SIZE:
+            _clients.popitem(last=False)
+        return client
+
+
 class AWSClient:
     """
     AWS Rekognition client.
     Just wraps some boto3 requests.
+    With `limiters` given, search and index requests are made through the shared RateLimiter for 'search' and
+    'index' keys respectively, they retry throttled requests and transient errors themselves. Face detection
+    requests use 'detect' key, collection maintenance requests use 'maintenance' key.
+    With `endpoint_url` given, requests go there instead of AWS, ie to a local stand-in of AWS Rekognition.
+    The client is thread safe, `max_pool_connections` should cover all the threads sharing it. The boto3 client is
+    shared with other instances having the same credentials, see `rekognition_client`.
     """
-    def __init__(self, collection_id: str, access_key: str, secret_key: str, threshold: float = 0.8):
+    def __init__(self, collection_id: str, access_key: str, secret_key: str, threshold: float = 0.8,
+                 limiters: dict = None, endpoint_url: str = None, max_pool_connections: int = None):
         self.collection_id = collection_id
         self.threshold = threshold
+        self.limiters = limiters or {}
+        self.max_pool_connections = max_pool_connections
         if not all((self.collection_id, access_key, secret_key)):
             raise AWSClientBadConfig()
 
-        self.rek = boto3.client('rekognition',
-                                region_name='us-east-1',
-                                aws_access_key_id=access_key,
-                                aws_secret_access_key=secret_key)
+        # Retries are made by limiters, otherwise throttled requests would be retried twice and botocore retries
+        # would ignore the rate limits
+        self.rek = rekognition_client(access_key, secret_key, endpoint_url=endpoint_url,
+                                      max_pool_connections=max_pool_connections, retries=not self.limiters)
+
+    def _call(self, api: str, func, **kwargs):
+        limiter = self.limiters.get(api)
+        with STAGE_SECONDS.labels(api).time():
+            if limiter is None:
+                return func(**kwargs)
+            return limiter.call(func, **kwargs)
 
     def create_collection(self):
         return self.rek.create_collection(CollectionId=self.collection_id)
@@ -36,14 +104,53 @@ class AWSClient:
         return self.rek.delete_collection(CollectionId=self.collection_id)
 
     def search_face(self, image):
-        return self.rek.search_faces_by_image(
+        return self._call(
+            'search', self.rek.search_faces_by_image,
             CollectionId=self.collection_id,
             Image={'Bytes': image},
             FaceMatchThreshold=self.threshold
         )
 
-    def index_faces(self, image):
-        return self.rek.index_faces(
+    def index_faces(self, image, quality_filter: str = None, max_faces: int = None):
+        kwargs = {}
+        if quality_filter:
+            kwargs['QualityFilter'] = quality_filter
+        if max_faces:
+            kwargs['MaxFaces'] = max_faces
+        return self._call(
+            'index', self.rek.index_faces,
             CollectionId=self.collection_id,
             Image={'Bytes': image},
+            **kwargs
+        )
+
+    def detect_faces(self, image):
+        return self._call(
+            'detect', self.rek.detect_faces,
+            Image={'Bytes': image}
+        )
+
+    def list_faces(self, next_token: str = None, max_results: int = 1000):
+        kwargs = {'NextToken': next_token} if next_token else {}
+        return self._call(
+            'maintenance', self.rek.list_faces,
+            CollectionId=self.collection_id,
+            MaxResults=max_results,
+            **kwargs
+        )
+
+    def search_faces(self, face_id: str, threshold: float, max_faces: int = 100):
+        return self._call(
+            'maintenance', self.rek.search_faces,
+            CollectionId=self.collection_id,
+            FaceId=face_id,
+            FaceMatchThreshold=threshold,
+            MaxFaces=max_faces
+        )
+
+    def delete_faces(self, face_ids: list):
+        return self._call(
+            'maintenance', self.rek.delete_faces,
+            CollectionId=self.collection_id,
+            FaceIds=face_ids
         )
@@ -0,0 +1,355 @@
+import argparse
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+import json
+import os
+from queue import Queue, Full
+import signal
+from threading import Event
+from time import monotonic, sleep, time
+import traceback
+
+from .journal import WorkJournal
+from .throttle import TokenBucket
+from .vxg_client import VXGClient, VXGClientBadConfig
+
+PAGE_SIZE = 100
+PREFETCH = 4  # Pages requested from VXG Server at once
+RATE = 10  # Events per second
+CHECKPOINT_FILE = 'backfill.json'
+BACKFILL_MARK = 'backfill'  # Data of "processing" tag set by the backfill, tells its events from the live ones
+
+
+class BackfillCheckpoint:
+    """
+    Progress of the backfill: its time range and the number of events of the range already queued, in time order.
+    Persisted to a JSON file, so an interrupted backfill goes on from the same point. A checkpoint of another time
+    range is not resumed.
+    """
+    def __init__(self, path: str, start: str, end: str = None):
+        """
+        :param path: JSON file, None to keep the progress in memory only
+        :param start: time of the oldest event, inclusive
+        :param end: events older than that time are processed, the checkpoint one or now by default
+        """
+        self.path = path
+        self.start = start
+        self.offset = 0
+        self.total = None
+        state = None
+        if self.path and os.path.exists(self.path):
+            with open(self.path) as f:
+                state = json.load(f)
+        if end is None and state is not None and state['start'] == start:
+            # "Now" of the interrupted run, so running the same command again resumes it
+            end = state['end']
+        elif end is None:
+            end = datetime.now(timezone.utc).replace(tzinfo=None).isoformat()
+        self.end = end
+        if state is not None:
+            if (state['start'], state['end']) == (start, end):
+                self.offset = state['offset']
+                self.total = state['total']
+            else:
+                print('Checkpoint at "%s" is made for %s - %s, starting over' % (path, state['start'], state['end']))
+
+    @property
+    def finished(self) -> bool:
+        return self.total is not None and self.offset >= self.total
+
+    def save(self):
+        if not self.path:
+            return
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'start': self.start, 'end': self.end, 'offset': self.offset, 'total': self.total}, f)
+        os.replace(tmp_path, self.path)
+
+
+class Backfill:
+    """
+    Runs historical events of a time range through the workers, ie after switching to a new collection or changing
+    the threshold. Unlike the poller it takes events regardless of their tags: results of the previous processing
+    are deleted once the event is tagged "processing" again, so the live poller never takes it meanwhile.
+    Events the live pipeline is processing right now are skipped, the ones left "processing" by an interrupted
+    backfill are taken again. An event which tags failed to change is tagged as an error rather than left
+    "processing", so the live poller and the next backfill see it as failed.
+
+    Events of a past time range don't change, so pages are requested by offset, `prefetch` of them at once ahead of
+    the page being queued. Events are queued at most `rate` per second, a bounded queue slows it down further when
+    the workers can't keep up, so the backfill takes a fixed share of AWS Rekognition limits and leaves the rest to
+    the live traffic.
+    Position is saved to the checkpoint after every queued page, events queued but not processed yet are known to
+    the journal, so the next run replays them.
+    """
+    PUT_TIMEOUT = 1
+    REPORT_INTERVAL = 10
+
+    def __init__(self, vxg_client: VXGClient, queue: Queue, checkpoint: BackfillCheckpoint, page_size: int = PAGE_SIZE,
+                 prefetch: int = PREFETCH, rate: float = RATE, reprocess: bool = True, journal: WorkJournal = None):
+        """
+        :param vxg_client: VXG Server client
+        :param queue: processing queue of the workers
+        :param checkpoint: time range and the position within it
+        :param page_size: events requested at once
+        :param prefetch: pages requested at once
+        :param rate: max events queued per second
+        :param reprocess: process events having results already, otherwise only unprocessed ones are queued
+        :param journal: queued events are recorded there before they are tagged
+        """
+        self.vxg_client = vxg_client
+        self.queue = queue
+        self.checkpoint = checkpoint
+        self.page_size = page_size
+        self.prefetch = max(1, prefetch)
+        self.bucket = TokenBucket(rate)
+        self.reprocess = reprocess
+        self.journal = journal
+        self.need_stop = Event()
+        self.started = None
+        self.started_offset = checkpoint.offset
+        self.reported_at = 0.0
+        self.queued_count = 0
+        self.skipped_count = 0
+        self.failed_count = 0
+        self.replayed = set()  # Events queued by the replay, pages see them tagged by the backfill
+
+    def stop(self):
+        self.need_stop.set()
+
+    def fetch(self, offset: int) -> (list, int):
+        """
+        :param offset: position of the page within the time range
+        :return: events of the page with their meta tags and total number of events within the range
+        """
+        while True:
+            try:
+                return self.vxg_client.get_events_since(self.checkpoint.start, limit=self.page_size, offset=offset,
+                                                        end=self.checkpoint.end, include_meta=True)
+            except Exception as ex:
+                if self.need_stop.is_set():
+                    raise
+                print('Unexpected exception at Backfill.fetch: %s\n%s' % (ex, traceback.format_exc()))
+                sleep(1)
+
+    def run(self):
+        """
+        Queue all the events of the range from the checkpoint on
+        :return: whether the whole range is queued
+        """
+        self.started = self.reported_at = monotonic()
+        if self.journal is not None:
+            self.replay()
+        if self.checkpoint.total is None:
+            _, self.checkpoint.total = self.fetch(0)
+            self.checkpoint.save()
+        print('Backfill of %d events from %s to %s, %d are queued already'
+              % (self.checkpoint.total, self.checkpoint.start, self.checkpoint.end, self.checkpoint.offset))
+        pages = deque()
+        next_offset = self.checkpoint.offset
+        with ThreadPoolExecutor(max_workers=self.prefetch, thread_name_prefix='Backfill fetch') as executor:
+            try:
+                while not self.need_stop.is_set() and not self.checkpoint.finished:
+                    while len(pages) < self.prefetch and next_offset < self.checkpoint.total:
+                        pages.append((next_offset, executor.submit(self.fetch, next_offset)))
+                        next_offset += self.page_size
+                    offset, future = pages.popleft()
+                    events, _ = future.result()
+                    if not events:
+                        # Events of the range were deleted meanwhile (ie by the storage retention)
+                        self.checkpoint.offset = self.checkpoint.total
+                    else:
+                        self.put_events(events)
+                        self.checkpoint.offset = offset + len(events)
+                    self.checkpoint.save()
+                    self.report()
+            except StopIteration:
+                pass
+            finally:
+                self.need_stop.set()
+                for _, future in pages:
+                    future.cancel()
+        self.report(force=True)
+        return self.checkpoint.finished
+
+    def replay(self):
+        """
+        Queue events queued but not processed by the previous run, they are tagged already
+        """
+        items = self.journal.recover()
+        if items:
+            print('Replaying %d unprocessed events from the journal' % len(items))
+        for item in items:
+            item['queued_at'] = time()
+            self.replayed.add(item['id'])
+            self.put_item(item)
+
+    def put_events(self, events: list):
+        """
+        Tag events "processing" again, delete their previous results and pass them to the workers
+        :param events: events with their meta tags
+        :raises StopIteration: when user asked us to stop
+        """
+        items = []
+        for event in events:
+            meta = event.get('meta') or {}
+            url = event.get('thumb', {}).get('url', None)
+            results = [tag for tag in meta if tag in self.vxg_client.SERVICE_TAGS or
+                       tag.startswith(self.vxg_client.TAG_FACE_FMT % '')]
+            # Events left "processing" by an interrupted backfill are taken again, the live ones are left alone
+            live = meta.get(VXGClient.TAG_PROCESSING, BACKFILL_MARK) != BACKFILL_MARK
+            if live or event['id'] in self.replayed or not url or (results and not self.reprocess):
+                self.skipped_count += 1
+                continue
+            items.append(({'id': event['id'], 'url': url, 'camid': event.get('camid'), 'time': event.get('time'),
+                           'processing': True}, results))
+        # Journal goes first: an event tagged "processing" must be known to the journal
+        if self.journal is not None:
+            self.journal.enqueue([item for item, _ in items])
+        for item, results in items:
+            self.bucket.acquire()
+            try:
+                self.vxg_client.update_event_meta(item['id'], [(VXGClient.TAG_PROCESSING, BACKFILL_MARK)],
+                                                  delete_tags=[tag for tag in results
+                                                               if tag != VXGClient.TAG_PROCESSING])
+            except Exception as ex:
+                self.tag_failed(item, ex)
+                continue
+            item['queued_at'] = time()
+            self.put_item(item)
+            self.queued_count += 1
+
+    def tag_failed(self, item: dict, ex: Exception):
+        """
+        Tags of the event may be changed partly: "processing" is set, but not all the previous results are deleted.
+        Tag it as an error instead of leaving it "processing" with nobody going to process it
+        :param item: task for workers
+        :param ex: exception the tags update failed with
+        """
+        print('Event %d tags are not updated: %s' % (item['id'], ex))
+        self.failed_count += 1
+        try:
+            self.vxg_client.set_event_processed_error(item['id'], 'backfill_failed: %s' % type(ex).__name__,
+                                                      clear_processing=True)
+        except Exception as ex:
+            # Still at the journal, so the next run processes it
+            print('Event %d is left at the journal: %s' % (item['id'], ex))
+            return
+        if self.journal is not None:
+            self.journal.complete(item['id'])
+
+    def put_item(self, item: dict):
+        """
+        :param item: task for workers
+        :raises StopIteration: when user asked us to stop
+        """
+        while True:
+            try:
+                self.queue.put(item, timeout=self.PUT_TIMEOUT)
+                break
+            except Full:
+                if self.need_stop.is_set():
+                    raise StopIteration()
+
+    def stats(self) -> dict:
+        total = self.checkpoint.total or 0
+        elapsed = monotonic() - self.started if self.started is not None else 0
+        done = self.checkpoint.offset - self.started_offset
+        rate = done / elapsed if elapsed > 0 else 0.0
+        return {
+            'start': self.checkpoint.start,
+            'end': self.checkpoint.end,
+            'total': total,
+            'offset': self.checkpoint.offset,
+            'queued': self.queued_count,
+            'skipped': self.skipped_count,
+            'failed': self.failed_count,
+            'rate': rate,
+            'eta': (total - self.checkpoint.offset) / rate if rate > 0 else None,
+        }
+
+    def report(self, force: bool = False):
+        now = monotonic()
+        if not force and now - self.reported_at < self.REPORT_INTERVAL:
+            return
+        self.reported_at = now
+        stats = self.stats()
+        print('Backfill: %d of %d events (%.1f%%), %d queued, %d skipped, %d failed, %.1f events/s, ETA %s'
+              % (stats['offset'], stats['total'], 100.0 * stats['offset'] / max(1, stats['total']), stats['queued'],
+                 stats['skipped'], stats['failed'], stats['rate'], format_duration(stats['eta'])))
+
+
+def format_duration(seconds: float) -> str:
+    if seconds is None:
+        return 'unknown'
+    seconds = int(seconds)
+    return '%d:%02d:%02d' % (seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+
+def parse_args(argv: list = None):
+    parser = argparse.ArgumentParser(description='Run historical events of VXG Server through face recognition. '
+                                                 'Settings are taken from the same env vars as run_sync.py takes')
+    parser.add_argument('--start', required=True, help='time of the oldest event, like 2019-01-31T00:00:00 (UTC)')
+    parser.add_argument('--end', help='events older than that time are processed, now by default')
+    parser.add_argument('--checkpoint', default=CHECKPOINT_FILE, help='file to keep the progress at')
+    parser.add_argument('--journal', help='SQLite file to journal queued events at, JOURNAL_FILE env var or the '
+                                          'checkpoint file name with ".journal" suffix by default')
+    parser.add_argument('--rate', type=float, default=RATE, help='max events per second')
+    parser.add_argument('--workers', type=int, help='number of worker threads, WORKERS env var by default')
+    parser.add_argument('--page-size', type=int, default=PAGE_SIZE, help='events requested at once')
+    parser.add_argument('--prefetch', type=int, default=PREFETCH, help='pages requested at once')
+    parser.add_argument('--only-unprocessed', action='store_true',
+                        help="skip events processed already, they're reprocessed by default")
+    return parser.parse_args(argv)
+
+
+def main(argv: list = None) -> int:
+    # Imported here, the application pulls the web server in
+    from .app import Application, EXECUTION_MODE_THREADS
+
+    args = parse_args(argv)
+    application = Application()
+    if args.workers:
+        application.workers_count = args.workers
+    # Backfill feeds thread workers directly, there's no poller and no web UI
+    application.execution_mode = EXECUTION_MODE_THREADS
+    # Collection is maintained by the running instance, merges it made are still resolved
+    application.maintenance = False
+    try:
+        vxg_client = VXGClient(server_uri=application.server_uri, token=application.token, http=application.http)
+    except VXGClientBadConfig:
+        print('You should set SERVER_URI and TOKEN env vars')
+        return 1
+    # Events queued but not processed on stop are known to the journal only, the checkpoint is past them already
+    if application.journal is not None and args.journal:
+        application.journal.close()
+        application.journal = None
+    if application.journal is None:
+        application.journal = WorkJournal(args.journal or args.checkpoint + '.journal')
+    application.start_workers()
+    if application.workers is None:
+        application.journal.close()
+        return 1
+    backfill = Backfill(vxg_client, application.work_queue, BackfillCheckpoint(args.checkpoint, args.start, args.end),
+                        page_size=args.page_size, prefetch=args.prefetch, rate=args.rate,
+                        reprocess=not args.only_unprocessed, journal=application.journal)
+
+    def signal_handler(sig, frame):
+        print('Stopping with signal %s' % sig)
+        backfill.stop()
+
+    signal.signal(signal.SIGTERM, signal_handler)
+    signal.signal(signal.SIGINT, signal_handler)
+    finished = False
+    try:
+        finished = backfill.run()
+        # Queued events are processed before exit, the checkpoint counts them as done
+        while application.work_queue.unfinished_tasks or application.retry.pending():
+            sleep(0.5)
+    finally:
+        application.stop_source_and_workers()
+        application.journal.close()
+        application.http.close()
+    print('Backfill is %s' % ('finished' if finished else 'interrupted, run it again to go on'))
+    return 0 if finished else 1
@@ -0,0 +1,114 @@
+from queue import Queue, Empty, Full
+from threading import Event, Lock
+from time import monotonic, sleep
+import traceback
+
+
+class CameraBatcher:
+    """
+    Groups events from the same camera arriving within a short time window.
+    Gets items from the poller queue and puts them to the workers queue as a single item with the rest of the group at
+    'group' key, so a worker can recognise one representative and share the result with near-identical frames.
+    An event waits at most `window` seconds, a group has at most `max_batch` events.
+    """
+    GET_TIMEOUT = 0.05
+
+    def __init__(self, in_queue: Queue, out_queue: Queue, window: float = 0.5, max_batch: int = 10):
+        self.in_queue = in_queue
+        self.out_queue = out_queue
+        self.window = window
+        self.max_batch = max_batch
+        self.pending = {}  # camid -> (time of the first event, list of items)
+        self.lock = Lock()
+        self.groups_count = 0
+        self.events_count = 0
+        self.need_stop = Event()
+
+    def stop(self):
+        self.need_stop.set()
+
+    def routine(self):
+        while not self.need_stop.is_set():
+            try:
+                self.step()
+            except Exception as ex:
+                print('Unexpected exception at CameraBatcher.routine: %s\n%s' % (ex, traceback.format_exc()))
+                sleep(1)
+        # Open groups are passed to the workers queue as is, whatever doesn't fit is kept until the next start
+        self.flush()
+
+    def step(self):
+        """
+        Single run of the main routine: take one item if any and flush groups that are full or waited enough
+        """
+        try:
+            item = self.in_queue.get(timeout=self.GET_TIMEOUT)
+        except Empty:
+            item = None
+        if item is not None:
+            self.in_queue.task_done()
+            camid = item.get('camid')
+            if camid is None:
+                if not self.put([item]):
+                    self.keep(monotonic(), [item])
+            else:
+                started, items = self.pending.setdefault(camid, (monotonic(), []))
+                items.append(item)
+        now = monotonic()
+        for camid, (started, items) in list(self.pending.items()):
+            if len(items) >= self.max_batch or now - started >= self.window:
+                del self.pending[camid]
+                if not self.put(items):
+                    self.keep(started, items)
+
+    def flush(self):
+        """
+        Pass all the open groups to the workers, stop at the first one that doesn't fit
+        """
+        for camid, (started, items) in list(self.pending.items()):
+            del self.pending[camid]
+            if not self.put(items):
+                self.keep(started, items)
+                return
+
+    def keep(self, started: float, items: list):
+        """
+        Return the group that wasn't passed to the workers back to the pending ones
+        :param started: time the first event of the group arrived
+        :param items: events from the same camera
+        """
+        camid = items[0].get('camid')
+        if camid in self.pending:
+            # Returned events are older than the ones arrived meanwhile
+            self.pending[camid] = (started, items + self.pending[camid][1])
+        else:
+            self.pending[camid] = (started, items)
+
+    def put(self, items: list) -> bool:
+        """
+        Pass the group to the workers
+        :param items: events from the same camera
+        :return: False if the workers queue is full and we're asked to stop, the group is not passed then
+        """
+        group_item = dict(items[0])
+        if len(items) > 1:
+            group_item['group'] = items[1:]
+        while True:
+            try:
+                self.out_queue.put(group_item, timeout=1)
+                break
+            except Full:
+                if self.need_stop.is_set():
+                    return False
+        with self.lock:
+            self.groups_count += 1
+            self.events_count += len(items)
+        return True
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                'groups': self.groups_count,
+                'events': self.events_count,
+                'pending': sum(len(items) for _, items in list(self.pending.values())),
+            }
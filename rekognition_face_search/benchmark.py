@@ -0,0 +1,265 @@
+import argparse
+import json
+import multiprocessing
+import os
+from threading import Thread
+from time import monotonic, sleep, time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from .stubs import StubProcess
+
+DEFAULT_CASE = {
+    'mode': 'threads',
+    'workers': 20,
+    'queue_size': 100,
+    'events': 2000,
+    'rate': 0,  # Events per second, 0 puts all of them at once
+    'cameras': 10,
+    'people': 50,
+    'face_share': 0.8,
+    'image_size': 50 * 1024,
+    'vxg': {},  # Fault settings of the stubs, see `stubs.Fault`
+    'storage': {},
+    'rekognition': {},
+    'env': {},  # Extra settings of the application
+    'idle_timeout': 10,  # The run is over when no event is done for that many seconds
+}
+
+
+def case_key(case: dict) -> str:
+    return '%s/workers=%d/queue=%d' % (case['mode'], case['workers'], case['queue_size'])
+
+
+def case_params(case: dict) -> dict:
+    """
+    :return: settings the results depend on, runs are comparable only when they're equal
+    """
+    return {key: value for key, value in case.items() if key != 'idle_timeout'}
+
+
+def percentile(values: list, share: float) -> float:
+    """
+    :param values: sorted values
+    :param share: percentile as a share, ie 0.95
+    :return: nearest-rank percentile, None if there are no values
+    """
+    if not values:
+        return None
+    return values[min(len(values) - 1, max(0, int(round(share * len(values))) - 1))]
+
+
+def peak_memory_mb(who: str = 'self') -> float:
+    """
+    :param who: "self" for the current process or "children" for the largest of its finished child processes
+    """
+    if resource is None:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_SELF if who == 'self' else resource.RUSAGE_CHILDREN)
+    # Kilobytes at Linux
+    return usage.ru_maxrss / 1024
+
+
+def application_main(case: dict, vxg_uri: str, rekognition_uri: str, conn):
+    """
+    Entry point of the application process: runs the whole application until "stop" is received.
+    Settings are passed through the environment, so it has to be a process of its own.
+    """
+    os.environ.update({
+        'SERVER_URI': vxg_uri,
+        'TOKEN': 'benchmark',
+        'COLLECTION_ID': 'benchmark',
+        'ACCESS_KEY': 'benchmark',
+        'SECRET_KEY': 'benchmark',
+        'AWS_ENDPOINT_URL': rekognition_uri,
+        'EXECUTION_MODE': case['mode'],
+        'WORKERS': str(case['workers']),
+        'QUEUE_SIZE': str(case['queue_size']),
+    })
+    os.environ.update({key: str(value) for key, value in case['env'].items()})
+    # Application is imported here, so its module level settings see the environment of the case
+    from .app import Application
+
+    app = Application()
+    web_thread = Thread(name='Web', target=app.web.routine, daemon=True)
+    web_thread.start()
+    app.start_source_and_workers()
+    conn.send('started')
+    conn.recv()
+    app.stop_source_and_workers()
+    app.web.stop()
+    # Worker processes are joined by now, so their usage is known
+    conn.send({'peak_memory_mb': peak_memory_mb('self'), 'worker_processes_peak_memory_mb': peak_memory_mb('children')})
+
+
+def receive(conn, process):
+    """
+    Wait for a message of the process
+    :raises RuntimeError: the process is dead
+    """
+    while not conn.poll(1):
+        if not process.is_alive():
+            raise RuntimeError('%s process exited with code %s' % (process.name, process.exitcode))
+    return conn.recv()
+
+
+def run_case(case: dict) -> dict:
+    """
+    Run the whole application against local stand-ins of VXG Server and AWS Rekognition until all the events are
+    done or the processing is stuck. The application and the stubs run at processes of their own, so the stubs
+    don't take the CPU and memory of the application and settings of the cases don't mix.
+    :param case: benchmark settings, see DEFAULT_CASE
+    :return: results
+    """
+    case = dict(DEFAULT_CASE, **case)
+    stubs = StubProcess(
+        vxg_options={'events': case['events'], 'rate': case['rate'], 'cameras': case['cameras'],
+                     'people': case['people'], 'face_share': case['face_share'], 'image_size': case['image_size'],
+                     'fault': case['vxg'], 'storage_fault': case['storage']},
+        rekognition_options={'fault': case['rekognition']})
+    stubs.start()
+    context = multiprocessing.get_context('spawn')
+    conn, child_conn = context.Pipe()
+    # Not a daemon, it may start worker processes
+    app = context.Process(name='Application', target=application_main,
+                          args=(case, stubs.vxg_uri, stubs.rekognition_uri, child_conn))
+    try:
+        app.start()
+        receive(conn, app)
+        started = time()
+        stubs.feed()
+        done = 0
+        progressed = monotonic()
+        while done < case['events']:
+            sleep(0.1)
+            count = stubs.stats()['vxg']['done']
+            if count != done:
+                done = count
+                progressed = monotonic()
+            elif monotonic() - progressed > case['idle_timeout']:
+                break
+        conn.send('stop')
+        memory = receive(conn, app)
+        app.join(timeout=5)
+        created, finished_at = stubs.times()
+        stats = stubs.stats()
+    finally:
+        if app.is_alive():
+            app.terminate()
+        stubs.stop()
+
+    latencies = sorted(finished_at[event_id] - created[event_id] for event_id in finished_at)
+    finished = max(finished_at.values()) if finished_at else time()
+    return dict({
+        'case': case_key(case),
+        'params': case_params(case),
+        'events': case['events'],
+        'done': len(latencies),
+        'lost': case['events'] - len(latencies),
+        'seconds': round(finished - started, 3),
+        'throughput': round(len(latencies) / (finished - started), 2) if finished > started else 0,
+        'latency': {
+            'p50': percentile(latencies, 0.5),
+            'p95': percentile(latencies, 0.95),
+            'p99': percentile(latencies, 0.99),
+        },
+    }, **memory, **stats)
+
+
+def compare(result: dict, baseline: dict, tolerance: float = 0.1) -> list:
+    """
+    :param result: results of the run
+    :param baseline: results of the same case stored before
+    :param tolerance: allowed share of degradation
+    :raises ValueError: the baseline was made with other settings
+    :return: descriptions of the regressions
+    """
+    if result['params'] != baseline.get('params'):
+        raise ValueError('the baseline of %s was made with other settings' % result['case'])
+    regressions = []
+    if result['throughput'] < baseline['throughput'] * (1 - tolerance):
+        regressions.append('throughput %.1f/s < %.1f/s' % (result['throughput'], baseline['throughput']))
+    for name in ('p50', 'p95', 'p99'):
+        value, base = result['latency'][name], baseline['latency'][name]
+        if value is not None and base is not None and value > base * (1 + tolerance):
+            regressions.append('%s latency %.3fs > %.3fs' % (name, value, base))
+    if result['lost'] > baseline['lost']:
+        regressions.append('%d events lost, %d before' % (result['lost'], baseline['lost']))
+    for name in ('peak_memory_mb', 'worker_processes_peak_memory_mb'):
+        if result.get(name) and baseline.get(name) and result[name] > baseline[name] * (1 + tolerance):
+            regressions.append('%s %.0fMB > %.0fMB' % (name, result[name], baseline[name]))
+    return regressions
+
+
+def format_result(result: dict) -> str:
+    latency = result['latency']
+    memory = '%.0f MB' % result['peak_memory_mb'] if result['peak_memory_mb'] else '- MB'
+    if result['worker_processes_peak_memory_mb']:
+        memory += ', worker process %.0f MB' % result['worker_processes_peak_memory_mb']
+    return ('%-32s %6d/%-6d %8.1f ev/s  p50 %s  p95 %s  p99 %s  %s' % (
+        result['case'], result['done'], result['events'], result['throughput'],
+        *('%.3fs' % latency[name] if latency[name] is not None else '-' for name in ('p50', 'p95', 'p99')), memory))
+
+
+def parse_args(argv: list = None):
+    parser = argparse.ArgumentParser(description='Load test of the whole application against local stand-ins of '
+                                                 'VXG Server and AWS Rekognition')
+    parser.add_argument('--mode', default=DEFAULT_CASE['mode'], help='execution mode')
+    parser.add_argument('--workers', default=str(DEFAULT_CASE['workers']),
+                        help='comma separated numbers of workers, every one is a separate run')
+    parser.add_argument('--queue-size', default=str(DEFAULT_CASE['queue_size']),
+                        help='comma separated processing queue sizes, every one is a separate run')
+    parser.add_argument('--events', type=int, default=DEFAULT_CASE['events'])
+    parser.add_argument('--rate', type=float, default=DEFAULT_CASE['rate'],
+                        help='events per second, 0 puts all of them at once')
+    parser.add_argument('--cameras', type=int, default=DEFAULT_CASE['cameras'])
+    parser.add_argument('--people', type=int, default=DEFAULT_CASE['people'])
+    parser.add_argument('--image-size', type=int, default=DEFAULT_CASE['image_size'], help='bytes')
+    for stub in ('vxg', 'storage', 'rekognition'):
+        parser.add_argument('--%s-latency' % stub, type=float, default=0, help='seconds')
+        parser.add_argument('--%s-jitter' % stub, type=float, default=0, help='seconds')
+        parser.add_argument('--%s-error-rate' % stub, type=float, default=0, help='share of failed requests')
+        parser.add_argument('--%s-throttle-rate' % stub, type=float, default=0, help='share of throttled requests')
+        parser.add_argument('--%s-max-rate' % stub, type=float, default=0,
+                            help='requests per second above that are throttled')
+    parser.add_argument('--idle-timeout', type=float, default=DEFAULT_CASE['idle_timeout'])
+    parser.add_argument('--baseline', help='JSON file with results to compare with')
+    parser.add_argument('--save-baseline', action='store_true', help='store the results to the baseline file')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='allowed share of degradation')
+    return parser.parse_args(argv)
+
+
+def main(argv: list = None) -> int:
+    args = parse_args(argv)
+    faults = {stub: {name: getattr(args, '%s_%s' % (stub, name))
+                     for name in ('latency', 'jitter', 'error_rate', 'throttle_rate', 'max_rate')}
+              for stub in ('vxg', 'storage', 'rekognition')}
+    baseline = {}
+    if args.baseline and os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    regressions = 0
+    for workers in (int(value) for value in args.workers.split(',')):
+        for queue_size in (int(value) for value in args.queue_size.split(',')):
+            case = dict(DEFAULT_CASE, mode=args.mode, workers=workers, queue_size=queue_size, events=args.events,
+                        rate=args.rate, cameras=args.cameras, people=args.people, image_size=args.image_size,
+                        idle_timeout=args.idle_timeout, **faults)
+            result = run_case(case)
+            print(format_result(result))
+            if result['case'] in baseline and not args.save_baseline:
+                try:
+                    found = compare(result, baseline[result['case']], args.tolerance)
+                except ValueError as ex:
+                    print('    Not compared: %s, save a new baseline for them' % ex)
+                    continue
+                for regression in found:
+                    regressions += 1
+                    print('    REGRESSION: %s' % regression)
+            baseline[result['case']] = result
+    if args.baseline and args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+    return 1 if regressions else 0
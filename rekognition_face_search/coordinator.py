@@ -0,0 +1,181 @@
+from functools import partial
+import json
+import os
+import socket
+import sqlite3
+from threading import Lock
+from time import monotonic, sleep, time
+
+from .vxg_client import VXGClient
+
+
+def default_owner() -> str:
+    return '%s:%d' % (socket.gethostname(), os.getpid())
+
+
+class Coordinator:
+    """
+    Lets several instances share a single VXG Server: an event is queued only by the instance holding its lease.
+    Leases expire after `lease_ttl` seconds, so events claimed by a dead instance before they were tagged
+    "processing" are claimed by another one later.
+    With `spread` above 1 the poller reads one of that many first batches of the backlog at random, so instances
+    mostly poll different events instead of competing for the same batch. Set it to the number of instances.
+    """
+    def __init__(self, owner: str = None, lease_ttl: float = 60, spread: int = 1):
+        self.owner = owner or default_owner()
+        self.lease_ttl = lease_ttl
+        self.spread = spread
+        self.lock = Lock()
+        self.claimed_count = 0
+        self.lost_count = 0
+
+    def claim(self, event_ids: list) -> list:
+        """
+        :param event_ids: events the instance is going to queue
+        :return: IDs of events leased by this instance
+        """
+        claimed = self._claim(event_ids)
+        with self.lock:
+            self.claimed_count += len(claimed)
+            self.lost_count += len(event_ids) - len(claimed)
+        return claimed
+
+    def _claim(self, event_ids: list) -> list:
+        raise NotImplementedError()
+
+    def release(self, event_ids: list):
+        """
+        Drop leases that aren't needed anymore: the events are tagged "processing", so other instances don't poll them
+        :param event_ids: events leased by this instance
+        """
+        pass
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                'owner': self.owner,
+                'claimed': self.claimed_count,
+                'lost': self.lost_count,
+            }
+
+
+class SQLiteCoordinator(Coordinator):
+    """
+    Leases are kept at SQLite database, for instances at the same host or sharing a volume with proper locking
+    """
+    def __init__(self, path: str, owner: str = None, lease_ttl: float = 60, spread: int = 1):
+        super(SQLiteCoordinator, self).__init__(owner, lease_ttl, spread)
+        self.path = path
+        # Several instances write at once, wait for their transactions instead of failing
+        self.db = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS leases '
+                        '(id INTEGER PRIMARY KEY, owner TEXT NOT NULL, expires REAL NOT NULL)')
+
+    def _claim(self, event_ids: list) -> list:
+        if not event_ids:
+            return []
+        now = time()
+        with self.lock:
+            # Write lock is taken at once, so claims of different instances are serialized
+            self.db.execute('BEGIN IMMEDIATE')
+            try:
+                self.db.execute('DELETE FROM leases WHERE expires < ?', (now,))
+                self.db.executemany('INSERT OR IGNORE INTO leases (id, owner, expires) VALUES (?, ?, ?)',
+                                    [(event_id, self.owner, now + self.lease_ttl) for event_id in event_ids])
+                owned = {row[0] for row in self.db.execute(
+                    'SELECT id FROM leases WHERE owner = ? AND id IN (%s)' % ','.join('?' * len(event_ids)),
+                    [self.owner] + list(event_ids))}
+                self.db.execute('COMMIT')
+            except Exception:
+                self.db.execute('ROLLBACK')
+                raise
+        return [event_id for event_id in event_ids if event_id in owned]
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+class VXGLeaseCoordinator(Coordinator):
+    """
+    Leases are kept at VXG Server itself as a meta tag with the owner and expiry time, no shared storage is needed.
+    Instances racing for the same event both write the tag, wait for `settle` seconds and read it back: the last
+    write wins and only its owner queues the event. The wait and the read back are skipped while no other instance
+    is around: `spread` is 1 and no valid lease of another owner was seen for `lease_ttl`. The tag is deleted once
+    the event is tagged "processing". Instance clocks are expected to be in sync within a small part of `lease_ttl`.
+    """
+    TAG_LEASE = 'rek_face_search_lease'
+
+    def __init__(self, vxg_client: VXGClient, owner: str = None, lease_ttl: float = 60, spread: int = 1,
+                 settle: float = 0.5):
+        super(VXGLeaseCoordinator, self).__init__(owner, lease_ttl, spread)
+        self.vxg = vxg_client
+        self.settle = settle
+        self.peer_seen_at = None  # Monotonic time a lease of another instance was seen last time
+
+    def get_leases(self, event_ids: list) -> list:
+        """
+        :param event_ids: events to check
+        :return: lease of every event as a dict with 'owner' and 'expires' keys, None if there's no valid lease
+        """
+        datas = self.vxg.http.run_concurrently([partial(self.vxg.get_event_meta, event_id, self.TAG_LEASE)
+                                                for event_id in event_ids])
+        leases = []
+        for data in datas:
+            try:
+                leases.append(json.loads(data) if data else None)
+            except ValueError:
+                leases.append(None)
+        return leases
+
+    def note_peers(self, leases: list, now: float):
+        """
+        :param leases: leases as returned by `get_leases`
+        :param now: time the leases are valid at
+        """
+        if any(lease is not None and lease.get('owner') != self.owner and lease.get('expires', 0) >= now
+               for lease in leases):
+            with self.lock:
+                self.peer_seen_at = monotonic()
+
+    def contended(self) -> bool:
+        """
+        :return: whether other instances may be claiming the same events
+        """
+        with self.lock:
+            return self.spread > 1 or (self.peer_seen_at is not None and
+                                       monotonic() - self.peer_seen_at < self.lease_ttl)
+
+    def _claim(self, event_ids: list) -> list:
+        if not event_ids:
+            return []
+        now = time()
+        leases = self.get_leases(event_ids)
+        self.note_peers(leases, now)
+        free = [event_id for event_id, lease in zip(event_ids, leases)
+                if lease is None or lease.get('owner') == self.owner or lease.get('expires', 0) < now]
+        if not free:
+            return []
+        data = json.dumps({'owner': self.owner, 'expires': now + self.lease_ttl})
+        self.vxg.http.run_concurrently([partial(self.vxg.set_event_meta, event_id, self.TAG_LEASE, data)
+                                        for event_id in free])
+        if not self.contended():
+            return free
+        # Let concurrent claims land, then see whose write is the last one
+        sleep(self.settle)
+        leases = self.get_leases(free)
+        self.note_peers(leases, now)
+        return [event_id for event_id, lease in zip(free, leases)
+                if lease is not None and lease.get('owner') == self.owner]
+
+    def release(self, event_ids: list):
+        def delete_lease(event_id: int):
+            try:
+                self.vxg.delete_event_meta(event_id, self.TAG_LEASE)
+            except Exception as ex:
+                # Expires anyway
+                print('Failed to delete lease of event %s: %s' % (event_id, ex))
+
+        if event_ids:
+            self.vxg.http.run_concurrently([partial(delete_lease, event_id) for event_id in event_ids])
@@ -0,0 +1,120 @@
+from collections import OrderedDict
+import copy
+import hashlib
+from io import BytesIO
+from threading import Lock
+from time import monotonic
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+
+HASH_SIZE = 8
+
+
+def image_hash(image: bytes) -> int:
+    """
+    64 bit difference hash (dHash) of the image: close images have close hashes by Hamming distance.
+    Falls back to exact hash of the bytes if Pillow is not installed or the image can't be decoded.
+    :param image: encoded image
+    :return: hash as int
+    """
+    if Image is not None:
+        try:
+            with Image.open(BytesIO(image)) as img:
+                img.draft('L', (HASH_SIZE * 8, HASH_SIZE * 8))  # Let JPEG decoder downscale, much cheaper
+                pixels = img.convert('L').resize((HASH_SIZE + 1, HASH_SIZE)).tobytes()
+        except (OSError, ValueError):
+            pass
+        else:
+            value = 0
+            for row in range(HASH_SIZE):
+                for col in range(HASH_SIZE):
+                    idx = row * (HASH_SIZE + 1) + col
+                    value = (value << 1) | (pixels[idx] > pixels[idx + 1])
+            return value
+    return int.from_bytes(hashlib.sha1(image).digest()[:8], 'big')
+
+
+def hash_distance(a: int, b: int) -> int:
+    return bin(a ^ b).count('1')
+
+
+class DedupCache:
+    """
+    Bounded cache of recognition results keyed by perceptual hash of the image and scoped per camera.
+    Lets near-identical thumbnails of the same scene reuse the result without calling AWS Rekognition.
+    Entries expire after `ttl` seconds, least recently used entries are evicted when the cache is full.
+    Thread safe.
+    """
+    def __init__(self, max_size: int = 1000, ttl: float = 30, max_distance: int = 6):
+        """
+        :param max_size: max number of cached results
+        :param ttl: seconds to keep the result
+        :param max_distance: max Hamming distance between hashes of images considered near-identical
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.max_distance = max_distance
+        self.entries = OrderedDict()  # (camid, hash) -> (expiration time, faces)
+        self.cameras = {}  # camid -> set of hashes
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, camid, key: int):
+        """
+        Find result for the near-identical image from the same camera
+        :param camid: camera ID, results are never shared between cameras
+        :param key: image hash, see `image_hash`
+        :return: copy of the cached faces list or None if not found
+        """
+        now = monotonic()
+        with self.lock:
+            for cached_key in list(self.cameras.get(camid, ())):
+                expiration, faces = self.entries[(camid, cached_key)]
+                if expiration < now:
+                    self._remove((camid, cached_key))
+                elif hash_distance(key, cached_key) <= self.max_distance:
+                    self.entries.move_to_end((camid, cached_key))
+                    self.hits += 1
+                    return copy.deepcopy(faces)
+            self.misses += 1
+            return None
+
+    def put(self, camid, key: int, faces: list):
+        """
+        Remember the result
+        :param camid: camera ID
+        :param key: image hash, see `image_hash`
+        :param faces: list of faces found at the image
+        """
+        with self.lock:
+            self.entries[(camid, key)] = (monotonic() + self.ttl, copy.deepcopy(faces))
+            self.entries.move_to_end((camid, key))
+            self.cameras.setdefault(camid, set()).add(key)
+            while len(self.entries) > self.max_size:
+                self._remove(next(iter(self.entries)))
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.cameras.clear()
+
+    def _remove(self, entry_key: tuple):
+        camid, key = entry_key
+        del self.entries[entry_key]
+        self.cameras[camid].discard(key)
+        if not self.cameras[camid]:
+            del self.cameras[camid]
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                'size': len(self.entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'perceptual': Image is not None,
+            }
@@ -0,0 +1,130 @@
+from concurrent.futures import ThreadPoolExecutor, wait
+from threading import Lock
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+class HTTPPool:
+    """
+    Connection-pooled HTTP transport shared by all the components of the process.
+    Wraps a single requests.Session, so TCP+TLS connections to the VXG Server and storage are kept alive and reused
+    instead of being opened for every request.
+    Every host gets `pool_size` connections for the callers and `concurrency` more for the helper threads of
+    `run_concurrently`, so the helpers don't take connections of the callers.
+    """
+    def __init__(self, pool_size: int = 10, pool_hosts: int = 10, keep_alive: bool = True, block: bool = False,
+                 concurrency: int = 4):
+        """
+        :param pool_size: max number of connections kept open to a single host for the threads making requests
+        :param pool_hosts: number of hosts to keep connection pools for
+        :param keep_alive: keep connections open between requests
+        :param block: never open more connections to a single host than the pool has, wait for a free one instead
+        :param concurrency: helper threads running requests for `run_concurrently`, shared by all the callers
+        """
+        self.pool_size = pool_size
+        self.pool_hosts = pool_hosts
+        self.keep_alive = keep_alive
+        self.block = block
+        self.concurrency = concurrency
+
+        self.adapter = HTTPAdapter(pool_connections=pool_hosts, pool_maxsize=pool_size + concurrency,
+                                   pool_block=block)
+        self.session = requests.Session()
+        self.session.mount('http://', self.adapter)
+        self.session.mount('https://', self.adapter)
+        if not keep_alive:
+            self.session.headers['Connection'] = 'close'
+
+        self.lock = Lock()
+        self.requests_count = 0
+        self.errors_count = 0
+        # Runs independent requests concurrently, see `run_concurrently`
+        self.executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='HTTP')
+
+    def request(self, method: str, url: str, **kwargs) -> requests.Response:
+        try:
+            resp = self.session.request(method, url, **kwargs)
+        except requests.RequestException:
+            with self.lock:
+                self.requests_count += 1
+                self.errors_count += 1
+            raise
+        with self.lock:
+            self.requests_count += 1
+        return resp
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url: str, **kwargs) -> requests.Response:
+        return self.request('POST', url, **kwargs)
+
+    def delete(self, url: str, **kwargs) -> requests.Response:
+        return self.request('DELETE', url, **kwargs)
+
+    def run_concurrently(self, calls: list) -> list:
+        """
+        Run independent calls in parallel on the pooled connections and wait for all of them.
+        The first call runs at the caller thread, the rest at the helper threads.
+        :param calls: list of callables without arguments
+        :raises Exception: the first exception raised by any of the calls, after all of them are finished
+        :return: results of the calls in the same order
+        """
+        if len(calls) == 1:
+            return [calls[0]()]
+        futures = [self.executor.submit(call) for call in calls[1:]]
+        try:
+            first = calls[0]()
+        finally:
+            wait(futures)
+        return [first] + [future.result() for future in futures]
+
+    def resize(self, pool_size: int):
+        """
+        Change the number of connections per host, ie when threads are added. Idle connections are closed, requests
+        in flight finish on their connections.
+        :param pool_size: max number of connections kept open to a single host for the threads making requests
+        """
+        if pool_size == self.pool_size:
+            return
+        previous = self.adapter
+        self.pool_size = pool_size
+        self.adapter = HTTPAdapter(pool_connections=self.pool_hosts, pool_maxsize=pool_size + self.concurrency,
+                                   pool_block=self.block)
+        self.session.mount('http://', self.adapter)
+        self.session.mount('https://', self.adapter)
+        previous.close()
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+        self.session.close()
+
+    def stats(self) -> dict:
+        """
+        Pool statistics for the status page
+        :return: pool settings, request counters and per-host connection usage
+        """
+        hosts = {}
+        pools = self.adapter.poolmanager.pools
+        for key in list(pools.keys()):
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            hosts['%s://%s:%s' % (pool.scheme, pool.host, pool.port)] = {
+                'connections_opened': pool.num_connections,
+                'requests': pool.num_requests,
+                'idle': pool.pool.qsize() if pool.pool is not None else 0,
+            }
+        with self.lock:
+            requests_count, errors_count = self.requests_count, self.errors_count
+        return {
+            'pool_size': self.pool_size,
+            'concurrency': self.concurrency,
+            'pool_hosts': self.pool_hosts,
+            'keep_alive': self.keep_alive,
+            'block': self.block,
+            'requests': requests_count,
+            'errors': errors_count,
+            'hosts': hosts,
+        }
@@ -0,0 +1,292 @@
+import json
+import os
+from threading import Event, Lock
+from time import time
+import traceback
+
+from .aws_client import AWSClient
+
+
+class FaceAliasMap:
+    """
+    Local knowledge about faces of the collection: when every face was first and last reported, whether it was
+    checked for duplicates already, and aliases of merged faces to their canonical FaceId.
+    Persisted to a JSON file, so reported FaceIds stay consistent after restart.
+    """
+    def __init__(self, path: str = None):
+        self.path = path
+        self.lock = Lock()
+        self.aliases = {}  # FaceId -> canonical FaceId
+        self.faces = {}  # FaceId -> {'first_seen': ..., 'last_seen': ..., 'checked': ...}
+        self.loaded_mtime = None  # Modification time of the file when it was read
+        if self.path and os.path.exists(self.path):
+            self.loaded_mtime = os.stat(self.path).st_mtime
+            with open(self.path) as f:
+                state = json.load(f)
+            self.aliases = state['aliases']
+            self.faces = state['faces']
+
+    def resolve(self, face_id: str) -> str:
+        """
+        :param face_id: FaceId reported by AWS Rekognition or the local index
+        :return: canonical FaceId
+        """
+        with self.lock:
+            # Merged faces can be merged further, but chains are short
+            while face_id in self.aliases:
+                face_id = self.aliases[face_id]
+            return face_id
+
+    def apply(self, faces: list) -> list:
+        """
+        Replace merged FaceIds by canonical ones and record the faces as seen
+        :param faces: faces to report, dicts with essential key 'FaceId'
+        :return: faces with canonical FaceIds
+        """
+        result = []
+        for face in faces:
+            face_id = self.resolve(face['FaceId'])
+            if face_id != face['FaceId']:
+                face = dict(face, FaceId=face_id)
+            self.touch(face_id)
+            result.append(face)
+        return result
+
+    def touch(self, face_id: str, now: float = None):
+        now = now if now is not None else time()
+        with self.lock:
+            info = self.faces.setdefault(face_id, {'first_seen': now, 'last_seen': now, 'checked': False})
+            info['last_seen'] = max(info['last_seen'], now)
+
+    def seen_since(self, since: float) -> dict:
+        """
+        :param since: time
+        :return: FaceId -> last time it was reported for faces reported after `since`
+        """
+        with self.lock:
+            return {face_id: info['last_seen'] for face_id, info in self.faces.items() if info['last_seen'] > since}
+
+    def reload_aliases(self) -> bool:
+        """
+        Take aliases saved by another process, ie by the collection maintainer of the main process
+        :return: whether the file has changed since it was read
+        """
+        if not self.path or not os.path.exists(self.path):
+            return False
+        mtime = os.stat(self.path).st_mtime
+        if mtime == self.loaded_mtime:
+            return False
+        with open(self.path) as f:
+            state = json.load(f)
+        with self.lock:
+            self.aliases = state['aliases']
+            self.loaded_mtime = mtime
+        return True
+
+    def merge(self, face_id: str, canonical_id: str):
+        with self.lock:
+            self.aliases[face_id] = canonical_id
+            info = self.faces.pop(face_id, None)
+            canonical = self.faces.get(canonical_id)
+            if info and canonical:
+                canonical['last_seen'] = max(canonical['last_seen'], info['last_seen'])
+
+    def merged_into(self, face_id: str) -> list:
+        """
+        :param face_id: canonical FaceId
+        :return: FaceIds merged into it, directly or through other merged faces
+        """
+        with self.lock:
+            merged = []
+            for alias in self.aliases:
+                canonical = alias
+                while canonical in self.aliases:
+                    canonical = self.aliases[canonical]
+                if canonical == face_id:
+                    merged.append(alias)
+            return merged
+
+    def forget(self, face_id: str):
+        with self.lock:
+            self.faces.pop(face_id, None)
+
+    def forget_missing(self, face_ids: set, listed_at: float):
+        """
+        :param face_ids: all the faces of the collection
+        :param listed_at: time the collection was listed at, faces seen later could be indexed after that
+        """
+        with self.lock:
+            for face_id in [face_id for face_id, info in self.faces.items()
+                            if face_id not in face_ids and info['first_seen'] < listed_at]:
+                del self.faces[face_id]
+
+    def info(self, face_id: str) -> dict:
+        with self.lock:
+            return dict(self.faces[face_id]) if face_id in self.faces else None
+
+    def set_checked(self, face_id: str):
+        with self.lock:
+            if face_id in self.faces:
+                self.faces[face_id]['checked'] = True
+
+    def save(self):
+        if not self.path:
+            return
+        with self.lock:
+            state = {'aliases': dict(self.aliases), 'faces': {face_id: dict(info)
+                                                              for face_id, info in self.faces.items()}}
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(state, f)
+        os.replace(tmp_path, self.path)
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                'faces': len(self.faces),
+                'aliases': len(self.aliases),
+            }
+
+
+class CollectionMaintainer:
+    """
+    Background maintenance of AWS Rekognition collection, keeps it from growing with duplicates of the same person:
+        1) lists faces of the collection;
+        2) deletes faces detected with low confidence and faces not reported for `stale_after` seconds;
+        3) searches the collection by every face not checked yet, faces matching each other above
+           `duplicate_threshold` are clustered and merged into the first seen one: the rest are deleted from the
+           collection and become its aliases.
+    Only new faces are searched at every run, since any older duplicate of a new face is found by its search.
+    Requests are made through 'maintenance' limiter of the AWS client, so their rate is bounded.
+    """
+    def __init__(self, aws_client: AWSClient, aliases: FaceAliasMap, duplicate_threshold: float = 95,
+                 min_confidence: float = 90, stale_after: float = 0, interval: float = 3600):
+        """
+        :param aws_client: AWS Rekognition client
+        :param aliases: alias map shared with the workers
+        :param duplicate_threshold: min similarity of faces of the same person
+        :param min_confidence: faces detected with lower confidence are deleted
+        :param stale_after: faces not reported for that many seconds are deleted, 0 keeps them forever
+        :param interval: seconds between maintenance runs
+        """
+        self.aws = aws_client
+        self.aliases = aliases
+        self.duplicate_threshold = duplicate_threshold
+        self.min_confidence = min_confidence
+        self.stale_after = stale_after
+        self.interval = interval
+        self.need_stop = Event()
+        self.last_run = None
+
+    def stop(self):
+        self.need_stop.set()
+
+    def routine(self):
+        while not self.need_stop.wait(timeout=self.interval):
+            try:
+                self.run_once()
+            except Exception as ex:
+                print('Unexpected exception at CollectionMaintainer.routine: %s\n%s' % (ex, traceback.format_exc()))
+
+    def list_faces(self) -> list:
+        faces = []
+        next_token = None
+        while True:
+            resp = self.aws.list_faces(next_token=next_token)
+            faces.extend(resp['Faces'])
+            next_token = resp.get('NextToken')
+            if not next_token or self.need_stop.is_set():
+                return faces
+
+    def run_once(self) -> dict:
+        """
+        Single maintenance run
+        :return: summary of the run, None if stopped
+        """
+        now = time()
+        faces = self.list_faces()
+        if self.need_stop.is_set():
+            # Listing may be incomplete
+            return None
+        # Faces indexed before the map was started are counted as seen now, so they're not stale at once
+        for face in faces:
+            if self.aliases.info(face['FaceId']) is None:
+                self.aliases.touch(face['FaceId'], now)
+        # Faces deleted from the collection by someone else
+        self.aliases.forget_missing({face['FaceId'] for face in faces}, now)
+
+        to_delete = set()
+        for face in faces:
+            info = self.aliases.info(face['FaceId'])
+            if face.get('Confidence', 100) < self.min_confidence:
+                to_delete.add(face['FaceId'])
+            elif self.stale_after and now - info['last_seen'] > self.stale_after:
+                to_delete.add(face['FaceId'])
+        low_quality_or_stale = len(to_delete)
+
+        merged = self.merge_duplicates([face['FaceId'] for face in faces if face['FaceId'] not in to_delete])
+        to_delete.update(merged)
+
+        self.delete_faces(sorted(to_delete))
+        for face_id in to_delete:
+            if face_id not in merged:
+                self.aliases.forget(face_id)
+        self.aliases.save()
+        self.last_run = {
+            'time': now,
+            'faces': len(faces),
+            'deleted': low_quality_or_stale,
+            'merged': len(merged),
+        }
+        return self.last_run
+
+    def merge_duplicates(self, face_ids: list) -> set:
+        """
+        :param face_ids: live faces of the collection
+        :return: FaceIds merged into other faces
+        """
+        live = set(face_ids)
+        parent = {face_id: face_id for face_id in face_ids}
+
+        def find(face_id: str) -> str:
+            while parent[face_id] != face_id:
+                parent[face_id] = parent[parent[face_id]]
+                face_id = parent[face_id]
+            return face_id
+
+        for face_id in face_ids:
+            if self.need_stop.is_set():
+                break
+            if self.aliases.info(face_id)['checked']:
+                continue
+            resp = self.aws.search_faces(face_id, threshold=self.duplicate_threshold)
+            for match in resp['FaceMatches']:
+                match_id = match['Face']['FaceId']
+                if match_id in live:
+                    parent[find(match_id)] = find(face_id)
+            self.aliases.set_checked(face_id)
+
+        clusters = {}
+        for face_id in face_ids:
+            clusters.setdefault(find(face_id), []).append(face_id)
+        merged = set()
+        for members in clusters.values():
+            if len(members) < 2:
+                continue
+            # Keep the oldest one, its FaceId is reported the longest
+            members.sort(key=lambda face_id: (self.aliases.info(face_id)['first_seen'], face_id))
+            for face_id in members[1:]:
+                self.aliases.merge(face_id, members[0])
+                merged.add(face_id)
+        return merged
+
+    def delete_faces(self, face_ids: list):
+        # AWS Rekognition accepts up to 4096 faces per request
+        for idx in range(0, len(face_ids), 4096):
+            self.aws.delete_faces(face_ids[idx:idx + 4096])
+
+    def stats(self) -> dict:
+        return {
+            'aliases': self.aliases.stats(),
+            'last_run': self.last_run,
+        }
@@ -0,0 +1,164 @@
+from datetime import datetime, timezone
+import json
+import sqlite3
+from threading import Lock
+from time import monotonic
+
+from .scheduler import event_timestamp
+
+
+def parse_time(value: str) -> float:
+    """
+    :param value: UTC time as VXG Server reports it (ISO 8601 without the zone) or Unix timestamp
+    :raises ValueError: neither of them
+    :return: Unix timestamp
+    """
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.fromisoformat(value.rstrip('Z')).replace(tzinfo=timezone.utc).timestamp()
+
+
+def format_time(timestamp: float) -> str:
+    """
+    :param timestamp: Unix timestamp
+    :return: UTC time as VXG Server reports it
+    """
+    return datetime.fromtimestamp(timestamp, timezone.utc).replace(tzinfo=None).isoformat()
+
+
+class IdentityStore:
+    """
+    Local record of every face reported for an event: FaceId, camera, event time, bounding box and similarity of the
+    match, backed by SQLite in WAL mode. Indexes by FaceId and by camera, both followed by time, serve "events of the
+    face within a time range" and "faces seen by the camera" lookups in milliseconds without asking VXG Server.
+    Sightings are written in batches, lookups write the pending ones first, so they always see every reported face.
+    FaceIds are valid for a single collection only, so every lookup is made within the collection.
+    Several processes may share the file.
+    """
+    def __init__(self, path: str, flush_size: int = 100, flush_interval: float = 1.0):
+        """
+        :param path: SQLite database file
+        :param flush_size: write sightings when that many are pending
+        :param flush_interval: write sightings at least that often, seconds
+        """
+        self.path = path
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.lock = Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=10)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS sightings ('
+                        'collection TEXT NOT NULL, event_id INTEGER NOT NULL, face_id TEXT NOT NULL, camid TEXT, '
+                        'time REAL NOT NULL, bounding_box TEXT, similarity REAL, '
+                        'PRIMARY KEY (collection, event_id, face_id))')
+        self.db.execute('CREATE INDEX IF NOT EXISTS sightings_face ON sightings (collection, face_id, time)')
+        # Covers the camera lookup, so it doesn't touch the table at all
+        self.db.execute('CREATE INDEX IF NOT EXISTS sightings_camera ON sightings (collection, camid, time, face_id)')
+        self.pending = []
+        self.flushed_at = monotonic()
+        self.recorded_count = 0
+        self.lookups_count = 0
+
+    def record(self, collection: str, item: dict, faces: list):
+        """
+        Record faces reported for the event, written to the database with the next batch
+        :param collection: AWS Rekognition collection the faces belong to
+        :param item: task from the processing queue
+        :param faces: faces reported for the event, dicts with essential key 'FaceId'
+        """
+        if not faces:
+            return
+        timestamp = event_timestamp(item)
+        camid = str(item['camid']) if item.get('camid') is not None else None
+        rows = [(collection, item['id'], face['FaceId'], camid, timestamp,
+                 json.dumps(face['BoundingBox']) if face.get('BoundingBox') else None, face.get('Similarity'))
+                for face in faces]
+        with self.lock:
+            self.pending.extend(rows)
+            self.recorded_count += len(rows)
+            if len(self.pending) >= self.flush_size or monotonic() - self.flushed_at >= self.flush_interval:
+                self._flush()
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+    def _flush(self):
+        self.flushed_at = monotonic()
+        if not self.pending:
+            return
+        rows = self.pending
+        self.pending = []
+        self.db.execute('BEGIN')
+        # Event processed again (ie replayed by the journal) reports the same faces
+        self.db.executemany('INSERT OR REPLACE INTO sightings (collection, event_id, face_id, camid, time, '
+                            'bounding_box, similarity) VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+        self.db.execute('COMMIT')
+
+    def events_for_face(self, collection: str, face_ids: list, start: float = None, end: float = None,
+                        limit: int = 100) -> list:
+        """
+        :param collection: AWS Rekognition collection
+        :param face_ids: FaceId of the person along with FaceIds merged into it
+        :param start: Unix timestamp, inclusive
+        :param end: Unix timestamp, exclusive
+        :param limit: max events to return
+        :return: sightings of the faces, the latest first
+        """
+        query = ('SELECT event_id, face_id, camid, time, bounding_box, similarity FROM sightings '
+                 'WHERE collection = ? AND face_id IN (%s)' % ','.join('?' * len(face_ids)))
+        query, params = self._time_range(query, [collection] + list(face_ids), start, end)
+        with self.lock:
+            self._flush()
+            self.lookups_count += 1
+            rows = self.db.execute(query + ' ORDER BY time DESC LIMIT ?', params + [limit]).fetchall()
+        return [{'event_id': event_id, 'face_id': face_id, 'camid': camid, 'time': format_time(timestamp),
+                 'bounding_box': json.loads(bounding_box) if bounding_box else None, 'similarity': similarity}
+                for event_id, face_id, camid, timestamp, bounding_box, similarity in rows]
+
+    def faces_on_camera(self, collection: str, camid: str, start: float = None, end: float = None,
+                        limit: int = 100) -> list:
+        """
+        :param collection: AWS Rekognition collection
+        :param camid: camera ID
+        :param start: Unix timestamp, inclusive
+        :param end: Unix timestamp, exclusive
+        :param limit: max faces to return
+        :return: faces seen by the camera with the number of their events, the last seen first
+        """
+        query, params = self._time_range('SELECT face_id, COUNT(*), MIN(time), MAX(time) FROM sightings '
+                                         'WHERE collection = ? AND camid = ?', [collection, str(camid)], start, end)
+        with self.lock:
+            self._flush()
+            self.lookups_count += 1
+            rows = self.db.execute(query + ' GROUP BY face_id ORDER BY MAX(time) DESC LIMIT ?',
+                                   params + [limit]).fetchall()
+        return [{'face_id': face_id, 'events': events, 'first_seen': format_time(first_seen),
+                 'last_seen': format_time(last_seen)}
+                for face_id, events, first_seen, last_seen in rows]
+
+    @staticmethod
+    def _time_range(query: str, params: list, start: float = None, end: float = None) -> (str, list):
+        if start is not None:
+            query += ' AND time >= ?'
+            params.append(start)
+        if end is not None:
+            query += ' AND time < ?'
+            params.append(end)
+        return query, params
+
+    def close(self):
+        with self.lock:
+            self._flush()
+            self.db.close()
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                'path': self.path,
+                'recorded': self.recorded_count,
+                'pending': len(self.pending),
+                'lookups': self.lookups_count,
+            }
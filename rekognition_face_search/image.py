@@ -0,0 +1,89 @@
+from io import BytesIO
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+from .http_pool import HTTPPool
+
+
+class ImageError(Exception):
+    """
+    Image can't be processed, `reason` is reported to VXG Server
+    """
+    def __init__(self, reason: str):
+        super(ImageError, self).__init__(reason)
+        self.reason = reason
+
+
+class ImageLoader:
+    """
+    Downloads images from the storage and prepares them for AWS Rekognition.
+    Download is streamed and aborted as soon as the image is bigger than `max_bytes`. Images bigger than `max_side`
+    pixels are downscaled and re-encoded to JPEG, it saves AWS Rekognition payload time while keeping enough details
+    for face search. Downscaling requires Pillow, images are passed as is without it.
+    """
+    CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, http: HTTPPool, max_bytes: int = 5 * 1024 * 1024, timeout: float = 10, max_side: int = 0,
+                 quality: int = 90):
+        """
+        :param http: HTTP pool to download with
+        :param max_bytes: max image size, AWS Rekognition accepts up to 5MB
+        :param timeout: connect and read timeout in seconds
+        :param max_side: max image width and height in pixels, 0 disables downscaling
+        :param quality: JPEG quality of downscaled images
+        """
+        self.http = http
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+        self.max_side = max_side
+        self.quality = quality
+
+    def load(self, url: str) -> bytes:
+        """
+        :param url: image URL
+        :raises ImageError: image is too large
+        :return: image ready to be sent to AWS Rekognition
+        """
+        return self.downscale(self.download(url))
+
+    def download(self, url: str) -> bytes:
+        resp = self.http.get(url, stream=True, timeout=self.timeout)
+        try:
+            resp.raise_for_status()
+            if int(resp.headers.get('Content-Length') or 0) > self.max_bytes:
+                raise ImageError('image_too_large')
+            chunks = []
+            size = 0
+            for chunk in resp.iter_content(chunk_size=self.CHUNK_SIZE):
+                size += len(chunk)
+                if size > self.max_bytes:
+                    raise ImageError('image_too_large')
+                chunks.append(chunk)
+            return b''.join(chunks)
+        finally:
+            resp.close()
+
+    def downscale(self, image: bytes) -> bytes:
+        """
+        :param image: encoded image
+        :return: downscaled and re-encoded image or the same one if it's small enough or can't be decoded
+        """
+        if not self.max_side or Image is None:
+            return image
+        try:
+            with Image.open(BytesIO(image)) as img:
+                if max(img.size) <= self.max_side:
+                    return image
+                # Let JPEG decoder skip the resolution we don't need
+                img.draft('RGB', (self.max_side, self.max_side))
+                img = img.convert('RGB')
+                img.thumbnail((self.max_side, self.max_side))
+                out = BytesIO()
+                img.save(out, format='JPEG', quality=self.quality)
+                return out.getvalue()
+        except (OSError, ValueError):
+            # Let AWS Rekognition decide what to do with it
+            return image
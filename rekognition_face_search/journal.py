@@ -0,0 +1,103 @@
+import json
+import sqlite3
+from threading import Lock
+from time import monotonic
+
+
+class WorkJournal:
+    """
+    Durable record of queued events backed by SQLite in WAL mode.
+    Events are journalled before they are tagged "processing" and removed when processed, so whatever was queued but
+    not processed when the process died is replayed on the next start instead of keeping the tag forever.
+    Completions are written in batches: after a crash some processed events may be replayed once more, that's harmless
+    as processing an event again just sets the same meta.
+    """
+    def __init__(self, path: str, flush_size: int = 50, flush_interval: float = 1.0):
+        """
+        :param path: SQLite database file
+        :param flush_size: write completions when that many are pending
+        :param flush_interval: write completions at least that often, seconds
+        """
+        self.path = path
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.lock = Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        # WAL with NORMAL sync survives process crashes, fsync happens at checkpoints only
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS queued (id INTEGER PRIMARY KEY, item TEXT NOT NULL)')
+        self.completed = []
+        self.flushed_at = monotonic()
+        self.recovered = False
+        self.enqueued_count = 0
+        self.completed_count = 0
+        self.replayed_count = 0
+
+    def enqueue(self, items: list):
+        """
+        Record items about to be queued, all in one transaction
+        :param items: queue items, must have 'id' key
+        """
+        if not items:
+            return
+        rows = [(item['id'], json.dumps(item)) for item in items]
+        with self.lock:
+            self.db.execute('BEGIN')
+            self.db.executemany('INSERT OR REPLACE INTO queued (id, item) VALUES (?, ?)', rows)
+            self.db.execute('COMMIT')
+            self.enqueued_count += len(rows)
+
+    def complete(self, event_id: int):
+        """
+        Record the event as processed, written to the database with the next batch
+        :param event_id: VXG Server event ID
+        """
+        with self.lock:
+            self.completed.append(event_id)
+            self.completed_count += 1
+            if len(self.completed) >= self.flush_size or monotonic() - self.flushed_at >= self.flush_interval:
+                self._flush()
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+    def _flush(self):
+        self.flushed_at = monotonic()
+        if not self.completed:
+            return
+        rows = [(event_id,) for event_id in self.completed]
+        self.completed = []
+        self.db.execute('BEGIN')
+        self.db.executemany('DELETE FROM queued WHERE id = ?', rows)
+        self.db.execute('COMMIT')
+
+    def recover(self) -> list:
+        """
+        Get events left unprocessed by the previous run. Returns them once per journal, later calls give nothing
+        as those events are already queued by then.
+        :return: queue items
+        """
+        with self.lock:
+            if self.recovered:
+                return []
+            self.recovered = True
+            items = [json.loads(row[0]) for row in self.db.execute('SELECT item FROM queued ORDER BY id')]
+            self.replayed_count += len(items)
+            return items
+
+    def close(self):
+        with self.lock:
+            self._flush()
+            self.db.close()
+
+    def stats(self) -> dict:
+        with self.lock:
+            pending = max(0, self.db.execute('SELECT COUNT(*) FROM queued').fetchone()[0] - len(self.completed))
+            return {
+                'pending': pending,
+                'enqueued': self.enqueued_count,
+                'completed': self.completed_count,
+                'replayed': self.replayed_count,
+            }
@@ -0,0 +1,244 @@
+import hashlib
+import json
+import os
+from collections import OrderedDict
+from threading import Lock
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+class LocalIndexUnavailable(Exception):
+    pass
+
+
+class EmbeddingModel:
+    """
+    Interface of a local CPU face detector and embedding model
+    """
+    DIMENSIONS = 128
+
+    def embed(self, image: bytes) -> tuple:
+        """
+        :param image: encoded image
+        :return: unit length float32 vector of `DIMENSIONS` for the biggest face at the image or None if no face found,
+            and bounding box of that face in AWS Rekognition format or None if the model doesn't locate faces
+        """
+        raise NotImplementedError()
+
+
+class StandInEmbeddingModel(EmbeddingModel):
+    """
+    Stand-in model, gives the same embedding for byte-identical images and unrelated ones for anything else.
+    Used for tests and when no real model is configured.
+    """
+    def embed(self, image: bytes) -> tuple:
+        seed = int.from_bytes(hashlib.sha1(image).digest()[:4], 'big')
+        vector = np.random.RandomState(seed).standard_normal(self.DIMENSIONS).astype(np.float32)
+        return vector / np.linalg.norm(vector), None
+
+
+class LocalFaceIndex:
+    """
+    Vector index of faces already known to AWS Rekognition, a single vector per FaceId: the latest one learned.
+    At most `max_size` faces are kept, the least recently matched or learned one is evicted for a new face.
+    Vectors are kept at memory-mapped `<path>.npy` file, changes of the rows are appended to `<path>.jsonl` file, so
+    the index is loaded warm after restart. Without path the index is kept in memory only.
+    """
+    CANDIDATES = 8  # Closest rows measured again under the lock, the scan itself is made without it
+
+    def __init__(self, dimensions: int, path: str = None, capacity: int = 1024, max_size: int = 100000):
+        if np is None:
+            raise LocalIndexUnavailable('NumPy is required for the local face index')
+        self.dimensions = dimensions
+        self.path = path
+        self.max_size = max_size
+        self.lock = Lock()
+        self.faces = []  # Face of every row
+        self.rows = OrderedDict()  # FaceId -> row, least recently used first
+        self.records_count = 0  # Lines at the .jsonl file
+        if path and os.path.exists(path + '.npy'):
+            self._load()
+        else:
+            self.vectors = self._allocate(min(capacity, max_size))
+
+    def _allocate(self, capacity: int):
+        if self.path:
+            # Searches running without the lock still read the previous file, so it's replaced rather than rewritten
+            vectors = np.lib.format.open_memmap(self.path + '.npy.tmp', mode='w+', dtype=np.float32,
+                                                shape=(capacity, self.dimensions))
+            os.replace(self.path + '.npy.tmp', self.path + '.npy')
+            return vectors
+        return np.zeros((capacity, self.dimensions), dtype=np.float32)
+
+    def _load(self):
+        vectors = np.load(self.path + '.npy', mmap_mode='r+')
+        faces = {}
+        rows = OrderedDict()
+        complete = True
+        if os.path.exists(self.path + '.jsonl'):
+            with open(self.path + '.jsonl') as f:
+                # Last line could be written partially when process crashed
+                for number, line in enumerate(f):
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        complete = False
+                        break
+                    # Rows were only appended before the index kept a single one per FaceId
+                    row, face = (record['row'], record['face']) if 'row' in record else (number, record)
+                    if row >= len(vectors):
+                        break
+                    replaced = faces.get(row)
+                    if replaced is not None and rows.get(replaced['FaceId']) == row:
+                        del rows[replaced['FaceId']]
+                    faces[row] = face
+                    rows.pop(face['FaceId'], None)
+                    rows[face['FaceId']] = row
+                    self.records_count += 1
+        if complete and self.records_count == len(rows) <= self.max_size:
+            # Every record has added a row
+            self.vectors = vectors
+            self.faces = [faces[row] for row in range(len(rows))]
+            self.rows = rows
+            return
+        # Drop replaced rows, rows of the duplicated FaceIds and the partially written line
+        kept = list(rows.values())[-self.max_size:]
+        old_vectors = np.array(vectors[kept])
+        del vectors
+        self.vectors = self._allocate(max(len(kept), 1))
+        self.vectors[:len(kept)] = old_vectors
+        self.vectors.flush()
+        self.faces = [faces[row] for row in kept]
+        self.rows = OrderedDict((face['FaceId'], row) for row, face in enumerate(self.faces))
+        self._rewrite_records()
+
+    def _rewrite_records(self):
+        with open(self.path + '.jsonl.tmp', 'w') as f:
+            for row, face in enumerate(self.faces):
+                f.write(json.dumps({'row': row, 'face': face}) + '\n')
+        os.replace(self.path + '.jsonl.tmp', self.path + '.jsonl')
+        self.records_count = len(self.faces)
+
+    def __len__(self):
+        return len(self.faces)
+
+    def add(self, vector, face: dict):
+        """
+        :param vector: unit length face embedding
+        :param face: face as returned by AWS Rekognition, with essential key 'FaceId'
+        """
+        with self.lock:
+            row = self.rows.pop(face['FaceId'], None)
+            if row is None and len(self.faces) >= self.max_size:
+                _, row = self.rows.popitem(last=False)
+            if row is None:
+                row = len(self.faces)
+                if row == len(self.vectors):
+                    old_vectors = np.array(self.vectors) if self.path else self.vectors
+                    self.vectors = self._allocate(min(row * 2, self.max_size))
+                    self.vectors[:row] = old_vectors
+                self.faces.append(face)
+            else:
+                self.faces[row] = face
+            self.vectors[row] = vector
+            self.rows[face['FaceId']] = row
+            if self.path:
+                self.vectors.flush()
+                if self.records_count >= 2 * len(self.faces) + 1024:
+                    self._rewrite_records()
+                else:
+                    with open(self.path + '.jsonl', 'a') as f:
+                        f.write(json.dumps({'row': row, 'face': face}) + '\n')
+                    self.records_count += 1
+
+    def search(self, vector) -> (dict, float, float):
+        """
+        Find the closest face
+        :param vector: unit length face embedding
+        :return: closest face, its cosine similarity and similarity of the second closest face
+        """
+        with self.lock:
+            count = len(self.faces)
+            vectors = self.vectors
+        if not count:
+            return None, 0.0, 0.0
+        similarities = vectors[:count] @ vector
+        if count > self.CANDIDATES:
+            closest = np.argpartition(similarities, count - self.CANDIDATES)[count - self.CANDIDATES:]
+        else:
+            closest = range(count)
+        with self.lock:
+            # Rows could be replaced with other faces during the scan
+            scored = sorted(((float(self.vectors[row] @ vector), row) for row in closest), reverse=True)
+            similarity, row = scored[0]
+            best = self.faces[row]
+            self.rows.move_to_end(best['FaceId'])
+            return dict(best), similarity, scored[1][0] if len(scored) > 1 else 0.0
+
+
+class LocalMatcher:
+    """
+    Local matching stage in front of AWS Rekognition search.
+    Only confident matches are reported: similarity is above `threshold` and the best face is ahead of any other
+    face by `margin`. Everything else falls through to AWS, and its results are learned by the index.
+    """
+    def __init__(self, model: EmbeddingModel, index: LocalFaceIndex, threshold: float = 0.95, margin: float = 0.05):
+        self.model = model
+        self.index = index
+        self.threshold = threshold
+        self.margin = margin
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def embed(self, image: bytes) -> tuple:
+        """
+        :param image: encoded image
+        :return: face embedding and bounding box, see `EmbeddingModel.embed`
+        """
+        return self.model.embed(image)
+
+    def match(self, embedding: tuple):
+        """
+        :param embedding: face embedding and bounding box from `embed`
+        :return: list of faces to report or None if there's no confident match
+        """
+        vector, bounding_box = embedding
+        face, similarity, second_similarity = (None, 0.0, 0.0) if vector is None else self.index.search(vector)
+        confident = face is not None and similarity >= self.threshold and similarity - second_similarity >= self.margin
+        with self.lock:
+            if confident:
+                self.hits += 1
+            else:
+                self.misses += 1
+        if not confident:
+            return None
+        if bounding_box is not None:
+            # Face is located at this image, not at the one it was learned from
+            face['BoundingBox'] = bounding_box
+        if 'Similarity' in face:
+            # Similarity of this match at the same 0-100 scale, not the one of the match it was learned from
+            face['Similarity'] = round(similarity * 100, 2)
+        return [face]
+
+    def learn(self, embedding: tuple, faces: list):
+        """
+        Remember AWS Rekognition result for the image
+        :param embedding: face embedding and bounding box from `embed`
+        :param faces: faces reported for the image
+        """
+        vector, _ = embedding
+        # Embedding is taken for the biggest face only, so can't tell which face it is when there's many
+        if vector is not None and len(faces) == 1:
+            self.index.add(vector, faces[0])
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                'size': len(self.index),
+                'hits': self.hits,
+                'misses': self.misses,
+            }
@@ -0,0 +1,301 @@
+from bisect import bisect_left
+from threading import Lock
+from time import monotonic
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Metric:
+    """
+    Prometheus-style metric with labels.
+    Recording is a dict lookup and a locked add, cheap enough to keep it always on.
+    """
+    TYPE = None
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), registry: 'Registry' = None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.children = {}
+        self.lock = Lock()
+        (registry if registry is not None else REGISTRY).register(self)
+
+    def labels(self, *values):
+        """
+        :param values: label values in order of `labelnames`
+        :return: metric child for those values
+        """
+        child = self.children.get(values)
+        if child is None:
+            with self.lock:
+                child = self.children.setdefault(values, self._new_child())
+        return child
+
+    def _new_child(self):
+        raise NotImplementedError()
+
+    def _format_labels(self, values: tuple, extra: tuple = ()) -> str:
+        pairs = list(zip(self.labelnames, values)) + list(extra)
+        if not pairs:
+            return ''
+        return '{%s}' % ','.join('%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                                 for name, value in pairs)
+
+    def snapshot(self) -> dict:
+        """
+        :return: label values -> current value of the child, picklable
+        """
+        return {values: child.get() for values, child in list(self.children.items())}
+
+    def combine(self, value, other):
+        """
+        Merge values of the same child recorded at different processes
+        """
+        return value + other
+
+    def expose(self, remote: list = ()) -> list:
+        """
+        :param remote: snapshots of the same metric at other processes, added to the local values
+        """
+        lines = ['# HELP %s %s' % (self.name, self.documentation), '# TYPE %s %s' % (self.name, self.TYPE)]
+        merged = self.snapshot()
+        for snapshot in remote:
+            for values, value in snapshot.items():
+                merged[values] = self.combine(merged[values], value) if values in merged else value
+        for values, value in sorted(merged.items()):
+            lines.extend(self._expose_value(values, value))
+        return lines
+
+    def _expose_value(self, values: tuple, value) -> list:
+        return ['%s%s %s' % (self.name, self._format_labels(values), _format_value(value))]
+
+
+class CounterChild:
+    def __init__(self):
+        self.value = 0
+        self.lock = Lock()
+
+    def inc(self, amount: float = 1):
+        with self.lock:
+            self.value += amount
+
+    def get(self) -> float:
+        return self.value
+
+
+class Counter(Metric):
+    TYPE = 'counter'
+
+    def _new_child(self):
+        return CounterChild()
+
+    def inc(self, amount: float = 1):
+        self.labels().inc(amount)
+
+
+class GaugeChild:
+    def __init__(self):
+        self.value = 0
+        self.function = None
+        self.lock = Lock()
+
+    def set(self, value: float):
+        self.value = value
+
+    def inc(self, amount: float = 1):
+        with self.lock:
+            self.value += amount
+
+    def dec(self, amount: float = 1):
+        self.inc(-amount)
+
+    def set_function(self, function):
+        """
+        :param function: callable returning the value at the time of exposition, None to use the set value
+        """
+        self.function = function
+
+    def get(self) -> float:
+        return self.function() if self.function is not None else self.value
+
+
+class Gauge(Metric):
+    TYPE = 'gauge'
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), registry: 'Registry' = None,
+                 aggregate: str = 'sum'):
+        """
+        :param aggregate: how values of several processes are merged: "sum" or "max"
+        """
+        self.aggregate = aggregate
+        super(Gauge, self).__init__(name, documentation, labelnames, registry)
+
+    def combine(self, value, other):
+        return max(value, other) if self.aggregate == 'max' else value + other
+
+    def _new_child(self):
+        return GaugeChild()
+
+    def set(self, value: float):
+        self.labels().set(value)
+
+    def inc(self, amount: float = 1):
+        self.labels().inc(amount)
+
+    def dec(self, amount: float = 1):
+        self.labels().dec(amount)
+
+    def set_function(self, function):
+        self.labels().set_function(function)
+
+
+class Timer:
+    def __init__(self, histogram: 'HistogramChild'):
+        self.histogram = histogram
+        self.started = None
+
+    def __enter__(self):
+        self.started = monotonic()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.histogram.observe(monotonic() - self.started)
+
+
+class HistogramChild:
+    def __init__(self, buckets: tuple):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.lock = Lock()
+
+    def observe(self, value: float):
+        idx = bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[idx] += 1
+            self.sum += value
+
+    def time(self) -> Timer:
+        """
+        :return: context manager observing the time spent inside
+        """
+        return Timer(self)
+
+    def get(self) -> (list, float):
+        with self.lock:
+            return list(self.counts), self.sum
+
+
+class Histogram(Metric):
+    TYPE = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), buckets: tuple = DEFAULT_BUCKETS,
+                 registry: 'Registry' = None):
+        self.buckets = tuple(sorted(buckets))
+        super(Histogram, self).__init__(name, documentation, labelnames, registry)
+
+    def _new_child(self):
+        return HistogramChild(self.buckets)
+
+    def observe(self, value: float):
+        self.labels().observe(value)
+
+    def time(self) -> Timer:
+        return self.labels().time()
+
+    def combine(self, value, other):
+        return [count + other_count for count, other_count in zip(value[0], other[0])], value[1] + other[1]
+
+    def _expose_value(self, values: tuple, value) -> list:
+        counts, total = value
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += count
+            lines.append('%s_bucket%s %d' % (self.name, self._format_labels(values, (('le', _format_value(bound)),)),
+                                             cumulative))
+        lines.append('%s_sum%s %s' % (self.name, self._format_labels(values), _format_value(total)))
+        lines.append('%s_count%s %d' % (self.name, self._format_labels(values), cumulative))
+        return lines
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Registry:
+    """
+    Metrics of the process. Metrics of worker processes are merged in as their snapshots, so /metrics of the main
+    process covers all of them.
+    """
+    def __init__(self):
+        self.metrics = []
+        self.remote = {}  # source -> snapshot of a running process
+        self.retired = {}  # counters and histograms of finished processes
+        self.lock = Lock()
+
+    def register(self, metric: Metric):
+        with self.lock:
+            self.metrics.append(metric)
+
+    def snapshot(self) -> dict:
+        """
+        :return: metric name -> snapshot of the metric, picklable
+        """
+        return {metric.name: metric.snapshot() for metric in list(self.metrics)}
+
+    def merge_remote(self, source: str, snapshot: dict):
+        """
+        Replace metrics of another process with its newer snapshot
+        :param source: unique name of the process
+        :param snapshot: result of `snapshot` at that process
+        """
+        with self.lock:
+            self.remote[source] = snapshot
+
+    def retire_remote(self, source: str):
+        """
+        Keep totals of the finished process, so counters don't go back when worker processes are restarted.
+        Its gauges are dropped.
+        :param source: unique name of the process
+        """
+        with self.lock:
+            snapshot = self.remote.pop(source, None)
+            if snapshot is None:
+                return
+            for metric in self.metrics:
+                if metric.TYPE == 'gauge' or metric.name not in snapshot:
+                    continue
+                retired = self.retired.setdefault(metric.name, {})
+                for values, value in snapshot[metric.name].items():
+                    retired[values] = metric.combine(retired[values], value) if values in retired else value
+
+    def expose(self) -> str:
+        """
+        :return: all the metrics in Prometheus text exposition format
+        """
+        with self.lock:
+            snapshots = list(self.remote.values()) + [self.retired]
+        lines = []
+        for metric in list(self.metrics):
+            lines.extend(metric.expose([snapshot[metric.name] for snapshot in snapshots if metric.name in snapshot]))
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+STAGE_SECONDS = Histogram('rek_face_search_stage_seconds', 'Time spent at the processing stage', ('stage',))
+EVENTS = Counter('rek_face_search_events_total', 'Processed events by result', ('result',))
+ERRORS = Counter('rek_face_search_errors_total', 'Errors by stage and exception type', ('stage', 'type'))
+REJECTED = Counter('rek_face_search_rejected_total', 'Faces rejected for indexing by reason', ('reason',))
+AWS_THROTTLES = Counter('rek_face_search_aws_throttles_total', 'Throttled AWS Rekognition requests', ('api',))
+IN_FLIGHT = Gauge('rek_face_search_in_flight', 'Events being processed by workers')
+QUEUE_SIZE = Gauge('rek_face_search_queue_size', 'Events waiting at the processing queue')
+QUEUE_AGE = Gauge('rek_face_search_queue_age_seconds', 'Time the last dequeued event waited at the queue',
+                  aggregate='max')
+RETRIES = Counter('rek_face_search_retries_total', 'Failed events put aside to be retried by failed dependency',
+                  ('dependency',))
+BREAKER_OPEN = Gauge('rek_face_search_breaker_open', 'Circuit breaker of the dependency is open (1) or not (0)',
+                     ('dependency',), aggregate='max')
@@ -0,0 +1,174 @@
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from io import BytesIO
+from threading import Lock
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+from .aws_client import AWSClient
+from .quality import FaceRejected
+
+
+class MultiFaceUnavailable(Exception):
+    pass
+
+
+def crop_face(img, bounding_box: dict, margin: float, quality: int = 90) -> bytes:
+    """
+    :param img: decoded image
+    :param bounding_box: face bounding box in AWS Rekognition format, ratios of the image size
+    :param margin: part of the face size added at every side, AWS Rekognition needs some context to detect the face
+    :param quality: JPEG quality of the crop
+    :return: encoded crop
+    """
+    width, height = img.size
+    face_width = bounding_box['Width'] * width
+    face_height = bounding_box['Height'] * height
+    left = max(0, int(bounding_box['Left'] * width - face_width * margin))
+    top = max(0, int(bounding_box['Top'] * height - face_height * margin))
+    right = min(width, int(bounding_box['Left'] * width + face_width * (1 + margin)))
+    bottom = min(height, int(bounding_box['Top'] * height + face_height * (1 + margin)))
+    crop = img.crop((left, top, right, bottom))
+    if crop.mode not in ('RGB', 'L'):
+        crop = crop.convert('RGB')
+    out = BytesIO()
+    crop.save(out, format='JPEG', quality=quality)
+    return out.getvalue()
+
+
+def has_more_faces(index_resp: dict) -> bool:
+    """
+    :param index_resp: "index_faces" response for the whole frame made with MaxFaces 1
+    :return: whether there are other faces at the frame besides the indexed one
+    """
+    return len(index_resp['FaceRecords']) > 1 or any('EXCEEDS_MAX_FACES' in face.get('Reasons', ())
+                                                     for face in index_resp.get('UnindexedFaces', ()))
+
+
+def merge_faces(boxes: list, results: list) -> list:
+    """
+    Merge results of the face crops into faces of the frame
+    :param boxes: bounding boxes of the faces at the frame, the biggest first
+    :param results: faces found at every crop or FaceRejected if its face wasn't indexed
+    :raises FaceRejected: no faces are found and some of them are rejected
+    :return: faces to report, each one with its bounding box at the frame
+    """
+    faces = {}
+    rejected = None
+    for box, result in zip(boxes, results):
+        if isinstance(result, FaceRejected):
+            rejected = rejected or result
+            continue
+        for face in result:
+            # The same person may be detected twice (ie at a reflection), the biggest face is reported
+            if face['FaceId'] not in faces:
+                faces[face['FaceId']] = dict(face, BoundingBox=box)
+    if not faces and rejected is not None:
+        raise rejected
+    return list(faces.values())
+
+
+class MultiFaceSearch:
+    """
+    AWS Rekognition searches only the biggest face of an image. With several people in a frame, faces are detected
+    once with DetectFaces, every face is cropped in memory and the crops are searched concurrently.
+    DetectFaces is called only for frames known to have several faces: the biggest face is not familiar and indexing
+    it alone leaves other faces unindexed. Other faces of frames with a familiar biggest face are searched only with
+    `detect_always`, it calls DetectFaces for every frame.
+    Crops of a single frame run at most `per_frame` at once at the thread pool shared by all the workers, so crowded
+    scenes don't take the whole pool and starve other events. Frames with a single face are searched as usual.
+    Requires Pillow.
+    """
+    def __init__(self, aws_client: AWSClient, max_faces: int = 10, per_frame: int = 4, min_confidence: float = 90,
+                 margin: float = 0.3, quality: int = 90, pool_size: int = 20, detect_always: bool = False):
+        """
+        :param aws_client: AWS Rekognition client to detect faces with
+        :param max_faces: max faces searched at a single frame, the biggest ones are taken
+        :param per_frame: max crops of a single frame searched at once
+        :param min_confidence: faces detected with lower confidence are ignored
+        :param margin: part of the face size added around the crop
+        :param quality: JPEG quality of the crops
+        :param pool_size: threads searching the crops, shared by all the frames
+        :param detect_always: detect faces at every frame, not only at the ones known to have several faces
+        """
+        if Image is None:
+            raise MultiFaceUnavailable('Pillow is not installed')
+        self.aws = aws_client
+        self.max_faces = max_faces
+        self.per_frame = per_frame
+        self.min_confidence = min_confidence
+        self.margin = margin
+        self.quality = quality
+        self.pool_size = pool_size
+        self.detect_always = detect_always
+        self.executor = ThreadPoolExecutor(max_workers=pool_size, thread_name_prefix='MultiFace')
+        self.lock = Lock()
+        self.frames_count = 0
+        self.multi_face_frames_count = 0
+        self.crops_count = 0
+
+    def detect(self, image: bytes) -> list:
+        """
+        :param image: encoded image
+        :return: bounding boxes of the faces, the biggest first
+        """
+        resp = self.aws.detect_faces(image)
+        boxes = [face['BoundingBox'] for face in resp['FaceDetails'] if face['Confidence'] >= self.min_confidence]
+        boxes.sort(key=lambda box: box['Width'] * box['Height'], reverse=True)
+        return boxes[:self.max_faces]
+
+    def split(self, image: bytes) -> tuple:
+        """
+        :param image: encoded image
+        :return: bounding boxes of the faces and their encoded crops, None if the frame is to be searched as a whole
+        """
+        boxes = self.detect(image)
+        with self.lock:
+            self.frames_count += 1
+        if not boxes:
+            return [], []
+        if len(boxes) == 1:
+            return None
+        try:
+            with Image.open(BytesIO(image)) as img:
+                crops = [crop_face(img, box, self.margin, self.quality) for box in boxes]
+        except (OSError, ValueError):
+            # AWS Rekognition has decoded it, so let it search the biggest face at least
+            return None
+        with self.lock:
+            self.multi_face_frames_count += 1
+            self.crops_count += len(crops)
+        return boxes, crops
+
+    def run(self, calls: list) -> list:
+        """
+        Run the calls of a single frame at the shared pool, at most `per_frame` at once
+        :param calls: list of callables without arguments
+        :raises Exception: the first exception raised by any of the calls, after all the started ones are finished
+        :return: results of the calls in the same order
+        """
+        futures = []
+        running = set()
+        for call in calls:
+            if len(running) >= self.per_frame:
+                _, running = wait(running, return_when=FIRST_COMPLETED)
+            future = self.executor.submit(call)
+            futures.append(future)
+            running.add(future)
+        wait(running)
+        return [future.result() for future in futures]
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                'detect_always': self.detect_always,
+                'per_frame': self.per_frame,
+                'frames': self.frames_count,
+                'multi_face_frames': self.multi_face_frames_count,
+                'crops': self.crops_count,
+            }
@@ -0,0 +1,239 @@
+from queue import Queue, Empty
+from threading import Event, Lock, Thread
+from time import time
+import traceback
+
+from .aws_client import AWSClient
+from .dedup import DedupCache, image_hash
+from .hygiene import FaceAliasMap
+from .identity_store import IdentityStore
+from .image import ImageError, ImageLoader
+from .journal import WorkJournal
+from .local_index import LocalMatcher
+from .metrics import ERRORS, EVENTS, IN_FLIGHT, STAGE_SECONDS
+from .multi_face import MultiFaceSearch
+from .quality import FaceRejected, QualityGate
+from .resilience import DEPENDENCY_DOWNLOAD, DEPENDENCY_VXG, RetryQueue
+from .vxg_client import VXGClient
+from .worker import FaceRecognizer, observe_dequeued
+
+
+class PipelineStage:
+    """
+    Pool of threads taking tasks from `in_queue`, passing them to `handler` and putting results to `out_queue`.
+    Bounded `out_queue` blocks the stage when the next one can't keep up, so the pressure propagates back to the
+    processing queue and the poller.
+    The first stage stops taking tasks as soon as `need_stop` is set, later stages finish whatever their upstream
+    stage has passed to them.
+    """
+    GET_TIMEOUT = 0.1
+
+    def __init__(self, name: str, handler, in_queue: Queue, out_queue: Queue = None, workers: int = 1,
+                 upstream: 'PipelineStage' = None, need_stop: Event = None):
+        """
+        :param name: stage name for status and logs
+        :param handler: callable taking a task and returning the task for the next stage or None to drop it
+        :param in_queue: tasks of the stage
+        :param out_queue: tasks of the next stage, None for the last stage
+        :param workers: number of threads
+        :param upstream: previous stage, None for the first one
+        :param need_stop: stop event of the first stage
+        """
+        self.name = name
+        self.handler = handler
+        self.in_queue = in_queue
+        self.out_queue = out_queue
+        self.workers = workers
+        self.upstream = upstream
+        self.need_stop = need_stop if need_stop is not None else Event()
+        self.threads = []
+        self.lock = Lock()
+        self.running = 0
+        self.processed_count = 0
+
+    def start(self):
+        self.running = self.workers
+        self.threads = [Thread(name='%s %d' % (self.name.capitalize(), idx), target=self.routine)
+                        for idx in range(self.workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def finished(self) -> bool:
+        with self.lock:
+            return self.running == 0
+
+    def need_exit(self) -> bool:
+        if self.upstream is None:
+            return self.need_stop.is_set()
+        return self.upstream.finished() and self.in_queue.empty()
+
+    def routine(self):
+        try:
+            while not self.need_exit():
+                try:
+                    task = self.in_queue.get(timeout=self.GET_TIMEOUT)
+                except Empty:
+                    continue
+                try:
+                    result = self.handler(task)
+                    if result is not None and self.out_queue is not None:
+                        # Downstream runs until this stage is finished, so blocking here can't hang the stop
+                        self.out_queue.put(result)
+                    with self.lock:
+                        self.processed_count += 1
+                except Exception as ex:
+                    ERRORS.labels(self.name, type(ex).__name__).inc()
+                    print('Unexpected exception at PipelineStage(%s).routine: %s\n%s'
+                          % (self.name, ex, traceback.format_exc()))
+                finally:
+                    self.in_queue.task_done()
+        finally:
+            with self.lock:
+                self.running -= 1
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                'workers': self.workers,
+                'running': self.running,
+                'queue_depth': self.in_queue.qsize(),
+                'processed': self.processed_count,
+            }
+
+
+class PipelineWorker(FaceRecognizer):
+    """
+    Worker split into stages connected by bounded queues: download from the storage, recognition at AWS Rekognition
+    and write-back to VXG Server. Each stage has its own thread pool, so a slow dependency doesn't keep the others
+    idle and each one is driven at its own concurrency.
+    Events grouped by CameraBatcher are not expected, the dedup cache does the same for the pipeline.
+    An event failed at any stage is dropped from the pipeline and retried or given up the same way Worker does it.
+    """
+    def __init__(self, queue: Queue, aws_client: AWSClient, vxg_client: VXGClient, download_workers: int = 10,
+                 recognize_workers: int = 20, write_workers: int = 10, stage_queue_size: int = 20,
+                 dedup: DedupCache = None, local: LocalMatcher = None, loader: ImageLoader = None,
+                 journal: WorkJournal = None, aliases: FaceAliasMap = None, gate: QualityGate = None,
+                 multi_face: MultiFaceSearch = None, identities: IdentityStore = None, breakers: dict = None,
+                 retry: RetryQueue = None):
+        self.queue = queue
+        self.aws = aws_client
+        self.vxg = vxg_client
+        self.loader = loader if loader is not None else ImageLoader(vxg_client.http)
+        self.dedup = dedup
+        self.local = local
+        self.journal = journal
+        self.aliases = aliases
+        self.gate = gate
+        self.multi_face = multi_face
+        self.identities = identities
+        self.breakers = breakers or {}
+        self.retry = retry
+        self.need_stop = Event()
+        recognize_queue = Queue(maxsize=stage_queue_size)
+        write_queue = Queue(maxsize=stage_queue_size)
+        download = PipelineStage('download', self.download, queue, recognize_queue, download_workers,
+                                 need_stop=self.need_stop)
+        recognize = PipelineStage('recognize', self.recognize_task, recognize_queue, write_queue, recognize_workers,
+                                  upstream=download)
+        write = PipelineStage('write', self.write, write_queue, workers=write_workers, upstream=recognize)
+        self.stages = [download, recognize, write]
+
+    @property
+    def threads(self) -> list:
+        return [thread for stage in self.stages for thread in stage.threads]
+
+    def start(self):
+        for stage in self.stages:
+            stage.start()
+
+    def stop(self):
+        self.need_stop.set()
+
+    def download(self, item: dict) -> dict:
+        """
+        Download stage
+        :param item: task from the processing queue
+        :return: task for the recognition stage
+        """
+        observe_dequeued(item)
+        IN_FLIGHT.inc()
+        task = {'item': item, 'started': time(), 'image': None, 'faces': None, 'error': None, 'rejected': None}
+        try:
+            with STAGE_SECONDS.labels('download').time():
+                task['image'] = self.guard(DEPENDENCY_DOWNLOAD, self.loader.load, item['url'])
+        except ImageError as ex:
+            task['error'] = ex.reason
+        except Exception as ex:
+            self.fail_task(task, ex)
+            return None
+        return task
+
+    def recognize_task(self, task: dict) -> dict:
+        """
+        Recognition stage
+        :param task: task from the download stage
+        :return: task for the write stage
+        """
+        if task['error'] is not None:
+            return task
+        try:
+            camid = task['item'].get('camid')
+            image_key = image_hash(task['image']) if self.dedup is not None else None
+            faces = self.dedup.get(camid, image_key) if self.dedup is not None else None
+            if faces is None:
+                faces = self.recognize(task['image'])
+                if self.dedup is not None:
+                    self.dedup.put(camid, image_key, faces)
+        except FaceRejected as ex:
+            faces = None
+            task['rejected'] = ex.reason
+        except Exception as ex:
+            self.fail_task(task, ex)
+            return None
+        task['faces'] = faces
+        # Image isn't needed anymore, don't keep it at the write queue
+        task['image'] = None
+        return task
+
+    def write(self, task: dict):
+        """
+        Write-back stage
+        :param task: task from the recognition stage
+        """
+        item = task['item']
+        clear_processing = item.get('processing', True)
+        try:
+            if task['error'] is not None:
+                self.guard(DEPENDENCY_VXG, self.vxg.set_event_processed_error, item['id'], task['error'],
+                           clear_processing=clear_processing)
+                EVENTS.labels('error').inc()
+            elif task['rejected'] is not None:
+                self.guard(DEPENDENCY_VXG, self.vxg.set_event_rejected, item['id'], task['rejected'],
+                           clear_processing=clear_processing)
+                EVENTS.labels('rejected').inc()
+            else:
+                self.guard(DEPENDENCY_VXG, self.vxg.set_event_processed, item['id'], task['faces'],
+                           clear_processing=clear_processing)
+                if self.identities is not None:
+                    self.identities.record(self.aws.collection_id, item, task['faces'])
+                EVENTS.labels('face' if task['faces'] else 'no_face').inc()
+        except Exception as ex:
+            self.fail_task(task, ex)
+            return
+        if self.journal is not None:
+            self.journal.complete(item['id'])
+        IN_FLIGHT.dec()
+        STAGE_SECONDS.labels('total').observe(time() - task['started'])
+
+    def fail_task(self, task: dict, ex: Exception):
+        """
+        Drop the failed event from the pipeline, it's retried later or given up
+        :param task: task of the stage
+        :param ex: exception the stage failed with
+        """
+        IN_FLIGHT.dec()
+        STAGE_SECONDS.labels('total').observe(time() - task['started'])
+        self.fail(task['item'], ex)
+
+    def stats(self) -> dict:
+        return {stage.name: stage.stats() for stage in self.stages}
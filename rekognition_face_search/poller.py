@@ -1,25 +1,164 @@
+import json
+import os
+from random import randrange
 from threading import Event
-from time import sleep
+from time import sleep, time
 from queue import Queue, Full
 import traceback
 
+from .coordinator import Coordinator
+from .journal import WorkJournal
+from .metrics import ERRORS, STAGE_SECONDS
 from .vxg_client import VXGClient
 
 
+class PollCursor:
+    """
+    High-water mark of already polled events: time of the newest event and IDs of events having exactly that time.
+    Persisted to a file, so polling continues from the same point after restart.
+    """
+    def __init__(self, path: str = None):
+        self.path = path
+        self.time = None
+        self.ids = set()
+        if self.path and os.path.exists(self.path):
+            with open(self.path) as f:
+                state = json.load(f)
+            self.time = state['time']
+            self.ids = set(state['ids'])
+
+    def is_new(self, event: dict) -> bool:
+        """
+        :param event: event from VXG Server
+        :return: the event is newer than the cursor
+        """
+        return self.time is None or event['time'] > self.time or (event['time'] == self.time and
+                                                                   event['id'] not in self.ids)
+
+    def advance(self, event: dict):
+        """
+        Move the cursor to the event if it's newer
+        :param event: event from VXG Server
+        """
+        if self.time is None or event['time'] > self.time:
+            self.time = event['time']
+            self.ids = {event['id']}
+        elif event['time'] == self.time:
+            self.ids.add(event['id'])
+
+    def save(self):
+        if not self.path:
+            return
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'time': self.time, 'ids': sorted(self.ids)}, f)
+        os.replace(tmp_path, self.path)
+
+
+class AdaptivePollController:
+    """
+    Adjusts poll batch size and interval to the backlog at VXG Server and the processing queue fill level:
+    batch grows while the backlog is bigger than a batch and there's room at the queue, interval gets short while
+    events keep coming and backs off exponentially when idle.
+    """
+    QUEUE_HIGH_WATERMARK = 0.8
+
+    def __init__(self, min_batch: int = 20, max_batch: int = 100, min_interval: float = 0.1,
+                 max_interval: float = 5.0, base_interval: float = 0.5):
+        self.min_batch = min_batch
+        self.max_batch = max_batch
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.base_interval = base_interval
+
+        self.batch = min_batch
+        self.interval = base_interval
+        self.target_batch = min_batch
+        self.target_interval = base_interval
+        self.backlog = 0
+        self.queue_fill = 0.0
+
+    def update(self, backlog: int, got_events: bool, queue_size: int, queue_max_size: int):
+        """
+        Adjust values after the poll
+        :param backlog: number of events waiting at the server, including just polled ones
+        :param got_events: last poll returned some events
+        :param queue_size: current processing queue size
+        :param queue_max_size: processing queue capacity, 0 for unlimited queue
+        """
+        self.backlog = backlog
+        self.queue_fill = queue_size / queue_max_size if queue_max_size else 0.0
+        queue_free = queue_max_size - queue_size if queue_max_size else self.max_batch
+
+        if self.queue_fill >= self.QUEUE_HIGH_WATERMARK:
+            # Workers are the bottleneck, polling more often or more at once would only block at the queue
+            self.target_batch = self.min_batch
+            self.target_interval = self.base_interval
+        elif got_events:
+            self.target_batch = max(self.min_batch, min(self.max_batch, backlog, queue_free))
+            self.target_interval = self.min_interval
+        else:
+            self.target_batch = self.min_batch
+            self.target_interval = min(self.max_interval, max(self.interval, self.min_interval) * 2)
+
+        # Grow batch gradually to not overload the server with a single huge request, shrink immediately
+        if self.target_batch > self.batch:
+            self.batch = min(self.target_batch, self.batch * 2)
+        else:
+            self.batch = self.target_batch
+        self.interval = self.target_interval
+
+    def status(self) -> dict:
+        return {
+            'batch': self.batch,
+            'target_batch': self.target_batch,
+            'interval': self.interval,
+            'target_interval': self.target_interval,
+            'backlog': self.backlog,
+            'queue_fill': round(self.queue_fill, 3),
+        }
+
+
 class PollingImageSource:
     """
     Periodically polls VXG Server for images that are marked by cameras as having some face.
     Gets storage URL and event ID for that images and passes them to processing queue.
     Those events are marked with "processing" meta tag.
+
+    With `controller` given, batch size and poll interval are adjusted by it instead of fixed class constants.
+
+    With `cursor` given, polls incrementally: asks only for events newer than the cursor and moves the cursor further,
+    "processing" tag is optional then. Events left unprocessed (ie by a crash) are picked up by `backfill` on start.
+
+    With `journal` given, queued events are recorded there before they are tagged and replayed on start, so events
+    queued by a crashed process are not left with "processing" tag forever.
+
+    With `coordinator` given, only events leased by this instance are queued, so several instances can share the server.
     """
     MAX_EVENT_BATCH = 20
     POLL_INTERVAL = 0.5
 
-    def __init__(self, vxg_client: VXGClient, queue: Queue):
+    def __init__(self, vxg_client: VXGClient, queue: Queue, cursor: PollCursor = None, mark_processing: bool = True,
+                 controller: AdaptivePollController = None, journal: WorkJournal = None,
+                 coordinator: Coordinator = None):
         self.vxg_client = vxg_client
         self.queue = queue
+        self.cursor = cursor
+        self.mark_processing = mark_processing
+        self.controller = controller
+        self.journal = journal
+        self.coordinator = coordinator
+        self.last_total = 0
         self.need_stop = Event()
 
+    @property
+    def batch_size(self) -> int:
+        return self.controller.batch if self.controller else self.MAX_EVENT_BATCH
+
+    @property
+    def poll_interval(self) -> float:
+        return self.controller.interval if self.controller else self.POLL_INTERVAL
+
     def stop(self):
         self.need_stop.set()
 
@@ -27,49 +166,174 @@ class PollingImageSource:
         """
         Main routine
         """
-        timeout = self.POLL_INTERVAL
+        if self.journal is not None:
+            try:
+                self.replay()
+            except StopIteration:
+                return
+        if self.cursor is not None:
+            try:
+                self.backfill()
+            except StopIteration:
+                return
+        timeout = self.poll_interval
         while not self.need_stop.wait(timeout=timeout):
             try:
                 try:
                     more = self.poll_events()
                 except StopIteration:
                     break
-                timeout = 0 if more else self.POLL_INTERVAL
+                timeout = 0 if more else self.poll_interval
             except Exception as ex:
+                ERRORS.labels('poll', type(ex).__name__).inc()
                 print('Unexpected exception at PollingImageSource.routine: %s\n%s' % (ex, traceback.format_exc()))
                 sleep(1)
 
+    def backfill(self):
+        """
+        Queue all unprocessed events older than the cursor, then continue incrementally from the cursor.
+        On the first run the cursor is set to the time of the newest event on the server, so it doesn't depend on the
+        clock of this host. Events of that time are left to the incremental polling.
+        :raises StopIteration: when user asked us to stop
+        """
+        while self.cursor.time is None and not self.need_stop.is_set():
+            try:
+                latest = self.vxg_client.get_latest_event()
+            except Exception as ex:
+                print('Unexpected exception at PollingImageSource.backfill: %s\n%s' % (ex, traceback.format_exc()))
+                sleep(1)
+                continue
+            if latest is None:
+                # Nothing to backfill, all the events are new
+                return
+            self.cursor.time = latest['time']
+            self.cursor.save()
+        offset = 0
+        while not self.need_stop.is_set():
+            try:
+                events, total = self.vxg_client.get_unprocessed_events(limit=self.batch_size, offset=offset,
+                                                                       end=self.cursor.time)
+            except Exception as ex:
+                print('Unexpected exception at PollingImageSource.backfill: %s\n%s' % (ex, traceback.format_exc()))
+                sleep(1)
+                continue
+            self.put_events(events)
+            if len(events) < self.batch_size:
+                break
+            # Tagged events are excluded from the next page by the server itself
+            if not self.mark_processing:
+                offset += len(events)
+
     def poll_events(self) -> bool:
         """
         Single run of the main routine
         :raises StopIteration: when user asked us to stop
         :return: Is there more events at the server
         """
-        # TODO: first run should grab all unprocessed events too
-        # TODO: try to switch to remembering last event ID, not by relying to "processing" tag
-        events, more = self.get_events()
+        with STAGE_SECONDS.labels('poll').time():
+            events, total, more = self.get_events_and_total()
+        self.put_events(events)
+        if self.cursor is not None:
+            for event in events:
+                self.cursor.advance(event)
+        if self.cursor is not None and events:
+            self.cursor.save()
+        if self.controller is not None:
+            self.controller.update(total, bool(events), self.queue.qsize(), self.queue.maxsize)
+        return more
+
+    def replay(self):
+        """
+        Queue events left unprocessed by the previous run, they are tagged already
+        :raises StopIteration: when user asked us to stop
+        """
+        items = self.journal.recover()
+        if items:
+            print('Replaying %d unprocessed events from the journal' % len(items))
+        for item in items:
+            item['queued_at'] = time()
+            self.put_item(item)
+
+    def put_event(self, event: dict):
+        """
+        Pass the event to the processing queue
+        :param event: event from VXG Server
+        :raises StopIteration: when user asked us to stop
+        """
+        self.put_events([event])
+
+    def put_events(self, events: list):
+        """
+        Pass events to the processing queue
+        :param events: events from VXG Server
+        :raises StopIteration: when user asked us to stop
+        """
+        items = []
         for event in events:
             url = event.get('thumb', {}).get('url', None)
             if not url:
                 self.vxg_client.set_event_processed_error(event['id'], 'no_image')
-            else:
-                self.vxg_client.set_event_processing(event['id'])
-                while True:
-                    try:
-                        self.queue.put({
-                            'id': event['id'],
-                            'url': url,
-                        }, timeout=1)
-                        break
-                    except Full:
-                        if self.need_stop.is_set():
-                            raise StopIteration()
-        return more
+                continue
+            items.append({
+                'id': event['id'],
+                'url': url,
+                'camid': event.get('camid'),
+                'time': event.get('time'),
+                'processing': self.mark_processing,
+            })
+        if self.coordinator is not None and items:
+            claimed = set(self.coordinator.claim([item['id'] for item in items]))
+            items = [item for item in items if item['id'] in claimed]
+        # Journal goes first: an event tagged "processing" must be known to the journal
+        if self.journal is not None:
+            self.journal.enqueue(items)
+        for item in items:
+            if self.mark_processing:
+                self.vxg_client.set_event_processing(item['id'])
+            item['queued_at'] = time()
+            self.put_item(item)
+        if self.coordinator is not None and self.mark_processing:
+            self.coordinator.release([item['id'] for item in items])
+
+    def put_item(self, item: dict):
+        """
+        :param item: task for workers
+        :raises StopIteration: when user asked us to stop
+        """
+        while True:
+            try:
+                self.queue.put(item, timeout=1)
+                break
+            except Full:
+                if self.need_stop.is_set():
+                    raise StopIteration()
 
     def get_events(self) -> (list, bool):
         """
         Get batch of events from VXG Server
         :return: Batch of events and bool indicating is there more events at the server
         """
-        events, total = self.vxg_client.get_unprocessed_events(limit=self.MAX_EVENT_BATCH)
-        return events, total > self.MAX_EVENT_BATCH
+        events, _, more = self.get_events_and_total()
+        return events, more
+
+    def get_events_and_total(self) -> (list, int, bool):
+        """
+        Get batch of events from VXG Server
+        :return: Batch of events, total number of events waiting at the server and bool indicating is there more
+        """
+        batch_size = self.batch_size
+        if self.cursor is not None:
+            # Events seen at the cursor time are the first ones, skip them, so more than a batch of events having
+            # the same time doesn't make every poll return the same page
+            offset = len(self.cursor.ids) if self.cursor.time is not None else 0
+            page, total = self.vxg_client.get_events_since(self.cursor.time, limit=batch_size, offset=offset)
+            events = [event for event in page if self.cursor.is_new(event)]
+            # Nothing new means the whole batch is events we've already seen at the cursor time
+            return events, total, bool(events) and total > offset + len(page)
+        offset = 0
+        if self.coordinator is not None and self.coordinator.spread > 1 and self.last_total > batch_size:
+            # Other instances likely take the first batch, try a random one of the first few
+            offset = randrange(min(self.coordinator.spread, self.last_total // batch_size)) * batch_size
+        events, total = self.vxg_client.get_unprocessed_events(limit=batch_size, offset=offset)
+        self.last_total = total
+        return events, total, total > batch_size
@@ -0,0 +1,116 @@
+from io import BytesIO
+from threading import Lock
+
+try:
+    from PIL import Image, ImageFilter, ImageStat
+except ImportError:
+    Image = ImageFilter = ImageStat = None
+
+from .metrics import REJECTED
+
+# Laplacian, its variance over the face is a common sharpness measure. Offset keeps negative responses from clipping
+LAPLACIAN = (0, 1, 0, 1, -4, 1, 0, 1, 0)
+SHARPNESS_SIDE = 128  # Faces are measured at this size, so the measure doesn't depend on the image resolution
+
+
+class FaceRejected(Exception):
+    """
+    Face is not good enough to be indexed, `reason` is reported to VXG Server
+    """
+    def __init__(self, reason: str):
+        super(FaceRejected, self).__init__(reason)
+        self.reason = reason
+
+
+def face_sharpness(img, bounding_box: dict) -> float:
+    """
+    :param img: decoded image
+    :param bounding_box: face bounding box in AWS Rekognition format, ratios of the image size
+    :return: variance of the Laplacian over the face, the higher the sharper
+    """
+    width, height = img.size
+    left = max(0, int(bounding_box['Left'] * width))
+    top = max(0, int(bounding_box['Top'] * height))
+    right = min(width, int((bounding_box['Left'] + bounding_box['Width']) * width))
+    bottom = min(height, int((bounding_box['Top'] + bounding_box['Height']) * height))
+    if right - left < 3 or bottom - top < 3:
+        return 0.0
+    face = img.crop((left, top, right, bottom)).convert('L')
+    face.thumbnail((SHARPNESS_SIDE, SHARPNESS_SIDE))
+    edges = face.filter(ImageFilter.Kernel((3, 3), LAPLACIAN, scale=1, offset=128))
+    return ImageStat.Stat(edges).var[0]
+
+
+class QualityGate:
+    """
+    Decides whether a face that matched nothing is good enough to be indexed.
+    Local checks use the face AWS Rekognition has already located at search: its size in pixels and sharpness.
+    They need Pillow and are skipped without it. Then IndexFaces itself filters faces by `quality_filter` and
+    indexes at most `max_faces` of them.
+    """
+    def __init__(self, min_face_size: int = 0, min_sharpness: float = 0, quality_filter: str = 'AUTO',
+                 max_faces: int = None):
+        """
+        :param min_face_size: min face width and height in pixels, 0 disables the check
+        :param min_sharpness: min variance of the Laplacian over the face, 0 disables the check
+        :param quality_filter: IndexFaces QualityFilter: NONE, AUTO, LOW, MEDIUM or HIGH
+        :param max_faces: IndexFaces MaxFaces, None for no limit
+        """
+        self.min_face_size = min_face_size
+        self.min_sharpness = min_sharpness
+        self.quality_filter = quality_filter
+        self.max_faces = max_faces
+        # Configured checks silently passing every face would index the faces they are set up to keep out
+        self.local_checks = Image is not None and bool(min_face_size or min_sharpness)
+        if Image is None and (min_face_size or min_sharpness):
+            print('Pillow is not installed, face size and sharpness checks are disabled')
+        self.lock = Lock()
+        self.checked_count = 0
+        self.rejects = {}
+
+    def check(self, image: bytes, search_resp: dict):
+        """
+        Local checks before indexing
+        :param image: encoded image
+        :param search_resp: "search_faces_by_image" response
+        :raises FaceRejected: face is too small or blurry
+        """
+        with self.lock:
+            self.checked_count += 1
+        bounding_box = search_resp.get('SearchedFaceBoundingBox')
+        if bounding_box is None or not self.local_checks:
+            return
+        try:
+            with Image.open(BytesIO(image)) as img:
+                width, height = img.size
+                if self.min_face_size and min(bounding_box['Width'] * width,
+                                              bounding_box['Height'] * height) < self.min_face_size:
+                    self.reject('face_too_small')
+                if self.min_sharpness and face_sharpness(img, bounding_box) < self.min_sharpness:
+                    self.reject('face_blurry')
+        except (OSError, ValueError):
+            # AWS Rekognition has decoded it, so let it decide
+            pass
+
+    def check_indexed(self, index_resp: dict):
+        """
+        :param index_resp: "index_faces" response
+        :raises FaceRejected: IndexFaces quality filter rejected all the faces
+        """
+        if not index_resp['FaceRecords'] and index_resp.get('UnindexedFaces'):
+            reasons = sorted({reason for face in index_resp['UnindexedFaces'] for reason in face.get('Reasons', ())})
+            self.reject('quality_filter', ','.join(reasons))
+
+    def reject(self, reason: str, details: str = ''):
+        with self.lock:
+            self.rejects[reason] = self.rejects.get(reason, 0) + 1
+        REJECTED.labels(reason).inc()
+        raise FaceRejected('%s:%s' % (reason, details) if details else reason)
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                'local_checks': self.local_checks,
+                'checked': self.checked_count,
+                'rejected': dict(self.rejects),
+            }
@@ -0,0 +1,292 @@
+import heapq
+from itertools import count
+from queue import Full
+from random import uniform
+from threading import Condition, Event, Lock
+from time import monotonic, time
+import traceback
+
+from .image import ImageError
+from .metrics import BREAKER_OPEN, RETRIES
+
+DEPENDENCY_DOWNLOAD = 'download'
+DEPENDENCY_REKOGNITION = 'rekognition'
+DEPENDENCY_VXG = 'vxg'
+
+
+class DependencyError(Exception):
+    """
+    Call to an external dependency failed, `reason` is reported to VXG Server if the event is given up
+    """
+    def __init__(self, dependency: str, reason: str):
+        super(DependencyError, self).__init__(reason)
+        self.dependency = dependency
+        self.reason = reason
+
+
+class CircuitOpen(DependencyError):
+    """
+    The dependency is failing, the call is not made at all
+    """
+    def __init__(self, dependency: str, retry_in: float):
+        super(CircuitOpen, self).__init__(dependency, '%s_unavailable' % dependency)
+        self.retry_in = retry_in
+
+
+class CircuitBreaker:
+    """
+    Stops calling a dependency after `failure_threshold` consecutive failures, so workers don't spend their time
+    waiting for timeouts of a service that is down. After `reset_timeout` seconds a single probe call is let through:
+    success closes the circuit, failure opens it for another `reset_timeout`.
+    Exceptions of `ignore` types are results rather than failures, they count as success and are raised as is.
+    Thread safe.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, name: str, failure_threshold: int = 5, reset_timeout: float = 30, ignore: tuple = ()):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.ignore = ignore
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.lock = Lock()
+        self.calls_count = 0
+        self.failures_count = 0
+        self.rejected_count = 0
+        self.opened_count = 0
+
+    def call(self, func, *args, **kwargs):
+        """
+        Make a call unless the circuit is open
+        :raises CircuitOpen: the dependency is failing, the call is not made
+        :raises DependencyError: the call failed, the original exception is its cause
+        :return: result of the call
+        """
+        self.before_call()
+        try:
+            result = func(*args, **kwargs)
+        except self.ignore:
+            self.record(success=True)
+            raise
+        except Exception as ex:
+            self.record(success=False)
+            raise DependencyError(self.name, '%s_failed: %s' % (self.name, type(ex).__name__)) from ex
+        self.record(success=True)
+        return result
+
+    async def call_async(self, func, *args, **kwargs):
+        """
+        Same as `call` for coroutine functions
+        """
+        self.before_call()
+        try:
+            result = await func(*args, **kwargs)
+        except self.ignore:
+            self.record(success=True)
+            raise
+        except Exception as ex:
+            self.record(success=False)
+            raise DependencyError(self.name, '%s_failed: %s' % (self.name, type(ex).__name__)) from ex
+        self.record(success=True)
+        return result
+
+    def before_call(self):
+        """
+        :raises CircuitOpen: the call must not be made
+        """
+        with self.lock:
+            if self.state == self.CLOSED:
+                self.calls_count += 1
+                return
+            retry_in = self.opened_at + self.reset_timeout - monotonic()
+            if self.state == self.OPEN and retry_in <= 0:
+                # This one is the probe, the rest wait for its result
+                self.state = self.HALF_OPEN
+                self.calls_count += 1
+                return
+            self.rejected_count += 1
+        raise CircuitOpen(self.name, max(0.0, retry_in))
+
+    def record(self, success: bool):
+        with self.lock:
+            if success:
+                self.failures = 0
+                if self.state != self.CLOSED:
+                    self.state = self.CLOSED
+                    BREAKER_OPEN.labels(self.name).set(0)
+                    print('Circuit breaker "%s" is closed' % self.name)
+                return
+            self.failures += 1
+            self.failures_count += 1
+            if self.state == self.HALF_OPEN or (self.state == self.CLOSED and self.failures >= self.failure_threshold):
+                if self.state == self.CLOSED:
+                    self.opened_count += 1
+                    BREAKER_OPEN.labels(self.name).set(1)
+                    print('Circuit breaker "%s" is open after %d failures' % (self.name, self.failures))
+                self.state = self.OPEN
+                self.opened_at = monotonic()
+
+    def retry_in(self) -> float:
+        """
+        :return: seconds until calls are let through again, 0 if they are
+        """
+        with self.lock:
+            if self.state == self.CLOSED:
+                return 0.0
+            return max(0.0, self.opened_at + self.reset_timeout - monotonic())
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                'state': self.state,
+                'consecutive_failures': self.failures,
+                'calls': self.calls_count,
+                'failures': self.failures_count,
+                'rejected': self.rejected_count,
+                'opened': self.opened_count,
+            }
+
+
+def create_breakers(failure_threshold: int = 5, reset_timeout: float = 30) -> dict:
+    """
+    :param failure_threshold: consecutive failures opening the circuit
+    :param reset_timeout: seconds before a probe call is made to the failing dependency
+    :return: dependency name -> CircuitBreaker for image storage, AWS Rekognition and VXG Server
+    """
+    return {
+        # Too large image is the event problem, not the storage one
+        DEPENDENCY_DOWNLOAD: CircuitBreaker(DEPENDENCY_DOWNLOAD, failure_threshold, reset_timeout,
+                                            ignore=(ImageError,)),
+        DEPENDENCY_REKOGNITION: CircuitBreaker(DEPENDENCY_REKOGNITION, failure_threshold, reset_timeout),
+        DEPENDENCY_VXG: CircuitBreaker(DEPENDENCY_VXG, failure_threshold, reset_timeout),
+    }
+
+
+def failure_reason(ex: Exception) -> str:
+    """
+    :param ex: exception the event processing failed with
+    :return: short description for the error meta tag
+    """
+    if isinstance(ex, DependencyError):
+        return ex.reason
+    return 'failed: %s' % type(ex).__name__
+
+
+class RetryQueue:
+    """
+    Delay queue for events that failed to process. Failed events wait here for their turn with jittered exponential
+    backoff and are put back to the processing queue by a separate thread, so workers go on with other events instead
+    of sleeping on a failing dependency.
+    An event is retried at most `max_attempts - 1` times, calls not made because the circuit is open are not counted
+    as attempts, such events wait until the circuit lets calls through.
+    Events waiting here outlive restarts of the workers.
+    """
+    PUT_TIMEOUT = 0.1
+
+    def __init__(self, queue, max_attempts: int = 5, base_delay: float = 1, max_delay: float = 60,
+                 max_size: int = 1000):
+        """
+        :param queue: processing queue to put events back to
+        :param max_attempts: attempts to process an event before it's given up, 1 disables retries
+        :param base_delay: max delay before the first retry, seconds, doubled for every next one
+        :param max_delay: upper limit for the delay, seconds
+        :param max_size: max events waiting for retry, failed events are given up when it's full
+        """
+        self.queue = queue
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_size = max_size
+        self.heap = []  # (due monotonic time, sequence number, item)
+        self.sequence = count()
+        self.condition = Condition()
+        self.need_stop = Event()
+        self.scheduled_count = 0
+        self.requeued_count = 0
+        self.given_up_count = 0
+
+    def stop(self):
+        self.need_stop.set()
+        with self.condition:
+            self.condition.notify_all()
+
+    def schedule(self, item: dict, ex: Exception) -> bool:
+        """
+        Put the failed event aside to be retried later
+        :param item: task from the processing queue
+        :param ex: exception the processing failed with
+        :return: False if the event must be given up: attempts are exhausted or there's no room to wait
+        """
+        attempts = item.get('attempts', 0)
+        if isinstance(ex, CircuitOpen):
+            # Not tried at all, wait until the probe call shows whether the dependency is back
+            delay = ex.retry_in + uniform(0, self.base_delay)
+        else:
+            attempts += 1
+            if attempts >= self.max_attempts:
+                return self.give_up()
+            # Full jitter spreads the retries of events failed at once over time
+            delay = uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempts - 1)))
+        item = dict(item, attempts=attempts)
+        with self.condition:
+            if len(self.heap) >= self.max_size:
+                return self.give_up()
+            heapq.heappush(self.heap, (monotonic() + delay, next(self.sequence), item))
+            self.scheduled_count += 1
+            self.condition.notify()
+        RETRIES.labels(ex.dependency if isinstance(ex, DependencyError) else 'worker').inc()
+        return True
+
+    def give_up(self) -> bool:
+        with self.condition:
+            self.given_up_count += 1
+        return False
+
+    def pending(self) -> int:
+        with self.condition:
+            return len(self.heap)
+
+    def routine(self):
+        while not self.need_stop.is_set():
+            try:
+                self.step()
+            except Exception as ex:
+                print('Unexpected exception at RetryQueue.routine: %s\n%s' % (ex, traceback.format_exc()))
+                self.need_stop.wait(timeout=1)
+
+    def step(self):
+        """
+        Wait for the first event to be due and put it back to the processing queue
+        """
+        with self.condition:
+            if not self.heap:
+                self.condition.wait(timeout=1)
+                return
+            wait = self.heap[0][0] - monotonic()
+            if wait > 0:
+                self.condition.wait(timeout=wait)
+                return
+            due, sequence, item = heapq.heappop(self.heap)
+        try:
+            self.queue.put(dict(item, queued_at=time()), timeout=self.PUT_TIMEOUT)
+        except Full:
+            # Processing queue is busy with fresh events, try again a bit later
+            with self.condition:
+                heapq.heappush(self.heap, (monotonic() + self.PUT_TIMEOUT, sequence, item))
+            return
+        with self.condition:
+            self.requeued_count += 1
+
+    def stats(self) -> dict:
+        with self.condition:
+            return {
+                'pending': len(self.heap),
+                'max_attempts': self.max_attempts,
+                'scheduled': self.scheduled_count,
+                'requeued': self.requeued_count,
+                'given_up': self.given_up_count,
+            }
@@ -0,0 +1,177 @@
+from collections import deque
+from datetime import datetime, timezone
+from queue import Queue
+from threading import Condition, Event
+from time import monotonic, time
+import traceback
+
+
+def event_timestamp(item: dict) -> float:
+    """
+    :param item: task from the poller
+    :return: time of the event, the time it was queued if the event time is unknown
+    """
+    try:
+        # VXG Server reports UTC times without the zone
+        return datetime.fromisoformat(item['time'].rstrip('Z')).replace(tzinfo=timezone.utc).timestamp()
+    except (KeyError, AttributeError, ValueError):
+        return item.get('queued_at', time())
+
+
+class FairQueue(Queue):
+    """
+    Drop-in replacement of the processing Queue, sharing the workers between cameras instead of serving events in
+    the order they were polled. Every camera has its own lane, lanes are served by smooth weighted round-robin, so a
+    noisy camera doesn't delay events of the others. Priority cameras get higher `weights`, the rest have weight 1.
+    With `deadline` set, events older than that many seconds are either moved to the stale lane or dropped. The stale
+    lane takes its turn in the round-robin with `stale_weight`, so old events still get their share under steady load.
+    Dropped events are passed to `on_drop` by `routine` run in a separate thread, so getting events doesn't wait for
+    their release at VXG Server.
+    """
+    def __init__(self, maxsize: int = 0, weights: dict = None, deadline: float = 0, drop_expired: bool = False,
+                 on_drop=None, stale_weight: float = 1):
+        """
+        :param maxsize: max events at the queue, 0 for no limit
+        :param weights: camera ID -> share of the workers relative to the other cameras
+        :param deadline: age of the event in seconds, when it's not worth processing before fresh ones, 0 disables
+        :param drop_expired: drop events older than the deadline instead of processing them after the fresh ones
+        :param on_drop: callable taking a dropped item, it's expected to release the event at VXG Server
+        :param stale_weight: share of the workers given to events older than the deadline, relative to the cameras
+        """
+        self.weights = {str(camid): weight for camid, weight in (weights or {}).items()}
+        self.deadline = deadline
+        self.drop_expired = drop_expired
+        self.on_drop = on_drop
+        self.stale_weight = stale_weight
+        self.deferred_count = 0
+        self.dropped_count = 0
+        self.dropped = deque()  # Dropped items waiting for `on_drop`
+        self.drop_condition = Condition()
+        self.need_stop = Event()
+        super(FairQueue, self).__init__(maxsize)
+
+    # Queue internals, called with `self.mutex` held
+
+    def _init(self, maxsize: int):
+        self.lanes = {}  # camid -> deque of (event timestamp, item)
+        self.credits = {}  # camid -> current weight of smooth weighted round-robin
+        self.stale = deque()
+        self.stale_credit = 0
+        self.size = 0
+
+    def _qsize(self) -> int:
+        return self.size
+
+    def _put(self, item: dict):
+        camid = item.get('camid')
+        lane = self.lanes.get(camid)
+        if lane is None:
+            lane = self.lanes[camid] = deque()
+            self.credits[camid] = 0
+        lane.append((event_timestamp(item), item))
+        self.size += 1
+
+    def _get(self) -> dict:
+        if self.deadline and not self.drop_expired:
+            self._defer_expired(time())
+        camid = self._next_camera() if self.lanes else None
+        self.size -= 1
+        if camid is None:
+            return self.stale.popleft()
+        lane = self.lanes[camid]
+        timestamp, item = lane.popleft()
+        if not lane:
+            del self.lanes[camid]
+            del self.credits[camid]
+        return item
+
+    def _defer_expired(self, now: float):
+        """
+        Move events older than the deadline to the stale lane, so they take the turns of the stale lane only
+        """
+        for camid, lane in list(self.lanes.items()):
+            # Older events of the lane are ahead, so only the heads need to be checked
+            while lane and now - lane[0][0] > self.deadline:
+                self.stale.append(lane.popleft()[1])
+                self.deferred_count += 1
+            if not lane:
+                del self.lanes[camid]
+                del self.credits[camid]
+
+    def _next_camera(self):
+        """
+        Smooth weighted round-robin: every camera gains its weight, the richest one is served and pays the total.
+        The stale lane takes part while it has events
+        :return: camera ID, None for the stale lane
+        """
+        total = 0
+        best = None
+        for camid in self.lanes:
+            weight = self.weights.get(str(camid), 1)
+            self.credits[camid] += weight
+            total += weight
+            if best is None or self.credits[camid] > self.credits[best]:
+                best = camid
+        if not self.stale:
+            self.stale_credit = 0
+        elif self.stale_weight > 0:
+            self.stale_credit += self.stale_weight
+            total += self.stale_weight
+            if self.stale_credit > self.credits[best]:
+                self.stale_credit -= total
+                return None
+        self.credits[best] -= total
+        return best
+
+    def get(self, block: bool = True, timeout: float = None) -> dict:
+        """
+        Same as `Queue.get`, events dropped for being too old are not returned
+        """
+        until = monotonic() + timeout if timeout is not None else None
+        while True:
+            item = super(FairQueue, self).get(block, max(0.0, until - monotonic()) if until is not None else None)
+            if not (self.deadline and self.drop_expired and time() - event_timestamp(item) > self.deadline):
+                return item
+            with self.mutex:
+                self.dropped_count += 1
+            if self.on_drop is not None:
+                with self.drop_condition:
+                    self.dropped.append(item)
+                    self.drop_condition.notify()
+            self.task_done()
+
+    def stop(self):
+        self.need_stop.set()
+        with self.drop_condition:
+            self.drop_condition.notify_all()
+
+    def routine(self):
+        """
+        Pass dropped events to `on_drop`, events dropped after the stop are passed on the next run
+        """
+        while not self.need_stop.is_set():
+            self.step()
+
+    def step(self):
+        """
+        Wait for a dropped event and pass it to `on_drop`
+        """
+        with self.drop_condition:
+            if not self.dropped:
+                self.drop_condition.wait(timeout=1)
+                return
+            item = self.dropped.popleft()
+        try:
+            self.on_drop(item)
+        except Exception as ex:
+            print('Unexpected exception at FairQueue.on_drop: %s\n%s' % (ex, traceback.format_exc()))
+
+    def stats(self) -> dict:
+        with self.mutex:
+            return {
+                'cameras': {str(camid): len(lane) for camid, lane in self.lanes.items()},
+                'stale': len(self.stale),
+                'dropped_pending': len(self.dropped),
+                'deferred': self.deferred_count,
+                'dropped': self.dropped_count,
+            }
@@ -0,0 +1,459 @@
+import asyncio
+import base64
+from datetime import datetime, timezone
+import json
+import multiprocessing
+from random import Random
+from threading import Event, Lock, Thread
+from time import monotonic, time
+from uuid import uuid4
+
+from tornado.httpserver import HTTPServer
+from tornado.ioloop import IOLoop
+from tornado.testing import bind_unused_port
+from tornado.web import Application as TornadoApplication, RequestHandler
+
+from .vxg_client import VXGClient
+
+# Tags written last for an event, the event is done once one of them is set
+FINAL_TAGS = (VXGClient.TAG_HAS_FACE, VXGClient.TAG_NO_FACE, VXGClient.TAG_ERROR, VXGClient.TAG_REJECTED)
+
+
+class Fault:
+    """
+    Latency and failures of a stubbed dependency
+    """
+    def __init__(self, latency: float = 0, jitter: float = 0, error_rate: float = 0, throttle_rate: float = 0,
+                 max_rate: float = 0, seed: int = 0):
+        """
+        :param latency: seconds added to every request
+        :param jitter: random seconds up to that added on top of `latency`
+        :param error_rate: share of requests failing with an internal error
+        :param throttle_rate: share of requests throttled at random
+        :param max_rate: requests per second above that are throttled, 0 for no limit
+        :param seed: random seed, so runs are repeatable
+        """
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.max_rate = max_rate
+        self.random = Random(seed)
+        self.window_start = monotonic()
+        self.window_count = 0
+
+    def delay(self) -> float:
+        return self.latency + (self.random.uniform(0, self.jitter) if self.jitter else 0)
+
+    def outcome(self) -> str:
+        """
+        Decide the fate of a request, called at the loop thread only
+        :return: "ok", "error" or "throttle"
+        """
+        now = monotonic()
+        if now - self.window_start >= 1:
+            self.window_start = now
+            self.window_count = 0
+        self.window_count += 1
+        if self.max_rate and self.window_count > self.max_rate:
+            return 'throttle'
+        roll = self.random.random()
+        if roll < self.error_rate:
+            return 'error'
+        if roll < self.error_rate + self.throttle_rate:
+            return 'throttle'
+        return 'ok'
+
+
+class StubVXGServer:
+    """
+    In-memory VXG Server: events API, event meta API and the storage with thumbnails.
+    Events are generated at `rate` per second (all at once if 0) from `cameras` cameras, `face_share` of them show
+    one of `people` persons, the rest show nobody. The time every event got its final tag is recorded.
+    """
+    def __init__(self, events: int = 1000, rate: float = 0, cameras: int = 10, people: int = 50,
+                 face_share: float = 0.8, image_size: int = 50 * 1024, fault: Fault = None,
+                 storage_fault: Fault = None, seed: int = 0):
+        self.events_count = events
+        self.rate = rate
+        self.cameras = cameras
+        self.people = people
+        self.face_share = face_share
+        self.image_size = image_size
+        self.fault = fault or Fault()
+        self.storage_fault = storage_fault or Fault()
+        self.random = Random(seed)
+        self.lock = Lock()
+        self.events = {}  # id -> event
+        self.metas = {}  # id -> {tag: data}
+        self.created = {}  # id -> time the event appeared
+        self.done = {}  # id -> time the event got its final tag
+        self.requests_count = 0
+        self.failed_count = 0
+        self.uri = None
+
+    def handlers(self) -> list:
+        return [
+            (r'/api/v2/storage/events/', StubEventsHandler, {'stub': self}),
+            (r'/api/v2/storage/events/(\d+)/', StubEventHandler, {'stub': self}),
+            (r'/api/v2/storage/events/(\d+)/meta/', StubEventMetasHandler, {'stub': self}),
+            (r'/api/v2/storage/events/(\d+)/meta/([^/]+)/', StubEventMetaHandler, {'stub': self}),
+            (r'/storage/(\d+)\.jpg', StubThumbHandler, {'stub': self}),
+        ]
+
+    def image(self, event_id: int) -> bytes:
+        person = self.events[event_id]['person']
+        header = ('person=%s;' % person).encode()
+        return header + b'\0' * max(0, self.image_size - len(header))
+
+    def add_event(self, event_id: int):
+        person = self.random.randrange(self.people) if self.random.random() < self.face_share else ''
+        now = time()
+        with self.lock:
+            self.events[event_id] = {
+                'id': event_id,
+                'camid': self.random.randrange(self.cameras),
+                'time': datetime.fromtimestamp(now, timezone.utc).replace(tzinfo=None).isoformat(),
+                'thumb': {'url': '%s/storage/%d.jpg' % (self.uri, event_id)},
+                'person': person,
+            }
+            self.metas[event_id] = {}
+            self.created[event_id] = now
+
+    async def feed(self):
+        """
+        Generate the events at the configured rate
+        """
+        started = monotonic()
+        for event_id in range(1, self.events_count + 1):
+            if self.rate:
+                wait = started + (event_id - 1) / self.rate - monotonic()
+                if wait > 0:
+                    await asyncio.sleep(wait)
+            self.add_event(event_id)
+
+    def list_events(self, args: dict) -> dict:
+        exclude = set(args['meta_not'].split(',')) if args.get('meta_not') else set()
+        with self.lock:
+            events = [event for event in self.events.values()
+                      if not exclude.intersection(self.metas[event['id']])
+                      and (not args.get('start') or event['time'] >= args['start'])
+                      and (not args.get('end') or event['time'] < args['end'])]
+        events.sort(key=lambda event: (event['time'], event['id']), reverse=args.get('order_by') == '-time')
+        offset = int(args.get('offset', 0))
+        limit = int(args.get('limit', 20))
+        return {
+            'meta': {'total_count': len(events)},
+            'objects': [dict(self.public(event), meta=dict(self.metas[event['id']]))
+                        if args.get('include_meta') == 'true' else self.public(event)
+                        for event in events[offset:offset + limit]],
+        }
+
+    @staticmethod
+    def public(event: dict) -> dict:
+        return {key: value for key, value in event.items() if key != 'person'}
+
+    def set_meta(self, event_id: int, tag: str, data: str):
+        with self.lock:
+            self.metas[event_id][tag] = data
+            if tag in FINAL_TAGS and event_id not in self.done:
+                self.done[event_id] = time()
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                'created': len(self.created),
+                'done': len(self.done),
+                'requests': self.requests_count,
+                'failed': self.failed_count,
+            }
+
+
+class StubHandler(RequestHandler):
+    def initialize(self, stub):
+        self.stub = stub
+
+    async def faulty(self, fault: Fault) -> bool:
+        """
+        Apply latency and failures of the stub
+        :return: whether the request is to be served
+        """
+        delay = fault.delay()
+        if delay:
+            await asyncio.sleep(delay)
+        outcome = fault.outcome()
+        with self.stub.lock:
+            self.stub.requests_count += 1
+            if outcome != 'ok':
+                self.stub.failed_count += 1
+        if outcome == 'ok':
+            return True
+        self.set_status(429 if outcome == 'throttle' else 500)
+        self.finish()
+        return False
+
+    def args(self) -> dict:
+        return {key: self.get_argument(key) for key in self.request.arguments}
+
+
+class StubEventsHandler(StubHandler):
+    async def get(self):
+        if await self.faulty(self.stub.fault):
+            self.write(self.stub.list_events(self.args()))
+
+
+class StubEventHandler(StubHandler):
+    async def get(self, event_id: str):
+        if not await self.faulty(self.stub.fault):
+            return
+        event_id = int(event_id)
+        if event_id not in self.stub.events:
+            self.set_status(404)
+            return
+        with self.stub.lock:
+            meta = dict(self.stub.metas[event_id])
+        self.write(dict(self.stub.public(self.stub.events[event_id]), meta=meta))
+
+
+class StubEventMetasHandler(StubHandler):
+    async def post(self, event_id: str):
+        if not await self.faulty(self.stub.fault):
+            return
+        body = json.loads(self.request.body)
+        self.stub.set_meta(int(event_id), body['tag'], body.get('data', ''))
+        self.set_status(201)
+        self.write(body)
+
+
+class StubEventMetaHandler(StubHandler):
+    async def get(self, event_id: str, tag: str):
+        if not await self.faulty(self.stub.fault):
+            return
+        with self.stub.lock:
+            data = self.stub.metas.get(int(event_id), {}).get(tag)
+        if data is None:
+            self.set_status(404)
+            return
+        self.write({'tag': tag, 'data': data})
+
+    async def delete(self, event_id: str, tag: str):
+        if not await self.faulty(self.stub.fault):
+            return
+        with self.stub.lock:
+            self.stub.metas.get(int(event_id), {}).pop(tag, None)
+        self.set_status(204)
+
+
+class StubThumbHandler(StubHandler):
+    async def get(self, event_id: str):
+        if await self.faulty(self.stub.storage_fault):
+            self.set_header('Content-Type', 'image/jpeg')
+            self.write(self.stub.image(int(event_id)))
+
+
+class StubRekognition:
+    """
+    In-memory AWS Rekognition speaking its JSON protocol, so the real boto3 client is used against it.
+    Images made by StubVXGServer name the person they show, the first image of a person is indexed as a new face and
+    the following ones match it.
+    """
+    BOX = {'Width': 0.2, 'Height': 0.3, 'Left': 0.4, 'Top': 0.3}
+
+    def __init__(self, fault: Fault = None):
+        self.fault = fault or Fault()
+        self.faces = {}  # person -> FaceId
+        self.calls = {}  # operation -> count
+        self.throttled_count = 0
+        self.uri = None
+
+    def handlers(self) -> list:
+        return [(r'/', StubRekognitionHandler, {'stub': self})]
+
+    @staticmethod
+    def person(body: dict) -> str:
+        image = base64.b64decode(body['Image']['Bytes'])
+        return image.split(b';', 1)[0].decode(errors='replace').partition('=')[2]
+
+    def face(self, face_id: str) -> dict:
+        return {'FaceId': face_id, 'BoundingBox': self.BOX, 'ImageId': str(uuid4()), 'Confidence': 99.9}
+
+    def call(self, operation: str, body: dict) -> dict:
+        self.calls[operation] = self.calls.get(operation, 0) + 1
+        if operation == 'CreateCollection':
+            return {'StatusCode': 200, 'CollectionArn': 'stub', 'FaceModelVersion': '4.0'}
+        if operation == 'SearchFacesByImage':
+            person = self.person(body)
+            face_id = self.faces.get(person) if person else None
+            return {'SearchedFaceBoundingBox': self.BOX, 'SearchedFaceConfidence': 99.9,
+                    'FaceMatches': [{'Similarity': 99.0, 'Face': self.face(face_id)}] if face_id else []}
+        if operation == 'IndexFaces':
+            person = self.person(body)
+            if not person:
+                return {'FaceRecords': [], 'UnindexedFaces': []}
+            face_id = self.faces.setdefault(person, str(uuid4()))
+            return {'FaceRecords': [{'Face': self.face(face_id), 'FaceDetail': {'BoundingBox': self.BOX,
+                                                                               'Confidence': 99.9}}]}
+        if operation == 'DetectFaces':
+            person = self.person(body)
+            return {'FaceDetails': [{'BoundingBox': self.BOX, 'Confidence': 99.9}] if person else []}
+        if operation == 'ListFaces':
+            return {'Faces': [self.face(face_id) for face_id in self.faces.values()]}
+        if operation == 'SearchFaces':
+            return {'SearchedFaceId': body['FaceId'], 'FaceMatches': []}
+        if operation == 'DeleteFaces':
+            return {'DeletedFaces': body['FaceIds']}
+        raise KeyError(operation)
+
+    def stats(self) -> dict:
+        return {
+            'calls': dict(self.calls),
+            'throttled': self.throttled_count,
+            'faces': len(self.faces),
+        }
+
+
+class StubRekognitionHandler(StubHandler):
+    def error(self, status: int, code: str, message: str):
+        self.set_status(status)
+        self.set_header('Content-Type', 'application/x-amz-json-1.1')
+        self.write(json.dumps({'__type': code, 'message': message}))
+
+    async def post(self):
+        delay = self.stub.fault.delay()
+        if delay:
+            await asyncio.sleep(delay)
+        operation = self.request.headers.get('X-Amz-Target', '').rpartition('.')[2]
+        outcome = self.stub.fault.outcome()
+        if outcome == 'throttle':
+            self.stub.throttled_count += 1
+            self.error(400, 'ThrottlingException', 'Rate exceeded')
+            return
+        if outcome == 'error':
+            self.error(500, 'InternalServerError', 'Stubbed failure')
+            return
+        try:
+            resp = self.stub.call(operation, json.loads(self.request.body or b'{}'))
+        except KeyError:
+            self.error(400, 'InvalidParameterException', 'Operation %s is not stubbed' % operation)
+            return
+        self.set_header('Content-Type', 'application/x-amz-json-1.1')
+        self.write(json.dumps(resp))
+
+
+class StubServers:
+    """
+    Runs the stubs at their own event loop thread on unused local ports
+    """
+    def __init__(self, vxg: StubVXGServer, rekognition: StubRekognition):
+        self.vxg = vxg
+        self.rekognition = rekognition
+        self.loop = None
+        self.thread = None
+        self.started = Event()
+
+    def start(self):
+        self.thread = Thread(name='Stubs', target=self.routine, daemon=True)
+        self.thread.start()
+        self.started.wait()
+
+    def routine(self):
+        asyncio.set_event_loop(asyncio.new_event_loop())
+        self.loop = IOLoop.current()
+        for stub in (self.vxg, self.rekognition):
+            sock, port = bind_unused_port()
+            server = HTTPServer(TornadoApplication(stub.handlers()))
+            server.add_sockets([sock])
+            stub.uri = 'http://127.0.0.1:%d' % port
+        self.loop.add_callback(self.started.set)
+        self.loop.start()
+
+    def feed(self):
+        """
+        Start generating VXG Server events
+        """
+        self.loop.add_callback(self.vxg.feed)
+
+    def stop(self):
+        if self.loop is not None:
+            self.loop.add_callback(self.loop.stop)
+        if self.thread is not None:
+            self.thread.join(timeout=5)
+
+
+def stub_process_main(vxg_options: dict, rekognition_options: dict, conn):
+    """
+    Entry point of the stubs process, serves commands of StubProcess until "stop"
+    """
+    vxg = StubVXGServer(**dict(vxg_options, fault=Fault(**vxg_options.get('fault', {})),
+                               storage_fault=Fault(**vxg_options.get('storage_fault', {}))))
+    rekognition = StubRekognition(fault=Fault(**rekognition_options.get('fault', {})))
+    servers = StubServers(vxg, rekognition)
+    servers.start()
+    conn.send((vxg.uri, rekognition.uri))
+    while True:
+        command = conn.recv()
+        if command == 'feed':
+            servers.feed()
+        elif command == 'stats':
+            conn.send({'vxg': vxg.stats(), 'rekognition': rekognition.stats()})
+        elif command == 'times':
+            with vxg.lock:
+                conn.send((dict(vxg.created), dict(vxg.done)))
+        elif command == 'stop':
+            servers.stop()
+            conn.send(None)
+            return
+
+
+class StubProcess:
+    """
+    Runs the stubs at a process of their own, so their CPU time and memory are not counted as the application ones
+    """
+    def __init__(self, vxg_options: dict, rekognition_options: dict):
+        """
+        :param vxg_options: StubVXGServer arguments, `fault` and `storage_fault` are given as Fault arguments
+        :param rekognition_options: StubRekognition arguments, `fault` is given as Fault arguments
+        """
+        self.vxg_options = vxg_options
+        self.rekognition_options = rekognition_options
+        self.process = None
+        self.conn = None
+        self.vxg_uri = None
+        self.rekognition_uri = None
+
+    def start(self):
+        context = multiprocessing.get_context('spawn')
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(name='Stubs', target=stub_process_main,
+                                       args=(self.vxg_options, self.rekognition_options, child_conn), daemon=True)
+        self.process.start()
+        self.vxg_uri, self.rekognition_uri = self.conn.recv()
+
+    def request(self, command: str):
+        self.conn.send(command)
+        return self.conn.recv()
+
+    def feed(self):
+        """
+        Start generating VXG Server events
+        """
+        self.conn.send('feed')
+
+    def stats(self) -> dict:
+        return self.request('stats')
+
+    def times(self) -> tuple:
+        """
+        :return: event ID -> time it appeared, event ID -> time it got its final tag
+        """
+        return self.request('times')
+
+    def stop(self):
+        if self.process is None:
+            return
+        try:
+            self.request('stop')
+        except (EOFError, OSError):
+            pass
+        self.process.join(timeout=5)
+        self.process = None
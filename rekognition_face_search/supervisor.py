@@ -0,0 +1,241 @@
+import multiprocessing
+import os
+from queue import Queue, Empty, Full
+import signal
+from threading import Event, Thread
+from time import monotonic, time
+import traceback
+
+from .aws_client import AWSClient
+from .dedup import DedupCache
+from .hygiene import FaceAliasMap
+from .http_pool import HTTPPool
+from .identity_store import IdentityStore
+from .image import ImageLoader
+from .journal import WorkJournal
+from .metrics import EVENTS, REGISTRY
+from .multi_face import MultiFaceSearch, MultiFaceUnavailable
+from .quality import QualityGate
+from .resilience import RetryQueue, create_breakers
+from .throttle import RateLimiter
+from .vxg_client import VXGClient
+from .worker import Worker
+
+STATS_INTERVAL = 1
+ALIASES_RELOAD_INTERVAL = 10  # Seconds between checks of the aliases file saved by the main process
+
+
+def process_main(index: int, config: dict, queue, stats_queue, need_stop):
+    """
+    Entry point of a worker process: runs Worker threads with its own clients on the shared queue
+    :param index: process number
+    :param config: settings made by `Application.worker_process_config`
+    :param queue: events from the supervisor
+    :param stats_queue: process stats go there
+    :param need_stop: stop event set by the supervisor
+    """
+    # Ctrl+C is handled by the supervisor, it stops us gracefully
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    http = HTTPPool(pool_size=config['http_pool_size'], pool_hosts=config['http_pool_hosts'],
+                    keep_alive=config['http_keep_alive'], block=config['http_pool_block'])
+    limiters = {api: RateLimiter(api, rate=rate, max_concurrency=config['aws_concurrency'],
+                                 retries=config['aws_retries'])
+                for api, rate in config['aws_rates'].items()}
+    loader = ImageLoader(http, **config['image'])
+    dedup = DedupCache(**config['dedup']) if config['dedup'] else None
+    gate = QualityGate(**config['gate'])
+    journal = WorkJournal(config['journal_path']) if config['journal_path'] else None
+    identities = IdentityStore(config['identity_store_path']) if config['identity_store_path'] else None
+    breakers = create_breakers(**config['breakers']) if config['breakers'] else {}
+    # Merges are made by the collection maintainer of the main process, they're taken from the file it saves.
+    # Faces reported here are passed to the main process, so the maintainer doesn't take them for stale ones
+    aliases = FaceAliasMap(config['aliases']['path']) if config['aliases'] else None
+    # Failed events are retried by the same process, the ones still waiting on stop are replayed by the journal
+    retry = RetryQueue(queue, **config['retry'])
+    retry_thread = Thread(name='Retry %d' % index, target=retry.routine)
+    retry_thread.start()
+    # boto3 clients are thread safe, so the workers and the multi-face search of the process share a single one
+    aws = AWSClient(collection_id=config['collection'], access_key=config['access_key'],
+                    secret_key=config['secret_key'], threshold=config['threshold'], limiters=limiters,
+                    endpoint_url=config['endpoint_url'], max_pool_connections=config['aws_pool_size'])
+    multi_face = None
+    multi_face_error = None
+    if config['multi_face']:
+        try:
+            multi_face = MultiFaceSearch(aws, **config['multi_face'])
+        except MultiFaceUnavailable as ex:
+            print('Multi-face search is disabled at worker process %d: %s' % (index, ex))
+            multi_face_error = str(ex)
+    workers = [
+        Worker(queue, aws,
+               VXGClient(server_uri=config['server_uri'], token=config['token'], http=http),
+               http=http, dedup=dedup, loader=loader, journal=journal, gate=gate, multi_face=multi_face,
+               aliases=aliases, breakers=breakers, retry=retry, identities=identities)
+        for _ in range(config['workers'])
+    ]
+    threads = [Thread(name='Worker %d.%d' % (index, idx), target=worker.routine) for idx, worker in enumerate(workers)]
+    for thread in threads:
+        thread.start()
+
+    reported_at = time()
+
+    def report():
+        nonlocal reported_at
+        now = time()
+        seen = aliases.seen_since(reported_at) if aliases is not None else {}
+        reported_at = now
+        stats_queue.put((index, {
+            'pid': os.getpid(),
+            'workers': len(workers),
+            'events': {labels[0]: child.get() for labels, child in list(EVENTS.children.items())},
+            'aws_limits': {api: limiter.stats() for api, limiter in limiters.items()},
+            'dedup': dedup.stats() if dedup else None,
+            'quality_gate': gate.stats(),
+            'multi_face': multi_face.stats() if multi_face
+            else {'error': multi_face_error} if multi_face_error else None,
+            'breakers': {name: breaker.stats() for name, breaker in breakers.items()},
+            'retry': retry.stats(),
+            'aliases': aliases.stats() if aliases is not None else None,
+            'metrics': REGISTRY.snapshot(),
+            'seen_faces': seen,
+        }))
+
+    reloaded_at = monotonic()
+    while not need_stop.wait(timeout=STATS_INTERVAL):
+        report()
+        if aliases is not None and monotonic() - reloaded_at >= ALIASES_RELOAD_INTERVAL:
+            reloaded_at = monotonic()
+            try:
+                aliases.reload_aliases()
+            except (OSError, ValueError) as ex:
+                print('Failed to reload face aliases at worker process %d: %s' % (index, ex))
+    for worker in workers:
+        worker.stop()
+    retry.stop()
+    for thread in threads + [retry_thread]:
+        thread.join(timeout=config['grace_stop_timeout'])
+    report()
+    if journal is not None:
+        journal.close()
+    if identities is not None:
+        identities.close()
+    if multi_face is not None:
+        multi_face.close()
+    http.close()
+
+
+class ProcessSupervisor:
+    """
+    Runs Worker threads at several processes, so CPU work of the workers isn't limited by a single core.
+    Single poller of the main process keeps feeding the local queue, the supervisor forwards those events to a
+    multiprocessing queue shared by the worker processes, so every event is taken by exactly one process.
+    Processes report their stats back, they're aggregated at /status/ of the main process, and their metrics are
+    merged into /metrics of the main process.
+    """
+    FORWARD_TIMEOUT = 0.1
+
+    def __init__(self, queue: Queue, processes: int, config: dict, queue_size: int = 20, aliases: FaceAliasMap = None):
+        """
+        :param queue: processing queue of the main process
+        :param processes: number of worker processes
+        :param config: worker process settings, see `process_main`
+        :param queue_size: max events waiting at the multiprocessing queue
+        :param aliases: face aliases of the collection maintainer, faces reported by the processes are recorded there
+        """
+        self.aliases = aliases
+        # Spawn, because forking a process running threads could copy locks held by other threads
+        context = multiprocessing.get_context('spawn')
+        self.queue = queue
+        self.process_queue = context.JoinableQueue(maxsize=queue_size)
+        self.stats_queue = context.Queue()
+        self.process_need_stop = context.Event()
+        self.processes = [context.Process(name='Worker process %d' % idx, target=process_main, daemon=True,
+                                          args=(idx, config, self.process_queue, self.stats_queue,
+                                                self.process_need_stop))
+                          for idx in range(processes)]
+        self.process_stats = {}
+        self.forwarded_count = 0
+        self.need_stop = Event()
+        self.forward_thread = Thread(name='Supervisor forward', target=self.forward)
+        self.stats_thread = Thread(name='Supervisor stats', target=self.collect_stats)
+
+    def start(self):
+        for process in self.processes:
+            process.start()
+        self.forward_thread.start()
+        self.stats_thread.start()
+
+    def stop(self):
+        self.need_stop.set()
+        self.process_need_stop.set()
+
+    def join(self, timeout: float):
+        """
+        Wait for the processes to finish, kill them if they don't
+        :param timeout: max time to wait for a single process
+        """
+        self.forward_thread.join(timeout=timeout)
+        started = monotonic()
+        for process in self.processes:
+            process.join(timeout=max(0.0, timeout - (monotonic() - started)))
+            if process.is_alive():
+                print('Worker process %s is not stopped in time, terminating' % process.pid)
+                process.terminate()
+        # Events left at the queue are lost anyway, don't let them block our exit
+        self.process_queue.cancel_join_thread()
+        self.stats_thread.join(timeout=timeout)
+        for idx in range(len(self.processes)):
+            REGISTRY.retire_remote(self.metrics_source(idx))
+
+    @staticmethod
+    def metrics_source(index: int) -> str:
+        return 'worker process %d' % index
+
+    def forward(self):
+        """
+        Move events from the local queue to the worker processes
+        """
+        while not self.need_stop.is_set():
+            try:
+                item = self.queue.get(timeout=self.FORWARD_TIMEOUT)
+            except Empty:
+                continue
+            try:
+                while True:
+                    try:
+                        self.process_queue.put(item, timeout=self.FORWARD_TIMEOUT)
+                        self.forwarded_count += 1
+                        break
+                    except Full:
+                        if self.need_stop.is_set():
+                            break
+            except Exception as ex:
+                print('Unexpected exception at ProcessSupervisor.forward: %s\n%s' % (ex, traceback.format_exc()))
+            finally:
+                self.queue.task_done()
+
+    def collect_stats(self):
+        while not self.need_stop.is_set() or any(process.is_alive() for process in self.processes):
+            try:
+                index, stats = self.stats_queue.get(timeout=STATS_INTERVAL)
+            except Empty:
+                continue
+            REGISTRY.merge_remote(self.metrics_source(index), stats.pop('metrics'))
+            seen = stats.pop('seen_faces', {})
+            if self.aliases is not None:
+                for face_id, last_seen in seen.items():
+                    self.aliases.touch(face_id, now=last_seen)
+            self.process_stats[index] = stats
+
+    def stats(self) -> dict:
+        events = {}
+        for stats in list(self.process_stats.values()):
+            for result, count in stats['events'].items():
+                events[result] = events.get(result, 0) + count
+        return {
+            'processes': len(self.processes),
+            'alive': sum(process.is_alive() for process in self.processes),
+            'forwarded': self.forwarded_count,
+            'events': events,
+            'per_process': dict(self.process_stats),
+        }
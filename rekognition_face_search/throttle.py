@@ -0,0 +1,148 @@
+from random import uniform
+from threading import Condition, Lock
+from time import monotonic, sleep
+
+from botocore.exceptions import ClientError, ConnectionError, HTTPClientError
+
+from .metrics import AWS_THROTTLES
+
+THROTTLING_ERROR_CODES = ('ThrottlingException', 'ProvisionedThroughputExceededException')
+
+
+def is_throttling_error(ex: Exception) -> bool:
+    return isinstance(ex, ClientError) and ex.response.get('Error', {}).get('Code') in THROTTLING_ERROR_CODES
+
+
+def is_transient_error(ex: Exception) -> bool:
+    """
+    :return: True for errors botocore retries itself: server side errors, connection errors and timeouts
+    """
+    if isinstance(ex, (ConnectionError, HTTPClientError)):
+        return True
+    return isinstance(ex, ClientError) and ex.response.get('ResponseMetadata', {}).get('HTTPStatusCode', 0) >= 500
+
+
+class TokenBucket:
+    """
+    Classic token bucket: allows `rate` calls per second on average with bursts up to `burst` calls.
+    Thread safe.
+    """
+    def __init__(self, rate: float, burst: float = None):
+        self.rate = rate
+        self.burst = burst if burst is not None else max(1.0, rate)
+        self.tokens = self.burst
+        self.updated = monotonic()
+        self.lock = Lock()
+
+    def acquire(self):
+        """
+        Take a token, wait for it if the bucket is empty
+        """
+        while True:
+            with self.lock:
+                now = monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            sleep(wait)
+
+
+class AIMDLimiter:
+    """
+    Concurrency limit with additive increase on success and multiplicative decrease on throttling, like TCP
+    congestion control. Keeps the number of calls in flight right at what the service accepts.
+    Thread safe.
+    """
+    def __init__(self, initial: float, min_limit: float = 1, max_limit: float = None, increase: float = 1,
+                 decrease: float = 0.5):
+        self.limit = initial
+        self.min_limit = min_limit
+        self.max_limit = max_limit if max_limit is not None else initial
+        self.increase = increase
+        self.decrease = decrease
+        self.in_flight = 0
+        self.condition = Condition()
+
+    def acquire(self):
+        with self.condition:
+            while self.in_flight >= int(self.limit):
+                self.condition.wait()
+            self.in_flight += 1
+
+    def release(self, throttled: bool = False):
+        with self.condition:
+            self.in_flight -= 1
+            if throttled:
+                self.limit = max(self.min_limit, self.limit * self.decrease)
+            else:
+                # Grows by `increase` per full window of successful calls
+                self.limit = min(self.max_limit, self.limit + self.increase / max(1.0, self.limit))
+            self.condition.notify_all()
+
+
+class RateLimiter:
+    """
+    Client-side limiter for a single AWS API: token bucket for the rate, AIMD for the concurrency and jittered
+    exponential backoff retries on throttling errors. Transient errors are retried the same way, since botocore
+    retries are disabled for the clients using limiters, they don't lower the concurrency limit.
+    Shared by all the clients of the process.
+    """
+    def __init__(self, name: str, rate: float, max_concurrency: int, burst: float = None, retries: int = 5,
+                 base_delay: float = 0.1, max_delay: float = 5):
+        self.name = name
+        self.bucket = TokenBucket(rate, burst)
+        self.concurrency = AIMDLimiter(max_concurrency)
+        self.retries = retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.lock = Lock()
+        self.calls_count = 0
+        self.throttles_count = 0
+        self.errors_count = 0
+
+    def call(self, func, *args, **kwargs):
+        """
+        Make a call within the limits
+        :raises ClientError: throttling or transient error after all the retries or any other error
+        :return: result of the call
+        """
+        attempt = 0
+        while True:
+            self.bucket.acquire()
+            self.concurrency.acquire()
+            try:
+                result = func(*args, **kwargs)
+            except Exception as ex:
+                throttled = is_throttling_error(ex)
+                transient = not throttled and is_transient_error(ex)
+                self.concurrency.release(throttled=throttled)
+                with self.lock:
+                    self.calls_count += 1
+                    self.throttles_count += throttled
+                    self.errors_count += transient
+                if throttled:
+                    AWS_THROTTLES.labels(self.name).inc()
+                if not (throttled or transient) or attempt >= self.retries:
+                    raise
+                # Full jitter spreads the retries of many threads over time
+                sleep(uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt)))
+                attempt += 1
+            else:
+                self.concurrency.release()
+                with self.lock:
+                    self.calls_count += 1
+                return result
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                'rate': self.bucket.rate,
+                'concurrency_limit': int(self.concurrency.limit),
+                'in_flight': self.concurrency.in_flight,
+                'calls': self.calls_count,
+                'throttles': self.throttles_count,
+                'transient_errors': self.errors_count,
+            }
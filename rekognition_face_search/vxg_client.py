@@ -1,7 +1,8 @@
 import json
 from urllib.parse import urlencode
 
-import requests
+from .http_pool import HTTPPool
+from .metrics import STAGE_SECONDS
 
 
 class VXGClientBadConfig(Exception):
@@ -16,9 +17,10 @@ class VXGClient:
     TAG_HAS_FACE = 'rek_face_search_processed_has_face'
     TAG_NO_FACE = 'rek_face_search_processed_no_face'
     TAG_ERROR = 'rek_face_search_error'
+    TAG_REJECTED = 'rek_face_search_rejected'
     TAG_FACE_FMT = 'rek_face_search_faceid_%s'
 
-    SERVICE_TAGS = (TAG_PROCESSING, TAG_HAS_FACE, TAG_NO_FACE, TAG_ERROR)
+    SERVICE_TAGS = (TAG_PROCESSING, TAG_HAS_FACE, TAG_NO_FACE, TAG_ERROR, TAG_REJECTED)
 
     ENDPOINTS = {
         'events': 'v2/storage/events/',
@@ -27,13 +29,15 @@ class VXGClient:
         'event_meta': 'v2/storage/events/%(id)d/meta/%(tag)s/'
     }
 
-    def __init__(self, server_uri: str, token: str):
+    def __init__(self, server_uri: str, token: str, http: HTTPPool = None):
         self.server_uri = server_uri
         self.token = token
 
         if not all((self.server_uri, self.token)):
             raise VXGClientBadConfig()
 
+        self.http = http if http is not None else HTTPPool()
+
     def _get_url(self, typ: str, params: dict = None, query: list = None) -> str:
         if not params:
             params = {}
@@ -44,17 +48,60 @@ class VXGClient:
         query.append(('token', self.token))
         return '%s/api/%s?%s' % (self.server_uri, self.ENDPOINTS[typ] % params, urlencode(query, safe=','))
 
-    def get_unprocessed_events(self, limit: int) -> (list, int):
+    def get_unprocessed_events(self, limit: int, offset: int = 0, end: str = None) -> (list, int):
         """
         Get batch of unprocessed events
         :param limit: limit the results
+        :param offset: skip that number of events, used for paging
+        :param end: get only events older than that time, events are ordered by time then
         :return: list of events and total number of unprocessed events on the server
         """
-        resp = requests.get(self._get_url('events', query=[
+        query = [
             ('type', 'facedetection'),
             ('meta_not', ','.join(self.SERVICE_TAGS)),
             ('limit', limit)
-        ]))
+        ]
+        if offset:
+            query.append(('offset', offset))
+        if end:
+            query.extend((('end', end), ('order_by', 'time')))
+        return self._get_events(query)
+
+    def get_events_since(self, start: str, limit: int, offset: int = 0, end: str = None,
+                         include_meta: bool = False) -> (list, int):
+        """
+        Get batch of events starting from the given time, regardless of their meta tags
+        :param start: time of the oldest event to get, inclusive, None to start from the oldest event on the server
+        :param limit: limit the results
+        :param offset: skip that number of events, used to skip events already seen at `start`
+        :param end: get only events older than that time
+        :param include_meta: get meta tags of the events too, as 'meta' dict of every event
+        :return: list of events ordered by time and total number of events since `start` on the server
+        """
+        query = [
+            ('type', 'facedetection'),
+            ('order_by', 'time'),
+            ('limit', limit)
+        ]
+        if start:
+            query.append(('start', start))
+        if offset:
+            query.append(('offset', offset))
+        if end:
+            query.append(('end', end))
+        if include_meta:
+            query.append(('include_meta', 'true'))
+        return self._get_events(query)
+
+    def get_latest_event(self) -> dict:
+        """
+        :return: the newest event on the server regardless of its meta tags, None if there are no events
+        """
+        events, _ = self._get_events([('type', 'facedetection'), ('order_by', '-time'), ('limit', 1)])
+        return events[0] if events else None
+
+    def _get_events(self, query: list) -> (list, int):
+        resp = self.http.get(self._get_url('events', query=query))
         resp.raise_for_status()
         resp_json = resp.json()
         return resp_json['objects'], resp_json['meta']['total_count']
@@ -64,8 +111,8 @@ class VXGClient:
         Set the "processing" tag to event, indicating that we're going to process it
         :param event_id: event ID from VXG Server
         """
-        resp = requests.post(self._get_url('event_metas', params={'id': event_id}),
-                             json={'data': '', 'tag': self.TAG_PROCESSING})
+        resp = self.http.post(self._get_url('event_metas', params={'id': event_id}),
+                              json={'data': '', 'tag': self.TAG_PROCESSING})
         resp.raise_for_status()
 
     def clear_event_processing(self, event_id: int):
@@ -73,39 +120,105 @@ class VXGClient:
         Delete "Processing" tag from event
         :param event_id: event ID from VXG Server
         """
-        resp = requests.delete(self._get_url('event_meta', params={'id': event_id, 'tag': self.TAG_PROCESSING}))
+        resp = self.http.delete(self._get_url('event_meta', params={'id': event_id, 'tag': self.TAG_PROCESSING}))
+        resp.raise_for_status()
+
+    def get_event_meta(self, event_id: int, tag: str) -> str:
+        """
+        Get single meta tag of the event
+        :param event_id: event ID from VXG Server
+        :param tag: meta tag name
+        :return: meta tag value or None if the event has no such tag
+        """
+        resp = self.http.get(self._get_url('event_meta', params={'id': event_id, 'tag': tag}))
+        if resp.status_code == 404:
+            return None
+        resp.raise_for_status()
+        return resp.json().get('data')
+
+    def set_event_meta(self, event_id: int, tag: str, data: str = ''):
+        """
+        Set single meta tag to the event
+        :param event_id: event ID from VXG Server
+        :param tag: meta tag name
+        :param data: meta tag value
+        """
+        resp = self.http.post(self._get_url('event_metas', params={'id': event_id}), json={'data': data, 'tag': tag})
+        resp.raise_for_status()
+
+    def delete_event_meta(self, event_id: int, tag: str):
+        """
+        Delete single meta tag from the event
+        :param event_id: event ID from VXG Server
+        :param tag: meta tag name
+        """
+        resp = self.http.delete(self._get_url('event_meta', params={'id': event_id, 'tag': tag}))
         resp.raise_for_status()
 
-    def set_event_processed(self, event_id: int, faces: list):
+    def update_event_meta(self, event_id: int, tags: list, delete_tags: list = ()):
+        """
+        Apply several meta changes to the event at once. Requests are running concurrently on the pooled connections,
+        so the whole update takes about one round trip instead of one per tag.
+        Tags from `delete_tags` are deleted only after the first tag from `tags` is written, so when the first one is
+        a service tag the event never looks unprocessed to the poller in the middle of the update.
+        :param event_id: event ID from VXG Server
+        :param tags: list of (tag, data) tuples to set
+        :param delete_tags: list of tags to delete
+        """
+        def set_first_and_delete():
+            self.set_event_meta(event_id, *tags[0])
+            for tag in delete_tags:
+                self.delete_event_meta(event_id, tag)
+
+        calls = [set_first_and_delete]
+        calls.extend((lambda tag=tag, data=data: self.set_event_meta(event_id, tag, data)) for tag, data in tags[1:])
+        with STAGE_SECONDS.labels('write').time():
+            self.http.run_concurrently(calls)
+
+    def set_event_processed(self, event_id: int, faces: list, clear_processing: bool = False):
         """
         Set "processed" tag to the event and also set tags with processing results
         :param event_id: event ID from VXG Server
         :param faces: list of results as dicts with essential key 'FaceId'
+        :param clear_processing: also delete "processing" tag within the same update
         """
-        if faces:
-            resp = requests.post(self._get_url('event_metas', params={'id': event_id}),
-                                 json={'data': '', 'tag': self.TAG_HAS_FACE})
-            resp.raise_for_status()
-            for face in faces:
-                face_id = face.pop('FaceId')
-                resp = requests.post(self._get_url('event_metas', params={'id': event_id}),
-                                     json={'data': json.dumps(face), 'tag': self.TAG_FACE_FMT % face_id})
-                resp.raise_for_status()
-        else:
-            resp = requests.post(self._get_url('event_metas', params={'id': event_id}),
-                                 json={'data': '', 'tag': self.TAG_NO_FACE})
-            resp.raise_for_status()
+        self.update_event_meta(event_id, self._get_processed_tags(faces),
+                               delete_tags=[self.TAG_PROCESSING] if clear_processing else [])
 
-    def set_event_processed_error(self, event_id: int, message: str):
+    def _get_processed_tags(self, faces: list) -> list:
+        """
+        Build meta tags with processing results, the service tag goes first
+        :param faces: list of results as dicts with essential key 'FaceId'
+        :return: list of (tag, data) tuples
+        """
+        if not faces:
+            return [(self.TAG_NO_FACE, '')]
+        tags = [(self.TAG_HAS_FACE, '')]
+        for face in faces:
+            face = dict(face)
+            face_id = face.pop('FaceId')
+            tags.append((self.TAG_FACE_FMT % face_id, json.dumps(face)))
+        return tags
+
+    def set_event_processed_error(self, event_id: int, message: str, clear_processing: bool = False):
         """
         Set "processed_with_error" tag
         :param event_id: event ID from VXG Server
         :param message: short description what were wrong
-        :return:
+        :param clear_processing: also delete "processing" tag within the same update
         """
-        resp = requests.post(self._get_url('event_metas', params={'id': event_id}),
-                             json={'data': message, 'tag': self.TAG_ERROR})
-        resp.raise_for_status()
+        self.update_event_meta(event_id, [(self.TAG_ERROR, message)],
+                               delete_tags=[self.TAG_PROCESSING] if clear_processing else [])
+
+    def set_event_rejected(self, event_id: int, reason: str, clear_processing: bool = False):
+        """
+        Set "rejected" tag: there's a face, but it's not good enough to be added to the collection
+        :param event_id: event ID from VXG Server
+        :param reason: why the face is rejected
+        :param clear_processing: also delete "processing" tag within the same update
+        """
+        self.update_event_meta(event_id, [(self.TAG_REJECTED, reason)],
+                               delete_tags=[self.TAG_PROCESSING] if clear_processing else [])
 
     def get_event_details(self, event_id: int) -> dict:
         """
@@ -113,7 +226,7 @@ class VXGClient:
         :param event_id:
         :return:
         """
-        resp = requests.get(self._get_url('event', params={'id': event_id}, query=[('include_meta', 'true')]))
+        resp = self.http.get(self._get_url('event', params={'id': event_id}, query=[('include_meta', 'true')]))
         resp.raise_for_status()
         resp_json = resp.json()
         return resp_json
@@ -125,12 +238,12 @@ class VXGClient:
         :param faces:
         """
         if faces:
-            resp = requests.delete(self._get_url('event_meta', params={'id': event_id, 'tag': self.TAG_HAS_FACE}))
+            resp = self.http.delete(self._get_url('event_meta', params={'id': event_id, 'tag': self.TAG_HAS_FACE}))
             resp.raise_for_status()
             for face in faces:
-                resp = requests.delete(self._get_url('event_meta', params={'id': event_id,
-                                                                           'tag': self.TAG_FACE_FMT % face['FaceId']}))
+                resp = self.http.delete(self._get_url('event_meta', params={'id': event_id,
+                                                                            'tag': self.TAG_FACE_FMT % face['FaceId']}))
                 resp.raise_for_status()
         else:
-            resp = requests.delete(self._get_url('event_meta', params={'id': event_id, 'tag': self.TAG_NO_FACE}))
+            resp = self.http.delete(self._get_url('event_meta', params={'id': event_id, 'tag': self.TAG_NO_FACE}))
             resp.raise_for_status()
@@ -1,21 +1,36 @@
 import asyncio
+from functools import partial
+from threading import Lock
 
+from botocore.exceptions import BotoCoreError, ClientError
 from tornado.httpserver import HTTPServer
 from tornado.ioloop import IOLoop
-from tornado.web import RequestHandler, Application as TornadoApplication
+from tornado.web import HTTPError, RequestHandler, Application as TornadoApplication
 from tornado.testing import bind_unused_port
 
+from .identity_store import parse_time
+from .metrics import REGISTRY
+from .pipeline import PipelineWorker
+from .scheduler import FairQueue
+from .supervisor import ProcessSupervisor
+
 
 class WebApplication(TornadoApplication):
     def __init__(self, app):
         super(WebApplication, self).__init__([
             (r"/settings/", SettingsHandler),
             (r"/status/", StatusHandler),
+            (r"/metrics", MetricsHandler),
+            (r"/faces/([^/]+)/events/", FaceEventsHandler),
+            (r"/cameras/([^/]+)/faces/", CameraFacesHandler),
         ])
         self.app = app
         self.loop = None
         self.port = None  # Actual port that we're running
         self.apply_in_progress = False
+        # Callbacks scheduled before the loop is started
+        self.pending_callbacks = []
+        self.pending_callbacks_lock = Lock()
 
     @staticmethod
     def _ensure_event_loop():
@@ -33,46 +48,158 @@ class WebApplication(TornadoApplication):
         else:
             self.listen(port)
         self.port = port
-        self.loop = IOLoop().current()
+        with self.pending_callbacks_lock:
+            self.loop = IOLoop().current()
+            for callback in self.pending_callbacks:
+                self.loop.add_callback(callback)
+            self.pending_callbacks = []
         self.loop.start()
 
+    def add_callback(self, callback):
+        """
+        Run callback or coroutine function on the web application loop. Safe to call from any thread, even before
+        the loop is started.
+        :param callback: function or coroutine function without arguments
+        """
+        with self.pending_callbacks_lock:
+            if self.loop is None:
+                self.pending_callbacks.append(callback)
+                return
+        self.loop.add_callback(callback)
+
     def stop(self):
         if self.loop:
-            self.loop.stop()
+            # Can be called from another thread or signal handler, so wake the loop up safely
+            self.loop.add_callback(self.loop.stop)
 
 
 class SettingsHandler(RequestHandler):
     async def get(self):
-        await self.render('templates/settings.html',
-                          server_uri=self.application.app.server_uri or '',
-                          token=self.application.app.token or '',
-                          collection=self.application.app.collection or '',
-                          access_key=self.application.app.access_key or '',
-                          secret_key=self.application.app.secret_key or '',
-                          apply_in_progress=self.application.apply_in_progress)
+        await self.render_settings()
 
     async def post(self):
+        error = None
         if not self.application.apply_in_progress:
-            self.application.app.server_uri = self.get_argument('server_uri')
-            self.application.app.token = self.get_argument('token')
-            self.application.app.collection = self.get_argument('collection')
-            self.application.app.access_key = self.get_argument('access_key')
-            self.application.app.secret_key = self.get_argument('secret_key')
-            self.application.apply_in_progress = True
-            await self.application.loop.run_in_executor(func=self.application.app.restart_source_and_workers,
-                                                        executor=None)
-            self.application.apply_in_progress = False
+            try:
+                settings = {
+                    'server_uri': self.get_argument('server_uri'),
+                    'token': self.get_argument('token'),
+                    'collection': self.get_argument('collection'),
+                    'access_key': self.get_argument('access_key'),
+                    'secret_key': self.get_argument('secret_key'),
+                    'threshold': float(self.get_argument('threshold', self.application.app.threshold)),
+                    'workers_count': int(self.get_argument('workers_count', self.application.app.workers_count)),
+                }
+                if not 0 <= settings['threshold'] <= 100 or settings['workers_count'] < 1:
+                    raise ValueError()
+            except ValueError:
+                error = 'Threshold must be a number from 0 to 100 and number of workers a positive integer'
+            else:
+                self.application.apply_in_progress = True
+                try:
+                    # Applied in place while possible, so processing goes on
+                    await self.application.loop.run_in_executor(None, self.application.app.apply_settings, settings)
+                except (BotoCoreError, ClientError) as ex:
+                    # Nothing is changed then, the running components keep the previous settings
+                    error = 'AWS Rekognition settings are not applied: %s' % ex
+                finally:
+                    self.application.apply_in_progress = False
+        await self.render_settings(error)
+
+    async def render_settings(self, error: str = None):
+        app = self.application.app
         await self.render('templates/settings.html',
-                          server_uri=self.application.app.server_uri or '',
-                          token=self.application.app.token or '',
-                          collection=self.application.app.collection or '',
-                          access_key=self.application.app.access_key or '',
-                          secret_key=self.application.app.secret_key or '',
+                          server_uri=app.server_uri or '',
+                          token=app.token or '',
+                          collection=app.collection or '',
+                          access_key=app.access_key or '',
+                          secret_key=app.secret_key or '',
+                          threshold=app.threshold,
+                          workers_count=app.workers_count,
+                          error=error,
                           apply_in_progress=self.application.apply_in_progress)
 
 
 class StatusHandler(RequestHandler):
     async def get(self):
-        self.write({'source_running': self.application.app.source is not None,
-                    'workers_running': self.application.app.workers is not None,
-                    'queue_size': self.application.app.queue.qsize()})
+        app = self.application.app
+        self.write({'source_running': app.source is not None,
+                    'poller': app.source.controller.status() if app.source and app.source.controller else None,
+                    'workers_running': app.workers is not None,
+                    'aws': app.aws_status(),
+                    'execution_mode': app.execution_mode,
+                    'queue_size': app.queued_count(),
+                    'scheduler': app.work_queue.stats() if isinstance(app.work_queue, FairQueue) else None,
+                    'pipeline': app.workers[0].stats() if app.workers and isinstance(app.workers[0], PipelineWorker)
+                    else None,
+                    'processes': app.workers[0].stats() if app.workers and isinstance(app.workers[0], ProcessSupervisor)
+                    else None,
+                    'coordinator': app.source.coordinator.stats() if app.source and app.source.coordinator else None,
+                    'journal': app.journal.stats() if app.journal else None,
+                    'batcher': app.batcher.stats() if app.batcher else None,
+                    'http_pool': app.http.stats(),
+                    'aws_limits': {name: limiter.stats() for name, limiter in app.aws_limiters.items()},
+                    'dedup': app.dedup.stats() if app.dedup else None,
+                    'local_match': app.local.stats() if app.local else None,
+                    'quality_gate': app.gate.stats(),
+                    'multi_face': app.multi_face_status(),
+                    'hygiene': app.maintainer.stats() if app.maintainer else None,
+                    'resilience': app.resilience_stats(),
+                    'identities': app.identities.stats() if app.identities else None})
+
+
+class IdentityLookupHandler(RequestHandler):
+    """
+    Lookups at the local identity store, time range is given by "start" and "end" query arguments as VXG Server
+    times or Unix timestamps
+    """
+    MAX_LIMIT = 1000
+
+    def lookup_args(self) -> dict:
+        """
+        :raises HTTPError: the store is not enabled or arguments are invalid
+        :return: collection, start, end and limit arguments of the lookup
+        """
+        app = self.application.app
+        if app.identities is None:
+            raise HTTPError(404, 'Identity store is not enabled, set IDENTITY_STORE_FILE')
+        try:
+            start = self.get_argument('start', None)
+            end = self.get_argument('end', None)
+            return {'collection': app.collection,
+                    'start': parse_time(start) if start else None,
+                    'end': parse_time(end) if end else None,
+                    'limit': min(self.MAX_LIMIT, int(self.get_argument('limit', 100)))}
+        except ValueError:
+            raise HTTPError(400, 'Times must be like 2019-01-31T12:00:00 or Unix timestamps, limit a number')
+
+    async def run_lookup(self, func, *args, **kwargs):
+        # SQLite query is quick, but it's still disk access, so keep it off the loop
+        return await self.application.loop.run_in_executor(None, partial(func, *args, **kwargs))
+
+
+class FaceEventsHandler(IdentityLookupHandler):
+    async def get(self, face_id: str):
+        args = self.lookup_args()
+        aliases = self.application.app.aliases
+        if aliases is not None:
+            # Events reported before the faces of the person were merged have other FaceIds
+            face_id = aliases.resolve(face_id)
+            face_ids = [face_id] + aliases.merged_into(face_id)
+        else:
+            face_ids = [face_id]
+        events = await self.run_lookup(self.application.app.identities.events_for_face, face_ids=face_ids, **args)
+        self.write({'face_id': face_id, 'face_ids': face_ids, 'events': events})
+
+
+class CameraFacesHandler(IdentityLookupHandler):
+    async def get(self, camid: str):
+        args = self.lookup_args()
+        faces = await self.run_lookup(self.application.app.identities.faces_on_camera, camid=camid, **args)
+        self.write({'camid': camid, 'faces': faces})
+
+
+class MetricsHandler(RequestHandler):
+    async def get(self):
+        self.set_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.write(REGISTRY.expose())
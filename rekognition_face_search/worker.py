@@ -1,15 +1,257 @@
+import copy
+from functools import partial
 from queue import Queue, Empty
 from threading import Event
-from time import sleep
+from time import time
 import traceback
 
-import requests
-
 from .aws_client import AWSClient
+from .dedup import DedupCache, hash_distance, image_hash
+from .hygiene import FaceAliasMap
+from .http_pool import HTTPPool
+from .identity_store import IdentityStore
+from .image import ImageError, ImageLoader
+from .journal import WorkJournal
+from .local_index import LocalMatcher
+from .metrics import ERRORS, EVENTS, IN_FLIGHT, QUEUE_AGE, STAGE_SECONDS
+from .multi_face import MultiFaceSearch, has_more_faces, merge_faces
+from .quality import FaceRejected, QualityGate
+from .resilience import (DEPENDENCY_DOWNLOAD, DEPENDENCY_REKOGNITION, DEPENDENCY_VXG, CircuitOpen, DependencyError,
+                         RetryQueue, failure_reason)
 from .vxg_client import VXGClient
 
 
-class Worker:
+def matched_faces(search_resp: dict) -> list:
+    """
+    Get faces to report from "search_faces_by_image" response
+    :param search_resp: AWS Rekognition response
+    :return: list with the best matching face along with its similarity or empty list if there's no familiar faces
+    """
+    # AWS looking only for the biggest face in the image, so let's simply find a best match
+    # for this single face and report it to server. Other faces are searched by MultiFaceSearch if it's enabled
+    best_match = None
+    for match in search_resp['FaceMatches']:
+        if best_match is None or best_match['Similarity'] < match['Similarity']:
+            best_match = match
+    return [dict(best_match['Face'], Similarity=best_match['Similarity'])] if best_match else []
+
+
+def indexed_faces(index_resp: dict) -> list:
+    """
+    Get faces to report from "index_faces" response
+    :param index_resp: AWS Rekognition response
+    :return: list of newly indexed faces
+    """
+    return [face_record['Face'] for face_record in index_resp['FaceRecords']]
+
+
+def observe_dequeued(item: dict):
+    """
+    Report the time the item waited at the queue
+    :param item: task just taken from the queue
+    """
+    if 'queued_at' in item:
+        age = max(0.0, time() - item['queued_at'])
+        QUEUE_AGE.set(age)
+        STAGE_SECONDS.labels('queue').observe(age)
+
+
+class FailureHandler:
+    """
+    Failure handling shared by the workers of all the execution modes: calls to the storage, AWS Rekognition and
+    VXG Server go through their circuit breakers, failed events are put aside to the retry queue or given up with
+    "rek_face_search_error" tag, so no event is left "processing".
+    Mixin expecting `vxg`, `breakers`, `retry` and `journal` attributes, see `Worker`.
+    """
+    def guard(self, dependency: str, func, *args, **kwargs):
+        """
+        Call the dependency through its circuit breaker if there's one
+        :param dependency: DEPENDENCY_DOWNLOAD, DEPENDENCY_REKOGNITION or DEPENDENCY_VXG
+        :raises DependencyError: the call failed or was not made
+        :return: result of the call
+        """
+        breaker = self.breakers.get(dependency)
+        if breaker is None:
+            return func(*args, **kwargs)
+        return breaker.call(func, *args, **kwargs)
+
+    def retry_later(self, item: dict, ex: Exception) -> bool:
+        """
+        Put the failed event aside to be retried
+        :param item: task from the queue
+        :param ex: exception the processing failed with
+        :return: False if the event must be given up
+        """
+        if not isinstance(ex, CircuitOpen):
+            cause = ex.__cause__ if isinstance(ex, DependencyError) and ex.__cause__ is not None else ex
+            ERRORS.labels(ex.dependency if isinstance(ex, DependencyError) else 'worker', type(cause).__name__).inc()
+            if isinstance(ex, DependencyError):
+                print('Event %s failed: %s (%s)' % (item['id'], ex.reason, cause))
+            else:
+                print('Unexpected exception at %s.process: %s\n%s' % (type(self).__name__, ex, traceback.format_exc()))
+        # Group members are processed by the worker that got the group
+        item = {key: value for key, value in item.items() if key != 'group'}
+        return self.retry is not None and self.retry.schedule(item, ex)
+
+    def fail(self, item: dict, ex: Exception):
+        """
+        Put the failed event aside to be retried, or give it up and set "rek_face_search_error" tag with the reason
+        :param item: task from the queue
+        :param ex: exception the processing failed with
+        """
+        if self.retry_later(item, ex):
+            return
+        reason = failure_reason(ex)
+        try:
+            self.guard(DEPENDENCY_VXG, self.vxg.set_event_processed_error, item['id'], reason,
+                       clear_processing=item.get('processing', True))
+        except Exception as write_ex:
+            # Left "processing", the journal replays it on the next start if it's enabled
+            print('Event %s is given up, but its error is not written: %s' % (item['id'], write_ex))
+            return
+        self.dead_letter(item, reason)
+
+    def dead_letter(self, item: dict, reason: str):
+        """
+        Account the event given up, its error is written already
+        :param item: task from the queue
+        :param reason: reason written to the error tag
+        """
+        print('Event %s is given up: %s' % (item['id'], reason))
+        EVENTS.labels('dead_letter').inc()
+        if self.journal is not None:
+            self.journal.complete(item['id'])
+
+
+class FaceRecognizer(FailureHandler):
+    """
+    Recognition shared by the workers of all the execution modes: local matching, AWS Rekognition search of the
+    biggest face or of every face of the frame, indexing of new faces and resolving of merged FaceIds.
+    Mixin expecting `aws`, `local`, `multi_face`, `gate` and `aliases` attributes along with the `FailureHandler`
+    ones, see `Worker`.
+    """
+    def recognize(self, image: bytes) -> list:
+        """
+        Find familiar faces at the image or index new ones
+        :param image: encoded image
+        :raises FaceRejected: new face is not good enough to be indexed
+        :return: list of faces to report
+        """
+        # Confident local match saves AWS Rekognition request
+        if self.local is not None:
+            embedding = self.local.embed(image)
+            faces = self.local.match(embedding)
+            if faces is not None:
+                return self.resolve_aliases(faces)
+        # Find faces at the image
+        if self.multi_face is None:
+            faces = self.search(image)
+        elif self.multi_face.detect_always:
+            split = self.multi_face.split(image)
+            if split is not None:
+                boxes, crops = split
+                faces = merge_faces(boxes, self.multi_face.run([partial(self.recognize_crop, crop) for crop in crops]))
+            else:
+                faces = self.search(image)
+        else:
+            faces = self.search_frame(image)
+        faces = self.resolve_aliases(faces)
+        if self.local is not None:
+            self.local.learn(embedding, faces)
+        return faces
+
+    def search(self, image: bytes, max_faces: int = None) -> list:
+        """
+        Search the biggest face of the image at the collection
+        :param image: encoded image
+        :param max_faces: max faces to index if the face is not found
+        :raises FaceRejected: new face is not good enough to be indexed
+        :return: list of faces to report
+        """
+        # Only the calls to AWS go through the breaker, failures of local image processing are not Rekognition ones
+        search_resp = self.guard(DEPENDENCY_REKOGNITION, self.aws.search_face, image)
+        faces = matched_faces(search_resp)
+        if not faces:
+            # If familiar faces are not found, index new faces to recognise them in the future
+            faces = self.index(image, search_resp, max_faces)
+        return faces
+
+    def search_frame(self, image: bytes) -> list:
+        """
+        Search the biggest face of the frame, other faces are searched if indexing shows there are any
+        :param image: encoded image
+        :raises FaceRejected: no faces are found and new faces are not good enough to be indexed
+        :return: list of faces to report
+        """
+        search_resp = self.guard(DEPENDENCY_REKOGNITION, self.aws.search_face, image)
+        faces = matched_faces(search_resp)
+        if faces:
+            return faces
+        # Indexing the biggest face alone tells whether there are more faces, other faces are indexed from their crops
+        index_resp = self.index_response(image, search_resp, max_faces=1)
+        split = self.multi_face.split(image) if has_more_faces(index_resp) else None
+        if split is None:
+            return self.indexed(index_resp)
+        boxes, crops = split
+        try:
+            first = self.indexed(index_resp)
+        except FaceRejected as ex:
+            first = ex
+        return merge_faces(boxes, [first] + self.multi_face.run([partial(self.recognize_crop, crop)
+                                                                 for crop in crops[1:]]))
+
+    def recognize_crop(self, crop: bytes):
+        """
+        :param crop: encoded crop of a single face
+        :return: list of faces to report or FaceRejected, so other faces of the frame are still reported
+        """
+        try:
+            # Crop margins may catch a part of another face, it's indexed from its own crop
+            return self.search(crop, max_faces=1)
+        except FaceRejected as ex:
+            return ex
+
+    def index(self, image: bytes, search_resp: dict, max_faces: int = None) -> list:
+        """
+        Add new faces to the collection
+        :param image: encoded image
+        :param search_resp: "search_faces_by_image" response for the image
+        :param max_faces: max faces to index, overrides the gate setting
+        :raises FaceRejected: face is not good enough to be indexed
+        :return: list of newly indexed faces
+        """
+        return self.indexed(self.index_response(image, search_resp, max_faces))
+
+    def index_response(self, image: bytes, search_resp: dict, max_faces: int = None) -> dict:
+        """
+        :raises FaceRejected: face is not good enough to be indexed
+        :return: "index_faces" response, see `index`
+        """
+        if self.gate is None:
+            return self.guard(DEPENDENCY_REKOGNITION, self.aws.index_faces, image, max_faces=max_faces)
+        self.gate.check(image, search_resp)
+        return self.guard(DEPENDENCY_REKOGNITION, self.aws.index_faces, image,
+                          quality_filter=self.gate.quality_filter, max_faces=max_faces or self.gate.max_faces)
+
+    def indexed(self, index_resp: dict) -> list:
+        """
+        :param index_resp: "index_faces" response
+        :raises FaceRejected: IndexFaces quality filter rejected all the faces
+        :return: list of newly indexed faces
+        """
+        if self.gate is not None:
+            self.gate.check_indexed(index_resp)
+        return indexed_faces(index_resp)
+
+    def resolve_aliases(self, faces: list) -> list:
+        """
+        :param faces: faces found at the image
+        :return: faces with FaceIds merged by the collection maintenance replaced by canonical ones
+        """
+        return self.aliases.apply(faces) if self.aliases is not None else faces
+
+
+class Worker(FaceRecognizer):
     """
     Gets image URLs from the Queue and starts it's processing:
         1) downloads image from the storage;
@@ -17,13 +259,32 @@ class Worker:
         3) if no known faces is found, but there's a faces, call "index_faces" to add faces to Collection, get their UUIDs
         4) set metadata with face UUID and rectangle to this event, also set meta tag "processed_has_face"
         5) if no faces found set meta tag "processed_no_face"
+    Calls to the storage, AWS Rekognition and VXG Server go through their `breakers`. Failed events are put aside to
+    the `retry` queue, events failed too many times get "rek_face_search_error" tag with the reason.
+    Reported faces are recorded at the `identities` store.
     """
     QUEUE_TIMEOUT = 1
+    GROUP_MAX_DISTANCE = 6  # Max perceptual hash distance of the frames sharing the result within a group
 
-    def __init__(self, queue: Queue, aws_client: AWSClient, vxg_client: VXGClient):
+    def __init__(self, queue: Queue, aws_client: AWSClient, vxg_client: VXGClient, http: HTTPPool = None,
+                 dedup: DedupCache = None, local: LocalMatcher = None, loader: ImageLoader = None,
+                 journal: WorkJournal = None, aliases: FaceAliasMap = None, gate: QualityGate = None,
+                 multi_face: MultiFaceSearch = None, breakers: dict = None, retry: RetryQueue = None,
+                 identities: IdentityStore = None):
         self.queue = queue
         self.aws = aws_client
         self.vxg = vxg_client
+        self.http = http if http is not None else HTTPPool()
+        self.loader = loader if loader is not None else ImageLoader(self.http)
+        self.dedup = dedup
+        self.local = local
+        self.journal = journal
+        self.aliases = aliases
+        self.gate = gate
+        self.multi_face = multi_face
+        self.breakers = breakers or {}
+        self.retry = retry
+        self.identities = identities
         self.need_stop = Event()
 
     def stop(self):
@@ -37,8 +298,9 @@ class Worker:
                 except Empty:
                     pass
             except Exception as ex:
-                print('Unexpected exception at PollingImageSource.routine: %s\n%s' % (ex, traceback.format_exc()))
-                sleep(1)
+                # Failed events are handled by `fail`, so there's nothing to wait for here
+                ERRORS.labels('worker', type(ex).__name__).inc()
+                print('Unexpected exception at Worker.routine: %s\n%s' % (ex, traceback.format_exc()))
 
     def process(self):
         """
@@ -46,24 +308,75 @@ class Worker:
         """
         # Get task
         item = self.queue.get(timeout=self.QUEUE_TIMEOUT)
+        observe_dequeued(item)
+        IN_FLIGHT.inc()
         try:
-            # Download image
-            img_resp = requests.get(item['url'])
-            # Find faces at the image
-            search_resp = self.aws.search_face(img_resp.content)
-            if not search_resp['FaceMatches']:
-                # If familiar faces are not found, index new faces to recognise them in the future
-                index_resp = self.aws.index_faces(img_resp.content)
-                faces = [face_record['Face'] for face_record in index_resp['FaceRecords']]
-            else:
-                # AWS looking only for the biggest face in the image, so let's simply find a best match
-                # for this single face and report it to server
-                best_match = None
-                for match in search_resp['FaceMatches']:
-                    if best_match is None or best_match['Similarity'] < match['Similarity']:
-                        best_match = match
-                faces = [best_match['Face']]
-            self.vxg.set_event_processed(item['id'], faces)
-            self.vxg.clear_event_processing(item['id'])
+            reference = self.try_process_item(item)
+            # Events grouped by CameraBatcher: frames near-identical to the first one share its result
+            for member in item.get('group', ()):
+                self.try_process_item(member, reference)
         finally:
+            IN_FLIGHT.dec()
             self.queue.task_done()
+
+    def try_process_item(self, item: dict, reference: tuple = None) -> tuple:
+        """
+        Process a single event, failed one is retried later or given up
+        :param item: task from the queue
+        :param reference: image hash and faces of the first event of the group
+        :return: image hash (None if not needed) and faces found, None if the event is not processed
+        """
+        try:
+            return self.process_item(item, reference)
+        except Exception as ex:
+            self.fail(item, ex)
+            return None
+
+    def process_item(self, item: dict, reference: tuple = None) -> tuple:
+        """
+        Process a single event
+        :param item: task from the queue
+        :param reference: image hash and faces of the first event of the group
+        :return: image hash (None if not needed) and faces found, None if the image can't be processed
+        """
+        with STAGE_SECONDS.labels('total').time():
+            result = self._process_item(item, reference)
+        if self.journal is not None:
+            self.journal.complete(item['id'])
+        return result
+
+    def _process_item(self, item: dict, reference: tuple = None) -> tuple:
+        # Download image
+        try:
+            with STAGE_SECONDS.labels('download').time():
+                image = self.guard(DEPENDENCY_DOWNLOAD, self.loader.load, item['url'])
+        except ImageError as ex:
+            self.guard(DEPENDENCY_VXG, self.vxg.set_event_processed_error, item['id'], ex.reason,
+                       clear_processing=item.get('processing', True))
+            EVENTS.labels('error').inc()
+            return None
+        image_key = None
+        if self.dedup is not None or reference is not None or item.get('group'):
+            image_key = image_hash(image)
+        faces = None
+        if reference is not None and hash_distance(image_key, reference[0]) <= self.GROUP_MAX_DISTANCE:
+            faces = copy.deepcopy(reference[1])
+        # Near-identical image from the same camera may be already recognised
+        if faces is None and self.dedup is not None:
+            faces = self.dedup.get(item.get('camid'), image_key)
+        if faces is None:
+            try:
+                faces = self.recognize(image)
+            except FaceRejected as ex:
+                self.guard(DEPENDENCY_VXG, self.vxg.set_event_rejected, item['id'], ex.reason,
+                           clear_processing=item.get('processing', True))
+                EVENTS.labels('rejected').inc()
+                return None
+            if self.dedup is not None:
+                self.dedup.put(item.get('camid'), image_key, faces)
+        self.guard(DEPENDENCY_VXG, self.vxg.set_event_processed, item['id'], faces,
+                   clear_processing=item.get('processing', True))
+        if self.identities is not None:
+            self.identities.record(self.aws.collection_id, item, faces)
+        EVENTS.labels('face' if faces else 'no_face').inc()
+        return image_key, faces
@@ -0,0 +1,6 @@
+import sys
+
+from rekognition_face_search.benchmark import main
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,186 @@
+import os
+from time import sleep
+from unittest import TestCase
+from unittest.mock import patch
+
+from botocore.exceptions import ClientError
+
+from rekognition_face_search.app import Application
+from rekognition_face_search.aws_client import AWSClient
+from rekognition_face_search.scheduler import FairQueue
+from rekognition_face_search.vxg_client import VXGClient
+
+
+class MockAWSClient(AWSClient):
+    def __init__(self, max_pool_connections: int = 100, error: Exception = None):
+        self.threshold = 0.8
+        self.max_pool_connections = max_pool_connections
+        self.error = error
+
+    def ensure_collection_exist(self):
+        if self.error is not None:
+            raise self.error
+
+
+class MockSource:
+    def __init__(self, vxg_client: VXGClient):
+        self.vxg_client = vxg_client
+        self.stopped = False
+
+    def stop(self):
+        self.stopped = True
+
+
+class TestApplySettings(TestCase):
+    """
+    Settings applied in place to running thread workers
+    """
+    def setUp(self):
+        self.app = Application()
+        self.app.server_uri = 'http://vxg'
+        self.app.token = 'token'
+        self.app.collection = 'faces'
+        self.app.access_key = 'key'
+        self.app.secret_key = 'secret'
+        self.app.workers_count = 2
+        self.app.aws = MockAWSClient()
+        self.app.source = MockSource(VXGClient(self.app.server_uri, self.app.token, http=self.app.http))
+        self.app.workers = []
+        self.app.worker_threads = []
+        self.app.resize_workers()
+
+    def tearDown(self):
+        self.app.stop_source_and_workers()
+        self.app.http.close()
+
+    def test_resize(self):
+        workers = list(self.app.workers)
+        self.app.apply_settings({'workers_count': 4})
+        self.assertEqual(len(self.app.workers), 4)
+        self.assertEqual(self.app.workers[:2], workers)
+        self.assertTrue(all(thread.is_alive() for thread in self.app.worker_threads))
+
+        self.app.apply_settings({'workers_count': 1})
+        self.assertEqual(self.app.workers, workers[:1])
+        self.assertTrue(workers[1].need_stop.is_set())
+        self.assertEqual(len(self.app.retired_threads), 3)
+        # Idle workers exit as soon as they give up waiting for the queue
+        sleep(1.5)
+        self.assertFalse(any(thread.is_alive() for thread in self.app.retired_threads))
+        self.assertFalse(self.app.source.stopped)
+
+    def test_token_and_threshold(self):
+        aws = self.app.aws
+        self.app.apply_settings({'token': 'new', 'threshold': 90.0, 'server_uri': 'http://vxg'})
+        self.assertEqual([worker.vxg.token for worker in self.app.workers], ['new', 'new'])
+        self.assertEqual(self.app.source.vxg_client.token, 'new')
+        self.assertIs(self.app.aws, aws)
+        self.assertEqual(aws.threshold, 90.0)
+        self.assertTrue(all(worker.aws is aws for worker in self.app.workers))
+
+    def test_bad_credentials(self):
+        aws = self.app.aws
+        self.app.create_aws_client = lambda **settings: MockAWSClient(
+            error=ClientError({'Error': {'Code': 'UnrecognizedClientException', 'Message': 'Bad key'}},
+                              'CreateCollection'))
+        with self.assertRaises(ClientError):
+            self.app.apply_settings({'access_key': 'bad', 'collection': 'other', 'threshold': 90.0})
+        # Nothing is changed
+        self.assertEqual((self.app.access_key, self.app.collection, self.app.threshold), ('key', 'faces', 0.8))
+        self.assertIs(self.app.aws, aws)
+        self.assertTrue(all(worker.aws is aws for worker in self.app.workers))
+
+    def test_pools_follow_workers(self):
+        self.app.aws.max_pool_connections = 3
+        self.app.apply_settings({'workers_count': 4})
+        self.assertEqual(self.app.http.pool_size, 5)
+        self.assertGreaterEqual(self.app.aws.max_pool_connections, 5)
+        self.assertTrue(all(worker.aws is self.app.aws for worker in self.app.workers))
+
+
+class TestQueues(TestCase):
+    def setUp(self):
+        self.environ = dict(os.environ)
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.environ)
+
+    def test_fair_after_batcher(self):
+        os.environ.update({'BATCH_WINDOW': '0.5', 'EXECUTION_MODE': 'threads', 'SCHEDULER': 'fair'})
+        app = Application()
+        # Grouped events are scheduled fairly, the poller queue is drained by the batcher right away
+        self.assertIsInstance(app.work_queue, FairQueue)
+        self.assertNotIsInstance(app.queue, FairQueue)
+        app.queue.put({'id': 0})
+        app.work_queue.put({'id': 1, 'camid': 1})
+        self.assertEqual(app.queued_count(), 2)
+        app.http.close()
+
+    def test_single_queue(self):
+        os.environ.update({'BATCH_WINDOW': '0', 'SCHEDULER': 'fair'})
+        app = Application()
+        self.assertIs(app.work_queue, app.queue)
+        self.assertIsInstance(app.queue, FairQueue)
+        app.http.close()
+
+
+class SlowAWSClient(MockAWSClient):
+    def ensure_collection_exist(self):
+        sleep(0.3)
+        super(SlowAWSClient, self).ensure_collection_exist()
+
+
+class TestBackgroundStart(TestCase):
+    def setUp(self):
+        self.app = Application()
+        self.app.server_uri = 'http://vxg'
+        self.app.token = 'token'
+        self.app.workers_count = 2
+        self.app.start_source = lambda: None
+
+    def tearDown(self):
+        self.app.stop_source_and_workers()
+        self.app.http.close()
+
+    def test_ready(self):
+        self.app.create_aws_client = lambda **settings: SlowAWSClient()
+        self.app.start_in_background()
+        status = self.app.aws_status()
+        self.assertEqual((status['ready'], status['starting']), (False, True))
+        self.app.wait_started()
+        status = self.app.aws_status()
+        self.assertEqual((status['ready'], status['starting'], status['error']), (True, False, None))
+        self.assertGreaterEqual(status['ready_in'], 0.3)
+        self.assertEqual(len(self.app.workers), 2)
+
+    def test_failed(self):
+        self.app.create_aws_client = lambda **settings: MockAWSClient(
+            error=ClientError({'Error': {'Code': 'UnrecognizedClientException', 'Message': 'Bad key'}},
+                              'CreateCollection'))
+        self.app.start_in_background()
+        self.app.wait_started()
+        status = self.app.aws_status()
+        self.assertFalse(status['ready'])
+        self.assertIn('UnrecognizedClientException', status['error'])
+        self.assertIsNone(self.app.aws)
+
+    def test_multi_face_unavailable(self):
+        self.app.create_aws_client = lambda **settings: MockAWSClient()
+        with patch.dict(os.environ, {'MULTI_FACE': '1'}), patch('rekognition_face_search.multi_face.Image', None):
+            self.app.start_in_background()
+            self.app.wait_started()
+        # Enabled but not made is shown at /status/
+        self.assertIsNone(self.app.multi_face)
+        self.assertEqual(self.app.multi_face_status(), {'error': 'Pillow is not installed'})
+
+    def test_no_maintenance(self):
+        self.app.create_aws_client = lambda **settings: MockAWSClient()
+        # As set by backfill: the collection is maintained by the running instance
+        self.app.maintenance = False
+        with patch.dict(os.environ, {'HYGIENE': '1'}):
+            self.app.start_in_background()
+            self.app.wait_started()
+        self.assertIsNone(self.app.maintainer)
+        self.assertIsNotNone(self.app.aliases)
+        self.assertIs(self.app.workers[0].aliases, self.app.aliases)
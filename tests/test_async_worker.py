@@ -0,0 +1,117 @@
+import asyncio
+from queue import Queue
+from threading import current_thread
+from unittest import TestCase
+from uuid import uuid4
+
+from rekognition_face_search.async_worker import AsyncVXGClient, AsyncWorker
+from rekognition_face_search.aws_client import AWSClient
+
+
+class MockAsyncVXGClient(AsyncVXGClient):
+    def __init__(self, delay: float = 0):
+        self.delay = delay
+        self.events = {}
+        self.concurrent = 0
+        self.max_concurrent = 0
+
+    async def fetch(self, url: str, max_bytes: int = None, timeout: float = None) -> bytes:
+        self.concurrent += 1
+        self.max_concurrent = max(self.max_concurrent, self.concurrent)
+        await asyncio.sleep(self.delay)
+        self.concurrent -= 1
+        return url.encode()
+
+    async def set_event_processed(self, event_id: int, faces: list, clear_processing: bool = False):
+        await asyncio.sleep(self.delay)
+        self.events[event_id] = faces
+
+    def close(self):
+        pass
+
+
+class MockAWSClient(AWSClient):
+    """
+    Knows faces from images with even event ID only
+    """
+    def __init__(self):
+        pass
+
+    def search_face(self, image):
+        if int(image.decode().split('/')[-1]) % 2:
+            return {'FaceMatches': []}
+        return {'FaceMatches': [{'Similarity': 90, 'Face': {'FaceId': 'known'}},
+                                {'Similarity': 99, 'Face': {'FaceId': 'best'}}]}
+
+    def index_faces(self, image, quality_filter: str = None, max_faces: int = None):
+        return {'FaceRecords': [{'Face': {'FaceId': str(uuid4())}}]}
+
+
+class MockLocalMatcher:
+    """
+    Knows nothing, records threads it's called at
+    """
+    def __init__(self):
+        self.threads = set()
+
+    def embed(self, image: bytes) -> tuple:
+        self.threads.add(current_thread())
+        return (0.0,)
+
+    def match(self, embedding: tuple):
+        self.threads.add(current_thread())
+        return None
+
+    def learn(self, embedding: tuple, faces: list):
+        self.threads.add(current_thread())
+
+
+class TestAsyncWorker(TestCase):
+    def setUp(self):
+        super(TestAsyncWorker, self).setUp()
+        self.loop = asyncio.new_event_loop()
+        self.queue = Queue()
+        self.vxg = MockAsyncVXGClient(delay=0.05)
+        self.worker = AsyncWorker(self.queue, MockAWSClient(), self.vxg, max_in_flight=50, aws_concurrency=4)
+        self.worker.QUEUE_TIMEOUT = 0.05
+
+    def tearDown(self):
+        self.loop.close()
+        super(TestAsyncWorker, self).tearDown()
+
+    def run_until_processed(self, count: int):
+        async def stop_when_processed():
+            while len(self.vxg.events) < count:
+                await asyncio.sleep(0.01)
+            self.worker.stop()
+
+        async def run():
+            await asyncio.wait_for(asyncio.gather(self.worker.routine(), stop_when_processed()), timeout=5)
+
+        self.loop.run_until_complete(run())
+
+    def test_process(self):
+        for idx in range(2):
+            self.queue.put({'id': idx, 'url': 'http://dummy.s3.amazonaws.com/%d' % idx})
+        self.run_until_processed(2)
+        self.assertEqual(self.vxg.events[0], [{'FaceId': 'best', 'Similarity': 99}])
+        self.assertEqual(len(self.vxg.events[1]), 1)
+        self.assertNotEqual(self.vxg.events[1][0]['FaceId'], 'known')
+        self.assertTrue(self.worker.stopped.is_set())
+        self.assertEqual(self.worker.in_flight, 0)
+
+    def test_many_in_flight(self):
+        for idx in range(100):
+            self.queue.put({'id': idx, 'url': 'http://dummy.s3.amazonaws.com/%d' % idx})
+        self.run_until_processed(100)
+        self.assertEqual(len(self.vxg.events), 100)
+        self.assertGreater(self.vxg.max_concurrent, 4)
+        self.assertLessEqual(self.vxg.max_concurrent, 50)
+
+    def test_local_matching_off_loop(self):
+        self.worker.local = local = MockLocalMatcher()
+        self.queue.put({'id': 0, 'url': 'http://dummy.s3.amazonaws.com/0'})
+        self.run_until_processed(1)
+        self.assertEqual(self.vxg.events[0], [{'FaceId': 'best', 'Similarity': 99}])
+        self.assertTrue(local.threads)
+        self.assertNotIn(current_thread(), local.threads)
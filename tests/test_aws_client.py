@@ -0,0 +1,14 @@
+from unittest import TestCase
+
+from rekognition_face_search.aws_client import AWSClient
+
+
+class TestSharedClient(TestCase):
+    def test_shared(self):
+        aws = AWSClient('faces', 'key', 'secret', max_pool_connections=5)
+        # Another collection or threshold reuses the boto3 client
+        other = AWSClient('other', 'key', 'secret', threshold=0.9, max_pool_connections=5)
+        self.assertIs(other.rek, aws.rek)
+        self.assertIsNot(AWSClient('faces', 'key', 'secret', max_pool_connections=10).rek, aws.rek)
+        self.assertIsNot(AWSClient('faces', 'other_key', 'secret', max_pool_connections=5).rek, aws.rek)
+        self.assertEqual(aws.rek.meta.config.max_pool_connections, 5)
@@ -0,0 +1,133 @@
+import json
+import os
+from queue import Queue
+from tempfile import TemporaryDirectory
+from threading import Timer
+from unittest import TestCase
+
+from rekognition_face_search.backfill import BACKFILL_MARK, Backfill, BackfillCheckpoint, format_duration
+from rekognition_face_search.journal import WorkJournal
+from rekognition_face_search.vxg_client import VXGClient
+
+START = '2019-01-31T00:00:00'
+END = '2019-02-01T00:00:00'
+
+
+class MockVXGClient(VXGClient):
+    def __init__(self, metas: list):
+        self.events = [{'id': idx, 'camid': 1, 'time': '2019-01-31T12:00:%02d' % idx,
+                        'thumb': {'url': 'http://dummy/%d' % idx} if idx != 3 else {}}
+                       for idx in range(len(metas))]
+        self.metas = {idx: meta for idx, meta in enumerate(metas)}
+        self.pages = []
+        self.updates = []
+        self.errors = {}
+        self.failing = set()
+
+    def get_events_since(self, start: str, limit: int, offset: int = 0, end: str = None,
+                         include_meta: bool = False) -> (list, int):
+        assert (start, end, include_meta) == (START, END, True)
+        self.pages.append(offset)
+        return ([dict(event, meta=dict(self.metas[event['id']])) for event in self.events[offset:offset + limit]],
+                len(self.events))
+
+    def update_event_meta(self, event_id: int, tags: list, delete_tags: list = None):
+        if event_id in self.failing:
+            raise ConnectionError('VXG Server is down')
+        self.updates.append((event_id, tags, sorted(delete_tags)))
+
+    def set_event_processed_error(self, event_id: int, message: str, clear_processing: bool = False):
+        self.errors[event_id] = message
+
+
+PROCESSING = [(VXGClient.TAG_PROCESSING, BACKFILL_MARK)]
+
+METAS = [
+    {},
+    {VXGClient.TAG_HAS_FACE: '', VXGClient.TAG_FACE_FMT % 'a': '{}'},
+    {VXGClient.TAG_PROCESSING: ''},
+    {},  # no image
+    {VXGClient.TAG_ERROR: 'failed', 'user_tag': ''},
+]
+
+
+class TestBackfill(TestCase):
+    def setUp(self):
+        super(TestBackfill, self).setUp()
+        self.tmp_dir = TemporaryDirectory()
+        self.path = os.path.join(self.tmp_dir.name, 'backfill.json')
+        self.queue = Queue()
+        self.vxg = MockVXGClient(METAS)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+        super(TestBackfill, self).tearDown()
+
+    def queued(self) -> list:
+        return [self.queue.get_nowait()['id'] for _ in range(self.queue.qsize())]
+
+    def test_reprocess(self):
+        backfill = Backfill(self.vxg, self.queue, BackfillCheckpoint(self.path, START, END), page_size=2, rate=1000)
+        self.assertTrue(backfill.run())
+        self.assertEqual(self.queued(), [0, 1, 4])
+        # Results are replaced, the event is never seen unprocessed meanwhile
+        self.assertEqual(self.vxg.updates, [
+            (0, PROCESSING, []),
+            (1, PROCESSING, [VXGClient.TAG_FACE_FMT % 'a', VXGClient.TAG_HAS_FACE]),
+            (4, PROCESSING, [VXGClient.TAG_ERROR]),
+        ])
+        with open(self.path) as f:
+            self.assertEqual(json.load(f), {'start': START, 'end': END, 'offset': 5, 'total': 5})
+        stats = backfill.stats()
+        self.assertEqual((stats['queued'], stats['skipped'], stats['eta']), (3, 2, 0))
+
+    def test_only_unprocessed(self):
+        backfill = Backfill(self.vxg, self.queue, BackfillCheckpoint(None, START, END), reprocess=False, rate=1000)
+        self.assertTrue(backfill.run())
+        self.assertEqual(self.queued(), [0])
+
+    def test_resume(self):
+        checkpoint = BackfillCheckpoint(self.path, START, END)
+        checkpoint.offset, checkpoint.total = 4, 5
+        checkpoint.save()
+        backfill = Backfill(self.vxg, self.queue, BackfillCheckpoint(self.path, START, END), page_size=2, rate=1000)
+        self.assertTrue(backfill.run())
+        self.assertEqual(self.queued(), [4])
+        self.assertEqual(self.vxg.pages, [4])
+        # Range of the interrupted run is taken when the end is not given
+        self.assertEqual(BackfillCheckpoint(self.path, START).end, END)
+        # Checkpoint of another range is not resumed
+        checkpoint = BackfillCheckpoint(self.path, START, '2019-01-31T12:00:00')
+        self.assertEqual((checkpoint.offset, checkpoint.total), (0, None))
+
+    def test_stopped(self):
+        backfill = Backfill(self.vxg, Queue(maxsize=1), BackfillCheckpoint(self.path, START, END), page_size=2,
+                            rate=1000)
+        backfill.PUT_TIMEOUT = 0.05
+        # The second event doesn't fit the queue
+        Timer(0.2, backfill.stop).start()
+        self.assertFalse(backfill.run())
+        checkpoint = BackfillCheckpoint(self.path, START, END)
+        self.assertEqual((checkpoint.offset, checkpoint.total), (0, 5))
+
+    def test_format_duration(self):
+        self.assertEqual(format_duration(3725.5), '1:02:05')
+        self.assertEqual(format_duration(None), 'unknown')
+
+    def test_interrupted(self):
+        journal = WorkJournal(os.path.join(self.tmp_dir.name, 'journal.db'))
+        # Event 0 was queued by the previous run, event 4 was tagged by it and the run died before the journal commit
+        journal.enqueue([{'id': 0, 'url': 'http://dummy/0', 'processing': True}])
+        self.vxg.metas[0] = {VXGClient.TAG_PROCESSING: BACKFILL_MARK}
+        self.vxg.metas[4] = {VXGClient.TAG_PROCESSING: BACKFILL_MARK}
+        self.vxg.failing.add(1)
+        backfill = Backfill(self.vxg, self.queue, BackfillCheckpoint(None, START, END), rate=1000, journal=journal)
+        self.assertTrue(backfill.run())
+        self.assertEqual(self.queued(), [0, 4])
+        # Not left "processing" when the tags can't be changed
+        self.assertEqual(self.vxg.errors, {1: 'backfill_failed: ConnectionError'})
+        self.assertEqual(backfill.stats()['failed'], 1)
+        journal.close()
+        journal = WorkJournal(journal.path)
+        self.assertEqual(sorted(item['id'] for item in journal.recover()), [0, 4])
+        journal.close()
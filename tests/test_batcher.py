@@ -0,0 +1,77 @@
+from queue import Queue
+from time import sleep
+from unittest import TestCase
+
+from rekognition_face_search.batcher import CameraBatcher
+
+
+class TestCameraBatcher(TestCase):
+    def setUp(self):
+        super(TestCameraBatcher, self).setUp()
+        self.in_queue = Queue()
+        self.out_queue = Queue()
+        self.batcher = CameraBatcher(self.in_queue, self.out_queue, window=0.1, max_batch=3)
+        self.batcher.GET_TIMEOUT = 0.01
+
+    def drain(self) -> list:
+        while not self.in_queue.empty():
+            self.batcher.step()
+        items = []
+        while not self.out_queue.empty():
+            items.append(self.out_queue.get_nowait())
+        return items
+
+    def test_group_by_camera(self):
+        for idx in range(4):
+            self.in_queue.put({'id': idx, 'url': 'http://dummy/%d' % idx, 'camid': idx % 2})
+        self.assertEqual(self.drain(), [])
+        sleep(0.1)
+        self.batcher.step()
+        items = sorted(self.drain(), key=lambda item: item['id'])
+        self.assertEqual(len(items), 2)
+        self.assertEqual(items[0]['id'], 0)
+        self.assertEqual([member['id'] for member in items[0]['group']], [2])
+        self.assertEqual(items[1]['id'], 1)
+        self.assertEqual([member['id'] for member in items[1]['group']], [3])
+        self.assertEqual(self.batcher.stats(), {'groups': 2, 'events': 4, 'pending': 0})
+
+    def test_max_batch(self):
+        for idx in range(4):
+            self.in_queue.put({'id': idx, 'url': 'http://dummy/%d' % idx, 'camid': 1})
+        items = self.drain()
+        self.assertEqual(len(items), 1)
+        self.assertEqual(len(items[0]['group']), 2)
+        self.assertEqual(self.batcher.stats()['pending'], 1)
+
+    def test_no_camera(self):
+        self.in_queue.put({'id': 0, 'url': 'http://dummy/0', 'camid': None})
+        self.assertEqual(self.drain(), [{'id': 0, 'url': 'http://dummy/0', 'camid': None}])
+
+    def test_flush_on_stop(self):
+        for idx in range(3):
+            self.in_queue.put({'id': idx, 'url': 'http://dummy/%d' % idx, 'camid': idx})
+        while not self.in_queue.empty():
+            self.batcher.step()
+        self.batcher.stop()
+        self.batcher.routine()
+        self.assertEqual(sorted(item['id'] for item in self.drain()), [0, 1, 2])
+        self.assertEqual(self.batcher.stats()['pending'], 0)
+
+    def test_keep_when_full(self):
+        self.batcher.out_queue = self.out_queue = Queue(maxsize=1)
+        self.batcher.window = 10
+        for idx in range(3):
+            self.in_queue.put({'id': idx, 'url': 'http://dummy/%d' % idx, 'camid': idx})
+        while not self.in_queue.empty():
+            self.batcher.step()
+        self.batcher.stop()
+        self.batcher.routine()
+        # Nothing is dropped, events that didn't fit wait for the next start
+        self.assertEqual(self.batcher.stats()['pending'], 2)
+        self.assertEqual(len(self.drain()), 1)
+        self.batcher.need_stop.clear()
+        self.batcher.step()
+        self.batcher.stop()
+        self.batcher.flush()
+        self.assertEqual(len(self.drain()), 1)
+        self.assertEqual(self.batcher.stats()['pending'], 1)
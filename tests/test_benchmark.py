@@ -0,0 +1,40 @@
+from unittest import TestCase
+
+from rekognition_face_search.benchmark import DEFAULT_CASE, case_params, compare, percentile, run_case
+
+
+def make_result(throughput: float = 100, p95: float = 1, lost: int = 0, **params) -> dict:
+    return {
+        'case': 'threads/workers=20/queue=100',
+        'params': case_params(dict(DEFAULT_CASE, **params)),
+        'throughput': throughput,
+        'latency': {'p50': 0.5, 'p95': p95, 'p99': 2},
+        'lost': lost,
+        'peak_memory_mb': 100,
+        'worker_processes_peak_memory_mb': None,
+    }
+
+
+class TestBenchmark(TestCase):
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(percentile(values, 0.5), 50)
+        self.assertEqual(percentile(values, 0.99), 99)
+        self.assertEqual(percentile([3], 0.95), 3)
+        self.assertIsNone(percentile([], 0.5))
+
+    def test_compare(self):
+        baseline = make_result()
+        self.assertEqual(compare(make_result(throughput=95, p95=1.05), baseline), [])
+        self.assertEqual(len(compare(make_result(throughput=80, p95=2, lost=1), baseline)), 3)
+        # Results of other settings are not comparable, even with the same key
+        with self.assertRaises(ValueError):
+            compare(make_result(rekognition={'latency': 0.05}), baseline)
+
+    def test_run_case(self):
+        result = run_case({'events': 30, 'workers': 4, 'queue_size': 10, 'image_size': 1024, 'idle_timeout': 5,
+                           'rekognition': {'latency': 0.01}})
+        self.assertEqual(result['done'], 30)
+        self.assertEqual(result['lost'], 0)
+        self.assertEqual(len(result['latency']), 3)
+        self.assertGreater(result['rekognition']['calls']['SearchFacesByImage'], 0)
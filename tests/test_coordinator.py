@@ -0,0 +1,109 @@
+import os
+from tempfile import TemporaryDirectory
+from time import sleep, time
+from unittest import TestCase
+
+from rekognition_face_search.coordinator import SQLiteCoordinator, VXGLeaseCoordinator
+from rekognition_face_search.http_pool import HTTPPool
+from rekognition_face_search.vxg_client import VXGClient
+
+
+class SequentialHTTPPool(HTTPPool):
+    def __init__(self):
+        pass
+
+    def run_concurrently(self, calls: list) -> list:
+        return [call() for call in calls]
+
+
+class MockVXGClient(VXGClient):
+    def __init__(self):
+        self.http = SequentialHTTPPool()
+        self.metas = {}
+        self.reads = 0
+
+    def get_event_meta(self, event_id: int, tag: str) -> str:
+        self.reads += 1
+        return self.metas.get((event_id, tag))
+
+    def set_event_meta(self, event_id: int, tag: str, data: str = ''):
+        self.metas[(event_id, tag)] = data
+
+    def delete_event_meta(self, event_id: int, tag: str):
+        del self.metas[(event_id, tag)]
+
+
+class TestSQLiteCoordinator(TestCase):
+    def setUp(self):
+        super(TestSQLiteCoordinator, self).setUp()
+        self.tmp_dir = TemporaryDirectory()
+        self.path = os.path.join(self.tmp_dir.name, 'leases.db')
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+        super(TestSQLiteCoordinator, self).tearDown()
+
+    def test_claim(self):
+        first = SQLiteCoordinator(self.path, owner='first')
+        second = SQLiteCoordinator(self.path, owner='second')
+        self.assertEqual(first.claim([1, 2, 3]), [1, 2, 3])
+        self.assertEqual(second.claim([2, 3, 4, 5]), [4, 5])
+        # Own leases are kept
+        self.assertEqual(first.claim([3, 4]), [3])
+        self.assertEqual(second.stats(), {'owner': 'second', 'claimed': 2, 'lost': 2})
+        first.close()
+        second.close()
+
+    def test_expired_lease_reclaimed(self):
+        first = SQLiteCoordinator(self.path, owner='first', lease_ttl=0.1)
+        second = SQLiteCoordinator(self.path, owner='second')
+        self.assertEqual(first.claim([1]), [1])
+        self.assertEqual(second.claim([1]), [])
+        sleep(0.2)
+        self.assertEqual(second.claim([1]), [1])
+        self.assertEqual(first.claim([1]), [])
+        first.close()
+        second.close()
+
+
+class TestVXGLeaseCoordinator(TestCase):
+    def test_claim(self):
+        vxg = MockVXGClient()
+        first = VXGLeaseCoordinator(vxg, owner='first', settle=0)
+        second = VXGLeaseCoordinator(vxg, owner='second', settle=0, lease_ttl=0.1)
+        self.assertEqual(first.claim([1, 2]), [1, 2])
+        self.assertEqual(second.claim([1, 2, 3]), [3])
+        sleep(0.2)
+        # Lease of the second one is expired
+        self.assertEqual(first.claim([3]), [3])
+
+    def test_last_write_wins(self):
+        vxg = MockVXGClient()
+        first = VXGLeaseCoordinator(vxg, owner='first', settle=0, spread=2)
+        second = VXGLeaseCoordinator(vxg, owner='second', settle=0, spread=2)
+        set_event_meta = vxg.set_event_meta
+
+        def racing_set_event_meta(event_id, tag, data=''):
+            # Second one has checked the lease at the same time and writes its own right after the first one
+            set_event_meta(event_id, tag, data)
+            set_event_meta(event_id, tag, data.replace('first', 'second'))
+
+        vxg.set_event_meta = racing_set_event_meta
+        self.assertEqual(first.claim([1]), [])
+        vxg.set_event_meta = set_event_meta
+        self.assertEqual(second.claim([1]), [1])
+
+    def test_single_instance(self):
+        vxg = MockVXGClient()
+        coordinator = VXGLeaseCoordinator(vxg, owner='first', settle=10)
+        # Nobody else claims, so there's nothing to wait for and to read back
+        self.assertEqual(coordinator.claim([1, 2]), [1, 2])
+        self.assertEqual(vxg.reads, 2)
+        coordinator.release([1, 2, 3])
+        self.assertEqual(vxg.metas, {})
+        # Lease of another instance shows it's around
+        vxg.set_event_meta(3, VXGLeaseCoordinator.TAG_LEASE, '{"owner": "second", "expires": %f}' % (time() + 60))
+        coordinator.settle = 0
+        self.assertEqual(coordinator.claim([3, 4]), [4])
+        self.assertTrue(coordinator.contended())
+        self.assertEqual(vxg.reads, 5)
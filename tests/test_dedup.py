@@ -0,0 +1,74 @@
+from io import BytesIO
+from time import sleep
+from unittest import TestCase, skipUnless
+
+from rekognition_face_search.dedup import DedupCache, Image, hash_distance, image_hash
+
+
+def generate_image(shift: int = 0, noise: int = 0) -> bytes:
+    """
+    Generate gradient JPEG image
+    :param shift: shift gradient to the right
+    :param noise: add that much to every pixel
+    """
+    img = Image.new('L', (320, 240))
+    img.putdata([min(255, ((x + shift) * 255 // 320) + noise) for y in range(240) for x in range(320)])
+    out = BytesIO()
+    img.convert('RGB').save(out, format='JPEG', quality=90)
+    return out.getvalue()
+
+
+class TestImageHash(TestCase):
+    def test_not_an_image(self):
+        self.assertEqual(image_hash(b'not an image'), image_hash(b'not an image'))
+        self.assertNotEqual(image_hash(b'not an image'), image_hash(b'not an image either'))
+
+    @skipUnless(Image is not None, 'Pillow is required for perceptual hashing')
+    def test_near_identical(self):
+        self.assertLessEqual(hash_distance(image_hash(generate_image()), image_hash(generate_image(noise=3))), 6)
+
+    @skipUnless(Image is not None, 'Pillow is required for perceptual hashing')
+    def test_different(self):
+        reversed_img = Image.open(BytesIO(generate_image())).transpose(Image.FLIP_LEFT_RIGHT)
+        out = BytesIO()
+        reversed_img.save(out, format='JPEG')
+        self.assertGreater(hash_distance(image_hash(generate_image()), image_hash(out.getvalue())), 6)
+
+
+class TestDedupCache(TestCase):
+    def setUp(self):
+        super(TestDedupCache, self).setUp()
+        self.cache = DedupCache(max_size=3, ttl=10, max_distance=2)
+
+    def test_hit_and_miss(self):
+        faces = [{'FaceId': 'face'}]
+        self.cache.put(1, 0b1111, faces)
+        self.assertEqual(self.cache.get(1, 0b1100), faces)
+        self.assertIsNone(self.cache.get(1, 0b0000))
+        self.assertIsNone(self.cache.get(2, 0b1111))
+        self.assertEqual(self.cache.stats()['hits'], 1)
+        self.assertEqual(self.cache.stats()['misses'], 2)
+
+    def test_result_copied(self):
+        faces = [{'FaceId': 'face'}]
+        self.cache.put(1, 0, faces)
+        faces[0].pop('FaceId')
+        cached = self.cache.get(1, 0)
+        cached[0].pop('FaceId')
+        self.assertEqual(self.cache.get(1, 0), [{'FaceId': 'face'}])
+
+    def test_lru_eviction(self):
+        for key in range(3):
+            self.cache.put(key, 0, [])
+        self.cache.get(0, 0)
+        self.cache.put(3, 0, [])
+        self.assertIsNotNone(self.cache.get(0, 0))
+        self.assertIsNone(self.cache.get(1, 0))
+        self.assertEqual(self.cache.stats()['size'], 3)
+
+    def test_ttl(self):
+        self.cache.ttl = 0.05
+        self.cache.put(1, 0, [])
+        sleep(0.1)
+        self.assertIsNone(self.cache.get(1, 0))
+        self.assertEqual(self.cache.stats()['size'], 0)
@@ -0,0 +1,60 @@
+from time import sleep
+from threading import Thread
+from unittest import TestCase
+
+from rekognition_face_search.http_pool import HTTPPool
+from rekognition_face_search.web import WebApplication
+from tests.test_web import MockApplication
+
+
+class TestHTTPPool(TestCase):
+    def setUp(self):
+        super(TestHTTPPool, self).setUp()
+        self.web = WebApplication(MockApplication())
+        self.thread = Thread(target=self.web.routine)
+        self.thread.start()
+        sleep(0.1)
+        self.pool = HTTPPool(pool_size=2, pool_hosts=1)
+
+    def tearDown(self):
+        self.pool.close()
+        self.web.stop()
+        self.thread.join(timeout=1)
+        super(TestHTTPPool, self).tearDown()
+
+    def test_connection_reused(self):
+        url = 'http://127.0.0.1:%d/settings/' % self.web.port
+        for _ in range(5):
+            self.assertEqual(self.pool.get(url).status_code, 200)
+        stats = self.pool.stats()
+        self.assertEqual(stats['requests'], 5)
+        self.assertEqual(stats['errors'], 0)
+        host_stats = stats['hosts']['http://127.0.0.1:%d' % self.web.port]
+        self.assertEqual(host_stats['connections_opened'], 1)
+        self.assertEqual(host_stats['requests'], 5)
+
+    def test_no_keep_alive(self):
+        self.pool.close()
+        self.pool = HTTPPool(keep_alive=False)
+        url = 'http://127.0.0.1:%d/settings/' % self.web.port
+        for _ in range(2):
+            self.assertEqual(self.pool.get(url).status_code, 200)
+        self.assertEqual(self.pool.session.headers['Connection'], 'close')
+        self.assertFalse(self.pool.stats()['keep_alive'])
+
+    def test_run_concurrently(self):
+        url = 'http://127.0.0.1:%d/settings/' % self.web.port
+        results = self.pool.run_concurrently([lambda: self.pool.get(url).status_code for _ in range(4)])
+        self.assertEqual(results, [200] * 4)
+        # Helper threads have connections of their own on top of the callers ones
+        self.assertEqual(self.pool.adapter._pool_maxsize, self.pool.pool_size + self.pool.concurrency)
+        with self.assertRaises(ZeroDivisionError):
+            self.pool.run_concurrently([lambda: 1 // 0, lambda: 1])
+
+    def test_resize(self):
+        url = 'http://127.0.0.1:%d/settings/' % self.web.port
+        self.assertEqual(self.pool.get(url).status_code, 200)
+        self.pool.resize(5)
+        self.assertEqual(self.pool.adapter._pool_maxsize, 5 + self.pool.concurrency)
+        self.assertEqual(self.pool.get(url).status_code, 200)
+        self.assertEqual(self.pool.stats()['pool_size'], 5)
@@ -0,0 +1,111 @@
+import os
+from tempfile import TemporaryDirectory
+from time import time
+from unittest import TestCase
+
+from rekognition_face_search.aws_client import AWSClient
+from rekognition_face_search.hygiene import CollectionMaintainer, FaceAliasMap
+
+
+class MockAWSClient(AWSClient):
+    """
+    Collection of faces, faces with the same person ID match each other
+    """
+    def __init__(self, faces: dict):
+        self.faces = faces  # FaceId -> (person, confidence)
+        self.searched = []
+
+    def list_faces(self, next_token: str = None, max_results: int = 1000):
+        face_ids = sorted(self.faces)
+        start = int(next_token or 0)
+        resp = {'Faces': [{'FaceId': face_id, 'Confidence': self.faces[face_id][1]}
+                          for face_id in face_ids[start:start + 2]]}
+        if start + 2 < len(face_ids):
+            resp['NextToken'] = str(start + 2)
+        return resp
+
+    def search_faces(self, face_id: str, threshold: float, max_faces: int = 100):
+        self.searched.append(face_id)
+        person = self.faces[face_id][0]
+        return {'FaceMatches': [{'Similarity': 99, 'Face': {'FaceId': other_id}}
+                                for other_id, (other_person, _) in self.faces.items()
+                                if other_person == person and other_id != face_id]}
+
+    def delete_faces(self, face_ids: list):
+        for face_id in face_ids:
+            del self.faces[face_id]
+
+
+class TestFaceAliasMap(TestCase):
+    def test_apply_and_persist(self):
+        with TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'aliases.json')
+            aliases = FaceAliasMap(path)
+            aliases.touch('a', now=1)
+            aliases.touch('b', now=2)
+            aliases.merge('b', 'a')
+            aliases.merge('c', 'b')
+            faces = aliases.apply([{'FaceId': 'c', 'BoundingBox': {}}])
+            self.assertEqual(faces, [{'FaceId': 'a', 'BoundingBox': {}}])
+            aliases.save()
+
+            aliases = FaceAliasMap(path)
+            self.assertEqual(aliases.resolve('c'), 'a')
+            self.assertEqual(aliases.info('a')['first_seen'], 1)
+            self.assertGreater(aliases.info('a')['last_seen'], 2)
+            self.assertIsNone(aliases.info('b'))
+
+    def test_reload_aliases(self):
+        with TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'aliases.json')
+            maintained = FaceAliasMap(path)
+            maintained.save()
+            # Worker process keeps its own report times and takes merges made by the main process
+            aliases = FaceAliasMap(path)
+            aliases.touch('a', now=5)
+            aliases.touch('b', now=10)
+            self.assertFalse(aliases.reload_aliases())
+            maintained.merge('b', 'a')
+            maintained.save()
+            os.utime(path, (aliases.loaded_mtime + 1, aliases.loaded_mtime + 1))
+            self.assertTrue(aliases.reload_aliases())
+            self.assertEqual(aliases.resolve('b'), 'a')
+            self.assertEqual(aliases.seen_since(5), {'b': 10})
+            # Report times passed to the main process never go back
+            maintained.touch('a', now=20)
+            maintained.touch('a', now=5)
+            self.assertEqual(maintained.info('a')['last_seen'], 20)
+
+
+class TestCollectionMaintainer(TestCase):
+    def test_merge_duplicates(self):
+        aws = MockAWSClient({'a1': ('a', 99), 'a2': ('a', 99), 'a3': ('a', 99), 'b1': ('b', 99), 'c1': ('c', 50)})
+        aliases = FaceAliasMap()
+        aliases.touch('a2', now=1)
+        maintainer = CollectionMaintainer(aws, aliases)
+        summary = maintainer.run_once()
+        self.assertEqual(summary['faces'], 5)
+        self.assertEqual(summary['deleted'], 1)
+        self.assertEqual(summary['merged'], 2)
+        # The oldest face is kept
+        self.assertEqual(sorted(aws.faces), ['a2', 'b1'])
+        self.assertEqual(aliases.resolve('a1'), 'a2')
+        self.assertEqual(aliases.resolve('a3'), 'a2')
+        self.assertEqual(aliases.resolve('c1'), 'c1')
+
+        # Only new faces are searched
+        aws.faces['a4'] = ('a', 99)
+        aws.searched = []
+        maintainer.run_once()
+        self.assertEqual(aws.searched, ['a4'])
+        self.assertEqual(sorted(aws.faces), ['a2', 'b1'])
+        self.assertEqual(aliases.resolve('a4'), 'a2')
+
+    def test_delete_stale(self):
+        aws = MockAWSClient({'a1': ('a', 99), 'b1': ('b', 99)})
+        aliases = FaceAliasMap()
+        aliases.touch('a1', now=time() - 100)
+        maintainer = CollectionMaintainer(aws, aliases, stale_after=50)
+        maintainer.run_once()
+        self.assertEqual(sorted(aws.faces), ['b1'])
+        self.assertIsNone(aliases.info('a1'))
@@ -0,0 +1,128 @@
+import os
+from queue import Queue
+from tempfile import TemporaryDirectory
+from threading import Thread
+from time import sleep
+from unittest import TestCase
+
+import requests
+
+from rekognition_face_search.hygiene import FaceAliasMap
+from rekognition_face_search.identity_store import IdentityStore, format_time, parse_time
+from rekognition_face_search.web import WebApplication
+from rekognition_face_search.worker import Worker
+from tests.test_web import MockApplication
+from tests.test_worker import MockAWSClient, MockHTTPPool, MockVXGClient
+
+BOX = {'Left': 0.1, 'Top': 0.2, 'Width': 0.3, 'Height': 0.4}
+
+
+class TestIdentityStore(TestCase):
+    def setUp(self):
+        super(TestIdentityStore, self).setUp()
+        self.tmp_dir = TemporaryDirectory()
+        self.path = os.path.join(self.tmp_dir.name, 'identities.db')
+        self.store = IdentityStore(self.path, flush_size=100, flush_interval=60)
+
+    def tearDown(self):
+        self.store.close()
+        self.tmp_dir.cleanup()
+        super(TestIdentityStore, self).tearDown()
+
+    def test_time(self):
+        self.assertEqual(parse_time('2019-01-31T12:00:00'), 1548936000)
+        self.assertEqual(parse_time('2019-01-31T12:00:00Z'), 1548936000)
+        self.assertEqual(parse_time('1548936000.5'), 1548936000.5)
+        self.assertEqual(format_time(1548936000), '2019-01-31T12:00:00')
+        with self.assertRaises(ValueError):
+            parse_time('yesterday')
+
+    def test_lookups(self):
+        self.store.record('faces', {'id': 1, 'camid': 10, 'time': '2019-01-31T12:00:00'},
+                          [{'FaceId': 'a', 'BoundingBox': BOX, 'Similarity': 99.5}, {'FaceId': 'b'}])
+        self.store.record('faces', {'id': 2, 'camid': 10, 'time': '2019-01-31T12:05:00'}, [{'FaceId': 'a'}])
+        self.store.record('faces', {'id': 3, 'camid': 20, 'time': '2019-01-31T13:00:00'}, [{'FaceId': 'a'}])
+        self.store.record('other', {'id': 4, 'camid': 10, 'time': '2019-01-31T13:00:00'}, [{'FaceId': 'a'}])
+        self.store.record('faces', {'id': 5, 'camid': 10, 'time': '2019-01-31T13:00:00'}, [])
+
+        # Pending sightings are seen by lookups
+        events = self.store.events_for_face('faces', ['a'])
+        self.assertEqual([event['event_id'] for event in events], [3, 2, 1])
+        self.assertEqual(events[2], {'event_id': 1, 'face_id': 'a', 'camid': '10', 'time': '2019-01-31T12:00:00',
+                                     'bounding_box': BOX, 'similarity': 99.5})
+        events = self.store.events_for_face('faces', ['a'], start=parse_time('2019-01-31T12:05:00'),
+                                            end=parse_time('2019-01-31T13:00:00'))
+        self.assertEqual([event['event_id'] for event in events], [2])
+        self.assertEqual(len(self.store.events_for_face('faces', ['a'], limit=1)), 1)
+
+        faces = self.store.faces_on_camera('faces', '10')
+        self.assertEqual(faces, [
+            {'face_id': 'a', 'events': 2, 'first_seen': '2019-01-31T12:00:00', 'last_seen': '2019-01-31T12:05:00'},
+            {'face_id': 'b', 'events': 1, 'first_seen': '2019-01-31T12:00:00', 'last_seen': '2019-01-31T12:00:00'},
+        ])
+        self.assertEqual(self.store.faces_on_camera('other', 10)[0]['events'], 1)
+        self.assertEqual(self.store.stats()['recorded'], 5)
+
+    def test_replayed_event(self):
+        item = {'id': 1, 'camid': 10, 'time': '2019-01-31T12:00:00'}
+        self.store.record('faces', item, [{'FaceId': 'a'}])
+        self.store.flush()
+        self.store.record('faces', item, [{'FaceId': 'a'}])
+        self.store.close()
+        self.store = IdentityStore(self.path)
+        self.assertEqual(len(self.store.events_for_face('faces', ['a'])), 1)
+
+    def test_recorded_by_worker(self):
+        queue = Queue()
+        aws = MockAWSClient()
+        aws.collection_id = 'faces'
+        vxg = MockVXGClient()
+        worker = Worker(queue, aws, vxg, http=MockHTTPPool(), identities=self.store)
+        queue.put({'id': 1, 'url': 'http://dummy/a', 'camid': 10, 'time': '2019-01-31T12:00:00'})
+        worker.process()
+        self.assertEqual(self.store.events_for_face('faces', ['a'])[0]['similarity'], 99)
+
+
+class TestIdentityLookups(TestCase):
+    def setUp(self):
+        super(TestIdentityLookups, self).setUp()
+        self.tmp_dir = TemporaryDirectory()
+        app = MockApplication()
+        app.collection = 'faces'
+        app.aliases = FaceAliasMap()
+        app.identities = self.identities = IdentityStore(os.path.join(self.tmp_dir.name, 'identities.db'))
+        self.web = WebApplication(app)
+        self.thread = Thread(target=self.web.routine)
+        self.thread.start()
+        sleep(0.1)
+        self.url = 'http://127.0.0.1:%d' % self.web.port
+
+    def tearDown(self):
+        self.web.stop()
+        self.thread.join(timeout=1)
+        self.identities.close()
+        self.tmp_dir.cleanup()
+        super(TestIdentityLookups, self).tearDown()
+
+    def test_face_events(self):
+        identities = self.web.app.identities
+        identities.record('faces', {'id': 1, 'camid': 10, 'time': '2019-01-31T12:00:00'}, [{'FaceId': 'old'}])
+        identities.record('faces', {'id': 2, 'camid': 10, 'time': '2019-01-31T12:05:00'}, [{'FaceId': 'a'}])
+        self.web.app.aliases.merge('old', 'a')
+        resp = requests.get(self.url + '/faces/old/events/', params={'start': '2019-01-31T11:00:00'})
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.json()['face_id'], 'a')
+        self.assertEqual([event['event_id'] for event in resp.json()['events']], [2, 1])
+        resp = requests.get(self.url + '/faces/a/events/', params={'end': '2019-01-31T12:05:00'})
+        self.assertEqual([event['event_id'] for event in resp.json()['events']], [1])
+        resp = requests.get(self.url + '/faces/a/events/', params={'start': 'yesterday'})
+        self.assertEqual(resp.status_code, 400)
+
+    def test_camera_faces(self):
+        self.web.app.identities.record('faces', {'id': 1, 'camid': 10, 'time': '2019-01-31T12:00:00'},
+                                       [{'FaceId': 'a'}])
+        resp = requests.get(self.url + '/cameras/10/faces/')
+        self.assertEqual(resp.json(), {'camid': '10', 'faces': [
+            {'face_id': 'a', 'events': 1, 'first_seen': '2019-01-31T12:00:00', 'last_seen': '2019-01-31T12:00:00'}]})
+        self.web.app.identities = None
+        self.assertEqual(requests.get(self.url + '/cameras/10/faces/').status_code, 404)
@@ -0,0 +1,92 @@
+import asyncio
+from io import BytesIO
+from threading import Thread
+from time import sleep
+from unittest import TestCase, skipUnless
+
+from tornado.web import RequestHandler
+
+from rekognition_face_search.async_worker import AsyncVXGClient
+from rekognition_face_search.http_pool import HTTPPool
+from rekognition_face_search.image import Image, ImageError, ImageLoader
+from rekognition_face_search.web import WebApplication
+from tests.test_web import MockApplication
+
+
+def generate_image(width: int, height: int) -> bytes:
+    out = BytesIO()
+    Image.new('RGB', (width, height), color=(128, 64, 32)).save(out, format='JPEG')
+    return out.getvalue()
+
+
+class ChunkedHandler(RequestHandler):
+    """
+    Sends body of the given size without Content-Length
+    """
+    async def get(self, size: str):
+        for _ in range(int(size) // 1024):
+            self.write(b'x' * 1024)
+            await self.flush()
+
+
+class TestImageLoaderDownload(TestCase):
+    def setUp(self):
+        super(TestImageLoaderDownload, self).setUp()
+        self.web = WebApplication(MockApplication())
+        self.web.add_handlers(r'.*', [(r'/image/(\d+)', ChunkedHandler)])
+        self.thread = Thread(target=self.web.routine)
+        self.thread.start()
+        sleep(0.1)
+        self.http = HTTPPool()
+        self.loader = ImageLoader(self.http, max_bytes=64 * 1024)
+
+    def tearDown(self):
+        self.http.close()
+        self.web.stop()
+        self.thread.join(timeout=1)
+        super(TestImageLoaderDownload, self).tearDown()
+
+    def test_download(self):
+        self.assertEqual(len(self.loader.load('http://127.0.0.1:%d/image/%d' % (self.web.port, 32 * 1024))),
+                         32 * 1024)
+
+    def test_download_too_large(self):
+        with self.assertRaises(ImageError) as ctx:
+            self.loader.load('http://127.0.0.1:%d/image/%d' % (self.web.port, 1024 * 1024))
+        self.assertEqual(ctx.exception.reason, 'image_too_large')
+
+    def async_fetch(self, size: int, max_bytes: int) -> bytes:
+        vxg = AsyncVXGClient(server_uri='http://vxg', token='token', http=self.http)
+        url = 'http://127.0.0.1:%d/image/%d' % (self.web.port, size)
+        future = asyncio.run_coroutine_threadsafe(vxg.fetch(url, max_bytes=max_bytes, timeout=1),
+                                                  self.web.loop.asyncio_loop)
+        try:
+            return future.result(timeout=2)
+        finally:
+            self.web.loop.add_callback(vxg.close)
+
+    def test_async_download(self):
+        self.assertEqual(len(self.async_fetch(32 * 1024, 64 * 1024)), 32 * 1024)
+
+    def test_async_download_too_large(self):
+        with self.assertRaises(ImageError):
+            self.async_fetch(1024 * 1024, 64 * 1024)
+
+
+@skipUnless(Image is not None, 'Pillow is required for downscaling')
+class TestImageLoaderDownscale(TestCase):
+    def setUp(self):
+        super(TestImageLoaderDownscale, self).setUp()
+        self.loader = ImageLoader(None, max_side=640)
+
+    def test_downscale(self):
+        image = self.loader.downscale(generate_image(1920, 1080))
+        with Image.open(BytesIO(image)) as img:
+            self.assertEqual(img.size, (640, 360))
+
+    def test_small_image_untouched(self):
+        image = generate_image(640, 480)
+        self.assertIs(self.loader.downscale(image), image)
+
+    def test_not_an_image(self):
+        self.assertEqual(self.loader.downscale(b'not an image'), b'not an image')
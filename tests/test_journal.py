@@ -0,0 +1,45 @@
+import os
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+
+from rekognition_face_search.journal import WorkJournal
+
+
+class TestWorkJournal(TestCase):
+    def setUp(self):
+        super(TestWorkJournal, self).setUp()
+        self.tmp_dir = TemporaryDirectory()
+        self.path = os.path.join(self.tmp_dir.name, 'journal.db')
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+        super(TestWorkJournal, self).tearDown()
+
+    def test_recover_unfinished(self):
+        journal = WorkJournal(self.path, flush_size=2, flush_interval=60)
+        journal.enqueue([{'id': idx, 'url': 'http://dummy/%d' % idx, 'processing': True} for idx in range(5)])
+        journal.complete(0)
+        journal.complete(1)  # Flushed by size
+        journal.complete(2)  # Not flushed, lost by the crash
+        # Emulate crash: no close
+        journal.db.close()
+
+        journal = WorkJournal(self.path)
+        items = journal.recover()
+        self.assertEqual([item['id'] for item in items], [2, 3, 4])
+        self.assertEqual(items[0], {'id': 2, 'url': 'http://dummy/2', 'processing': True})
+        # Replayed once only
+        self.assertEqual(journal.recover(), [])
+        journal.close()
+
+    def test_close_flushes(self):
+        journal = WorkJournal(self.path, flush_size=100, flush_interval=60)
+        journal.enqueue([{'id': 1}, {'id': 2}])
+        journal.complete(1)
+        self.assertEqual(journal.stats()['pending'], 1)
+        journal.close()
+
+        journal = WorkJournal(self.path)
+        self.assertEqual(journal.recover(), [{'id': 2}])
+        self.assertEqual(journal.stats(), {'pending': 1, 'enqueued': 0, 'completed': 0, 'replayed': 1})
+        journal.close()
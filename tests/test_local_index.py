@@ -0,0 +1,121 @@
+import os
+from tempfile import TemporaryDirectory
+from unittest import TestCase, skipUnless
+
+from rekognition_face_search.local_index import LocalFaceIndex, LocalMatcher, StandInEmbeddingModel, np
+
+
+@skipUnless(np is not None, 'NumPy is required for the local face index')
+class TestLocalFaceIndex(TestCase):
+    def setUp(self):
+        super(TestLocalFaceIndex, self).setUp()
+        self.tmp_dir = TemporaryDirectory()
+        self.path = os.path.join(self.tmp_dir.name, 'index')
+        self.model = StandInEmbeddingModel()
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+        super(TestLocalFaceIndex, self).tearDown()
+
+    def test_search(self):
+        index = LocalFaceIndex(self.model.DIMENSIONS, capacity=2)
+        for idx in range(5):
+            index.add(self.model.embed(b'%d' % idx)[0], {'FaceId': str(idx)})
+        face, similarity, second_similarity = index.search(self.model.embed(b'3')[0])
+        self.assertEqual(face['FaceId'], '3')
+        self.assertAlmostEqual(similarity, 1, places=5)
+        self.assertLess(second_similarity, 0.5)
+
+    def test_persisted(self):
+        index = LocalFaceIndex(self.model.DIMENSIONS, path=self.path, capacity=2)
+        for idx in range(3):
+            index.add(self.model.embed(b'%d' % idx)[0], {'FaceId': str(idx)})
+        del index
+
+        index = LocalFaceIndex(self.model.DIMENSIONS, path=self.path)
+        self.assertEqual(len(index), 3)
+        face, similarity, _ = index.search(self.model.embed(b'2')[0])
+        self.assertEqual(face['FaceId'], '2')
+        self.assertAlmostEqual(similarity, 1, places=5)
+
+    def test_one_row_per_face(self):
+        index = LocalFaceIndex(self.model.DIMENSIONS, path=self.path)
+        for idx in range(3):
+            index.add(self.model.embed(b'%d' % idx)[0], {'FaceId': 'a', 'Similarity': idx})
+        self.assertEqual(len(index), 1)
+        face, similarity, second_similarity = index.search(self.model.embed(b'2')[0])
+        self.assertEqual(face, {'FaceId': 'a', 'Similarity': 2})
+        self.assertAlmostEqual(similarity, 1, places=5)
+        self.assertEqual(second_similarity, 0.0)
+        # Replaced rows are dropped from the files at load
+        index = LocalFaceIndex(self.model.DIMENSIONS, path=self.path)
+        self.assertEqual((len(index), index.records_count, len(index.vectors)), (1, 1, 1))
+        self.assertEqual(index.search(self.model.embed(b'2')[0])[0], {'FaceId': 'a', 'Similarity': 2})
+
+    def test_appended_rows_loaded(self):
+        # Files written when every learned face was appended, the last line is written partially
+        vectors = np.lib.format.open_memmap(self.path + '.npy', mode='w+', dtype=np.float32,
+                                            shape=(4, self.model.DIMENSIONS))
+        for idx in range(3):
+            vectors[idx] = self.model.embed(b'%d' % idx)[0]
+        vectors.flush()
+        del vectors
+        with open(self.path + '.jsonl', 'w') as f:
+            f.write('{"FaceId": "a"}\n{"FaceId": "b"}\n{"FaceId": "a"}\n{"FaceId"')
+        index = LocalFaceIndex(self.model.DIMENSIONS, path=self.path)
+        self.assertEqual(sorted(index.rows), ['a', 'b'])
+        self.assertEqual(index.search(self.model.embed(b'2')[0])[0], {'FaceId': 'a'})
+        self.assertEqual(index.search(self.model.embed(b'1')[0])[0], {'FaceId': 'b'})
+        index.add(self.model.embed(b'3')[0], {'FaceId': 'c'})
+        index = LocalFaceIndex(self.model.DIMENSIONS, path=self.path)
+        self.assertEqual(len(index), 3)
+
+    def test_evicted(self):
+        index = LocalFaceIndex(self.model.DIMENSIONS, path=self.path, max_size=2)
+        index.add(self.model.embed(b'a')[0], {'FaceId': 'a'})
+        index.add(self.model.embed(b'b')[0], {'FaceId': 'b'})
+        # Matched recently, so "b" is evicted for the new face
+        self.assertEqual(index.search(self.model.embed(b'a')[0])[0]['FaceId'], 'a')
+        index.add(self.model.embed(b'c')[0], {'FaceId': 'c'})
+        self.assertEqual(len(index), 2)
+        self.assertIn(index.search(self.model.embed(b'b')[0])[0]['FaceId'], ('a', 'c'))
+        index = LocalFaceIndex(self.model.DIMENSIONS, path=self.path, max_size=2)
+        self.assertEqual(sorted(index.rows), ['a', 'c'])
+        self.assertEqual(index.search(self.model.embed(b'c')[0])[0]['FaceId'], 'c')
+
+    def test_search_many(self):
+        index = LocalFaceIndex(self.model.DIMENSIONS, capacity=16)
+        for idx in range(100):
+            index.add(self.model.embed(b'%d' % idx)[0], {'FaceId': str(idx)})
+        face, similarity, second_similarity = index.search(self.model.embed(b'42')[0])
+        self.assertEqual(face['FaceId'], '42')
+        self.assertAlmostEqual(similarity, 1, places=5)
+        self.assertLess(second_similarity, 0.5)
+
+
+@skipUnless(np is not None, 'NumPy is required for the local face index')
+class TestLocalMatcher(TestCase):
+    def setUp(self):
+        super(TestLocalMatcher, self).setUp()
+        self.model = StandInEmbeddingModel()
+        self.matcher = LocalMatcher(self.model, LocalFaceIndex(self.model.DIMENSIONS))
+
+    def test_match_learned(self):
+        embedding = self.matcher.embed(b'image')
+        self.assertIsNone(self.matcher.match(embedding))
+        self.matcher.learn(embedding, [{'FaceId': 'face', 'BoundingBox': {'Top': 0.5}}])
+        self.assertEqual(self.matcher.match(self.matcher.embed(b'image')),
+                         [{'FaceId': 'face', 'BoundingBox': {'Top': 0.5}}])
+        self.assertIsNone(self.matcher.match(self.matcher.embed(b'another image')))
+        self.assertEqual(self.matcher.stats(), {'size': 1, 'hits': 1, 'misses': 2})
+
+    def test_many_faces_not_learned(self):
+        embedding = self.matcher.embed(b'image')
+        self.matcher.learn(embedding, [{'FaceId': 'face1'}, {'FaceId': 'face2'}])
+        self.assertIsNone(self.matcher.match(embedding))
+
+    def test_not_confident(self):
+        vector = self.model.embed(b'image')[0]
+        self.matcher.index.add(vector, {'FaceId': 'face1'})
+        self.matcher.index.add(vector, {'FaceId': 'face2'})
+        self.assertIsNone(self.matcher.match((vector, None)))
@@ -0,0 +1,70 @@
+from unittest import TestCase
+
+from rekognition_face_search.metrics import Counter, Gauge, Histogram, Registry
+
+
+class TestMetrics(TestCase):
+    def setUp(self):
+        self.registry = Registry()
+
+    def test_counter(self):
+        counter = Counter('test_total', 'Test counter', ('result',), registry=self.registry)
+        counter.labels('face').inc()
+        counter.labels('face').inc(2)
+        counter.labels('no "face"').inc()
+        text = self.registry.expose()
+        self.assertIn('# TYPE test_total counter\n', text)
+        self.assertIn('test_total{result="face"} 3\n', text)
+        self.assertIn('test_total{result="no \\"face\\""} 1\n', text)
+
+    def test_gauge(self):
+        gauge = Gauge('test_gauge', 'Test gauge', registry=self.registry)
+        gauge.inc()
+        gauge.inc()
+        gauge.dec()
+        self.assertIn('test_gauge 1\n', self.registry.expose())
+        gauge.set_function(lambda: 42)
+        self.assertIn('test_gauge 42\n', self.registry.expose())
+
+    def test_histogram(self):
+        histogram = Histogram('test_seconds', 'Test histogram', ('stage',), buckets=(0.1, 1),
+                              registry=self.registry)
+        histogram.labels('poll').observe(0.05)
+        histogram.labels('poll').observe(0.5)
+        histogram.labels('poll').observe(5)
+        with histogram.labels('write').time():
+            pass
+        text = self.registry.expose()
+        self.assertIn('test_seconds_bucket{stage="poll",le="0.1"} 1\n', text)
+        self.assertIn('test_seconds_bucket{stage="poll",le="1"} 2\n', text)
+        self.assertIn('test_seconds_bucket{stage="poll",le="+Inf"} 3\n', text)
+        self.assertIn('test_seconds_sum{stage="poll"} 5.55\n', text)
+        self.assertIn('test_seconds_count{stage="poll"} 3\n', text)
+        self.assertIn('test_seconds_count{stage="write"} 1\n', text)
+
+    def test_merge_remote(self):
+        counter = Counter('test_total', 'Test counter', ('result',), registry=self.registry)
+        histogram = Histogram('test_seconds', 'Test histogram', buckets=(1,), registry=self.registry)
+        gauge = Gauge('test_gauge', 'Test gauge', registry=self.registry)
+        age = Gauge('test_age', 'Test gauge', registry=self.registry, aggregate='max')
+        counter.labels('face').inc()
+        histogram.observe(0.5)
+        gauge.inc()
+        age.set(3)
+        remote = Registry()
+        Counter('test_total', 'Test counter', ('result',), registry=remote).labels('face').inc(2)
+        Histogram('test_seconds', 'Test histogram', buckets=(1,), registry=remote).observe(2)
+        Gauge('test_gauge', 'Test gauge', registry=remote).inc(2)
+        Gauge('test_age', 'Test gauge', registry=remote).set(1)
+        self.registry.merge_remote('worker', remote.snapshot())
+        text = self.registry.expose()
+        self.assertIn('test_total{result="face"} 3\n', text)
+        self.assertIn('test_seconds_bucket{le="1"} 1\n', text)
+        self.assertIn('test_seconds_count 2\n', text)
+        self.assertIn('test_gauge 3\n', text)
+        self.assertIn('test_age 3\n', text)
+        # Totals of a finished process are kept, its gauges are not
+        self.registry.retire_remote('worker')
+        text = self.registry.expose()
+        self.assertIn('test_total{result="face"} 3\n', text)
+        self.assertIn('test_gauge 1\n', text)
@@ -0,0 +1,142 @@
+import asyncio
+from io import BytesIO
+from queue import Queue
+from threading import Lock
+from time import sleep
+from unittest import TestCase, skipUnless
+
+from rekognition_face_search.async_worker import AsyncWorker
+from rekognition_face_search.aws_client import AWSClient
+from rekognition_face_search.multi_face import Image, MultiFaceSearch, merge_faces
+from rekognition_face_search.quality import FaceRejected
+from rekognition_face_search.worker import Worker
+
+COLORS = {(255, 0, 0): 'red', (0, 255, 0): 'green', (0, 0, 255): 'blue'}
+
+
+def make_frame(colors: list) -> bytes:
+    """
+    Frame with a "face" of the given color at every quarter of the width
+    """
+    img = Image.new('RGB', (400, 100))
+    for idx, color in enumerate(colors):
+        img.paste(color, (idx * 100 + 25, 25, idx * 100 + 75, 75))
+    out = BytesIO()
+    img.save(out, format='PNG')
+    return out.getvalue()
+
+
+class MockAWSClient(AWSClient):
+    """
+    Detects faces pasted by `make_frame`, knows the red one only
+    """
+    def __init__(self, faces: int, delay: float = 0):
+        self.faces = faces
+        self.delay = delay
+        self.lock = Lock()
+        self.running = 0
+        self.max_running = 0
+        self.calls = []
+
+    def detect_faces(self, image):
+        self.calls.append('detect_faces')
+        return {'FaceDetails': [{'Confidence': 99,
+                                 'BoundingBox': {'Left': idx * 0.25 + 0.0625, 'Top': 0.25, 'Width': 0.125,
+                                                 'Height': 0.5}}
+                                for idx in range(self.faces)] + [
+                                {'Confidence': 50, 'BoundingBox': {'Left': 0, 'Top': 0, 'Width': 0.9, 'Height': 0.9}}]}
+
+    def search_face(self, image):
+        with self.lock:
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+        sleep(self.delay)
+        with self.lock:
+            self.running -= 1
+        with Image.open(BytesIO(image)) as img:
+            # The biggest face of the whole frame is the first one
+            pixel = img.convert('RGB').getpixel((50, 50) if img.width == 400 else (img.width // 2, img.height // 2))
+        # Crops are JPEG, so colors are close but not exact
+        color = min(COLORS.items(), key=lambda item: sum(abs(a - b) for a, b in zip(item[0], pixel)))[1]
+        self.calls.append(('search_face', color))
+        if color == 'red':
+            return {'FaceMatches': [{'Similarity': 99, 'Face': {'FaceId': 'alice'}}]}
+        return {'FaceMatches': []}
+
+    def index_faces(self, image, quality_filter: str = None, max_faces: int = None):
+        self.calls.append(('index_faces', max_faces))
+        with Image.open(BytesIO(image)) as img:
+            frame = img.width == 400
+        unindexed = [{'Reasons': ['EXCEEDS_MAX_FACES']}] * (self.faces - 1) if frame and max_faces == 1 else []
+        return {'FaceRecords': [{'Face': {'FaceId': 'new'}}], 'UnindexedFaces': unindexed}
+
+
+@skipUnless(Image, 'Pillow is required for multi-face search')
+class TestMultiFaceSearch(TestCase):
+    def test_recognize(self):
+        aws = MockAWSClient(faces=2)
+        worker = Worker(Queue(), aws, None, multi_face=MultiFaceSearch(aws, pool_size=4, detect_always=True))
+        faces = worker.recognize(make_frame([(255, 0, 0), (0, 0, 255)]))
+        self.assertEqual([face['FaceId'] for face in faces], ['alice', 'new'])
+        self.assertEqual(faces[1]['BoundingBox']['Left'], 0.3125)
+        self.assertIn(('index_faces', 1), aws.calls)
+        self.assertEqual(worker.multi_face.stats()['crops'], 2)
+
+    def test_single_and_no_face(self):
+        aws = MockAWSClient(faces=1)
+        multi_face = MultiFaceSearch(aws)
+        self.assertIsNone(multi_face.split(make_frame([(255, 0, 0)])))
+        aws.faces = 0
+        self.assertEqual(multi_face.split(make_frame([])), ([], []))
+        self.assertEqual(multi_face.stats()['multi_face_frames'], 0)
+
+    def test_per_frame_limit(self):
+        aws = MockAWSClient(faces=4, delay=0.05)
+        worker = Worker(Queue(), aws, None, multi_face=MultiFaceSearch(aws, per_frame=2, pool_size=10,
+                                                                       detect_always=True))
+        faces = worker.recognize(make_frame([(255, 0, 0), (0, 255, 0), (0, 0, 255), (255, 0, 0)]))
+        self.assertEqual(aws.max_running, 2)
+        # Both red faces are the same person
+        self.assertEqual(sorted(face['FaceId'] for face in faces), ['alice', 'new'])
+
+    def test_detect_when_indexing_shows_more_faces(self):
+        aws = MockAWSClient(faces=2)
+        worker = Worker(Queue(), aws, None, multi_face=MultiFaceSearch(aws, pool_size=4))
+        faces = worker.recognize(make_frame([(0, 0, 255), (255, 0, 0)]))
+        self.assertEqual([face['FaceId'] for face in faces], ['new', 'alice'])
+        # The biggest face is searched and indexed once, from the whole frame
+        self.assertEqual(aws.calls.count(('search_face', 'blue')), 1)
+        self.assertEqual(aws.calls.count('detect_faces'), 1)
+        self.assertEqual(aws.calls.count(('index_faces', 1)), 1)
+
+    def test_no_detect(self):
+        aws = MockAWSClient(faces=2)
+        worker = Worker(Queue(), aws, None, multi_face=MultiFaceSearch(aws, pool_size=4))
+        # Familiar biggest face
+        self.assertEqual(worker.recognize(make_frame([(255, 0, 0), (0, 0, 255)])), [{'FaceId': 'alice',
+                                                                                    'Similarity': 99}])
+        # New single face
+        aws.faces = 1
+        self.assertEqual(worker.recognize(make_frame([(0, 0, 255)])), [{'FaceId': 'new'}])
+        self.assertNotIn('detect_faces', aws.calls)
+
+    def test_async(self):
+        aws = MockAWSClient(faces=2)
+        worker = AsyncWorker(Queue(), aws, None, aws_concurrency=4, multi_face=MultiFaceSearch(aws, pool_size=4))
+        loop = asyncio.new_event_loop()
+        try:
+            faces = loop.run_until_complete(worker.recognize(make_frame([(0, 0, 255), (255, 0, 0)])))
+        finally:
+            loop.close()
+            worker.aws_executor.shutdown()
+        self.assertEqual([face['FaceId'] for face in faces], ['new', 'alice'])
+        self.assertEqual(aws.calls.count('detect_faces'), 1)
+
+
+class TestMergeFaces(TestCase):
+    def test_rejected(self):
+        boxes = [{'Left': 0}, {'Left': 1}]
+        self.assertEqual(merge_faces(boxes, [FaceRejected('face_blurry'), [{'FaceId': 'a'}]]),
+                         [{'FaceId': 'a', 'BoundingBox': {'Left': 1}}])
+        with self.assertRaises(FaceRejected):
+            merge_faces(boxes, [FaceRejected('face_blurry'), []])
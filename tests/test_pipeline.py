@@ -0,0 +1,64 @@
+from queue import Queue
+from threading import Event
+from time import sleep
+from unittest import TestCase
+
+from rekognition_face_search.image import ImageLoader
+from rekognition_face_search.pipeline import PipelineStage, PipelineWorker
+
+from .test_worker import MockAWSClient, MockHTTPPool, MockVXGClient
+
+
+class TestPipelineStage(TestCase):
+    def test_backpressure_and_drain(self):
+        in_queue = Queue()
+        middle_queue = Queue(maxsize=2)
+        results = []
+        release = Event()
+
+        def slow(task):
+            release.wait()
+            results.append(task)
+
+        need_stop = Event()
+        first = PipelineStage('first', lambda task: task, in_queue, middle_queue, workers=2, need_stop=need_stop)
+        second = PipelineStage('second', slow, middle_queue, workers=1, upstream=first)
+        for idx in range(10):
+            in_queue.put(idx)
+        first.start()
+        second.start()
+        sleep(0.3)
+        # Slow stage holds one task, its queue is full and the first stage is blocked with two more
+        self.assertEqual(middle_queue.qsize(), 2)
+        self.assertEqual(in_queue.qsize(), 5)
+
+        need_stop.set()
+        release.set()
+        for thread in first.threads + second.threads:
+            thread.join(timeout=1)
+        self.assertTrue(second.finished())
+        # Whatever was taken from the input is finished, the rest stays at the input queue
+        self.assertEqual(sorted(results + list(in_queue.queue)), list(range(10)))
+        self.assertEqual(second.stats()['processed'], len(results))
+
+
+class TestPipelineWorker(TestCase):
+    def test_process(self):
+        queue = Queue()
+        aws = MockAWSClient()
+        vxg = MockVXGClient()
+        http = MockHTTPPool()
+        worker = PipelineWorker(queue, aws, vxg, download_workers=2, recognize_workers=2, write_workers=2,
+                                stage_queue_size=2, loader=ImageLoader(http, max_bytes=3))
+        for idx in range(10):
+            queue.put({'id': idx, 'url': 'http://dummy/%s' % ('abcd' if idx == 5 else idx)})
+        worker.start()
+        queue.join()
+        worker.stop()
+        for thread in worker.threads:
+            thread.join(timeout=1)
+        self.assertEqual(vxg.events[5], 'image_too_large')
+        for idx in range(10):
+            if idx != 5:
+                self.assertEqual(vxg.events[idx], [{'FaceId': str(idx), 'Similarity': 99}])
+        self.assertEqual(worker.stats()['write']['processed'], 10)
@@ -1,11 +1,15 @@
 from datetime import datetime, timedelta
+import os
 from queue import Queue, Empty
 from random import randint
 from time import sleep
+from tempfile import TemporaryDirectory
 from threading import Thread
 from unittest import TestCase
 
-from rekognition_face_search.poller import PollingImageSource
+from rekognition_face_search.coordinator import SQLiteCoordinator
+from rekognition_face_search.journal import WorkJournal
+from rekognition_face_search.poller import AdaptivePollController, PollCursor, PollingImageSource
 from rekognition_face_search.vxg_client import VXGClient
 
 
@@ -17,9 +21,21 @@ class MockVXGClient(VXGClient):
         self.events = {}
         self.delay = 0
 
-    def get_unprocessed_events(self, limit) -> (list, int):
+    def get_unprocessed_events(self, limit: int, offset: int = 0, end: str = None) -> (list, int):
         sleep(self.delay)
-        return list(self.events.values())[:limit], len(self.events)
+        events = [event for event in self.events.values() if not event.get('meta')]
+        if end:
+            events = sorted((event for event in events if event['time'] < end), key=lambda event: event['time'])
+        return events[offset:offset + limit], len(events)
+
+    def get_events_since(self, start: str, limit: int, offset: int = 0) -> (list, int):
+        sleep(self.delay)
+        events = sorted((event for event in self.events.values() if start is None or event['time'] >= start),
+                        key=lambda event: event['time'])
+        return events[offset:offset + limit], len(events)
+
+    def get_latest_event(self) -> dict:
+        return max(self.events.values(), key=lambda event: event['time'], default=None)
 
     def set_event_processing(self, event_id: int):
         sleep(self.delay)
@@ -124,6 +140,143 @@ class TestPollingImageSourcePollEvents(TestCase):
             pass
 
 
+class TestPollingImageSourceCursor(TestCase):
+    def setUp(self):
+        super(TestPollingImageSourceCursor, self).setUp()
+        self.tmp_dir = TemporaryDirectory()
+        self.cursor_path = os.path.join(self.tmp_dir.name, 'cursor.json')
+        self.vxg_client = MockVXGClient()
+        self.queue = Queue()
+        self.src = PollingImageSource(self.vxg_client, self.queue, cursor=PollCursor(self.cursor_path),
+                                      mark_processing=False)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+        super(TestPollingImageSourceCursor, self).tearDown()
+
+    def queued_ids(self) -> list:
+        ids = []
+        while not self.queue.empty():
+            item = self.queue.get_nowait()
+            self.assertFalse(item['processing'])
+            ids.append(item['id'])
+        return ids
+
+    def test_backfill_then_incremental(self):
+        self.vxg_client.events = generate_events(PollingImageSource.MAX_EVENT_BATCH * 2 + 1)
+        # Server time is taken, not the local one
+        self.vxg_client.events[0]['time'] = (datetime.utcnow() + timedelta(hours=1)).isoformat()
+        self.src.backfill()
+        self.assertEqual(self.src.cursor.time, self.vxg_client.events[0]['time'])
+        self.assertEqual(sorted(self.queued_ids()), sorted(self.vxg_client.events)[1:])
+        # The newest event is polled incrementally
+        self.src.poll_events()
+        self.assertEqual(self.queued_ids(), [0])
+        # Nothing new, so nothing is queued and processing tag is never set
+        self.assertFalse(self.src.poll_events())
+        self.assertEqual(self.queue.qsize(), 0)
+        for event in self.vxg_client.events.values():
+            self.assertNotIn('meta', event)
+
+        new_events = generate_events(PollingImageSource.MAX_EVENT_BATCH + 1)
+        for idx, event in new_events.items():
+            event['id'] = 1000 + idx
+            event['time'] = (datetime.utcnow() + timedelta(hours=1, seconds=idx + 1)).isoformat()
+            event['thumb']['time'] = event['time']
+            self.vxg_client.events[event['id']] = event
+        self.assertTrue(self.src.poll_events())
+        self.assertFalse(self.src.poll_events())
+        self.assertEqual(sorted(self.queued_ids()), sorted(event['id'] for event in new_events.values()))
+
+    def test_backfill_no_events(self):
+        self.src.backfill()
+        self.assertIsNone(self.src.cursor.time)
+        self.vxg_client.events = generate_events(3)
+        self.src.poll_events()
+        self.assertEqual(sorted(self.queued_ids()), [0, 1, 2])
+
+    def test_cursor_persisted(self):
+        self.vxg_client.events = generate_events(3)
+        self.src.cursor.time = min(event['time'] for event in self.vxg_client.events.values())
+        self.src.poll_events()
+        self.assertEqual(len(self.queued_ids()), 3)
+
+        src = PollingImageSource(self.vxg_client, self.queue, cursor=PollCursor(self.cursor_path),
+                                 mark_processing=False)
+        self.assertEqual(src.cursor.time, self.vxg_client.events[0]['time'])
+        self.assertEqual(src.cursor.ids, {0})
+        self.assertFalse(src.poll_events())
+        self.assertEqual(self.queue.qsize(), 0)
+
+    def test_same_time_over_batch(self):
+        events = generate_events(PollingImageSource.MAX_EVENT_BATCH + 10)
+        self.src.cursor.time = events[0]['time']
+        for event in events.values():
+            event['time'] = self.src.cursor.time
+        self.vxg_client.events = events
+        self.assertTrue(self.src.poll_events())
+        self.assertFalse(self.src.poll_events())
+        self.assertEqual(sorted(self.queued_ids()), sorted(events))
+        self.assertFalse(self.src.poll_events())
+        self.assertEqual(self.queue.qsize(), 0)
+
+
+class TestPollingImageSourceJournal(TestCase):
+    def setUp(self):
+        super(TestPollingImageSourceJournal, self).setUp()
+        self.tmp_dir = TemporaryDirectory()
+        self.journal_path = os.path.join(self.tmp_dir.name, 'journal.db')
+        self.vxg_client = MockVXGClient()
+        self.vxg_client.events = generate_events(5)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+        super(TestPollingImageSourceJournal, self).tearDown()
+
+    def test_replay_after_crash(self):
+        journal = WorkJournal(self.journal_path)
+        src = PollingImageSource(self.vxg_client, Queue(), journal=journal)
+        src.poll_events()
+        self.assertEqual(journal.stats()['pending'], 5)
+        for event in self.vxg_client.events.values():
+            self.assertIn(VXGClient.TAG_PROCESSING, event['meta'])
+        journal.complete(0)
+        journal.close()
+
+        # Tagged events are never polled again, but the journal has them
+        queue = Queue()
+        src = PollingImageSource(self.vxg_client, queue, journal=WorkJournal(self.journal_path))
+        src.replay()
+        self.assertFalse(src.poll_events())
+        ids = []
+        while not queue.empty():
+            item = queue.get_nowait()
+            self.assertEqual(item['url'], 'http://dummy.s3.amazonaws.com/%d' % item['id'])
+            ids.append(item['id'])
+        self.assertEqual(sorted(ids), [1, 2, 3, 4])
+        src.journal.close()
+
+
+class TestPollingImageSourceCoordinator(TestCase):
+    def test_instances_share_events(self):
+        with TemporaryDirectory() as tmp_dir:
+            vxg_client = MockVXGClient()
+            vxg_client.events = generate_events(PollingImageSource.MAX_EVENT_BATCH)
+            path = os.path.join(tmp_dir, 'leases.db')
+            first = PollingImageSource(vxg_client, Queue(), coordinator=SQLiteCoordinator(path, owner='first'))
+            second = PollingImageSource(vxg_client, Queue(), coordinator=SQLiteCoordinator(path, owner='second'))
+            # Both instances got the same batch before any of them tagged it
+            events, _ = vxg_client.get_unprocessed_events(limit=PollingImageSource.MAX_EVENT_BATCH)
+            first.put_events(events[:15])
+            second.put_events(events[5:])
+            self.assertEqual(first.queue.qsize(), 15)
+            self.assertEqual(second.queue.qsize(), 5)
+            ids = [item['id'] for item in list(first.queue.queue) + list(second.queue.queue)]
+            self.assertEqual(sorted(ids), sorted(vxg_client.events))
+            first.coordinator.close()
+            second.coordinator.close()
+
+
 class TestPollingImageSourceRoutine(TestCase):
     def setUp(self):
         super(TestPollingImageSourceRoutine, self).setUp()
@@ -142,3 +295,47 @@ class TestPollingImageSourceRoutine(TestCase):
 
     # TODO: test various interruption scenarios, ie in the middle of server requests, awaiting while queue will be freed
     # TODO: test VXG Server connectivity issues
+
+
+class TestAdaptivePollController(TestCase):
+    def setUp(self):
+        super(TestAdaptivePollController, self).setUp()
+        self.controller = AdaptivePollController(min_batch=20, max_batch=100, min_interval=0.1, max_interval=2,
+                                                 base_interval=0.5)
+
+    def test_burst_grows_batch(self):
+        self.controller.update(1000, True, 0, 200)
+        self.assertEqual(self.controller.batch, 40)
+        self.assertEqual(self.controller.target_batch, 100)
+        self.assertEqual(self.controller.interval, 0.1)
+        self.controller.update(1000, True, 0, 200)
+        self.controller.update(1000, True, 0, 200)
+        self.assertEqual(self.controller.batch, 100)
+
+    def test_batch_limited_by_queue(self):
+        self.controller.update(1000, True, 150, 200)
+        self.assertEqual(self.controller.batch, 40)
+        self.assertEqual(self.controller.target_batch, 50)
+        self.controller.update(1000, True, 190, 200)
+        self.assertEqual(self.controller.batch, 20)
+        self.assertEqual(self.controller.interval, 0.5)
+
+    def test_idle_backoff(self):
+        intervals = []
+        for _ in range(5):
+            self.controller.update(0, False, 0, 200)
+            intervals.append(self.controller.interval)
+        self.assertEqual(intervals, [1, 2, 2, 2, 2])
+        self.controller.update(5, True, 0, 200)
+        self.assertEqual(self.controller.interval, 0.1)
+        self.assertEqual(self.controller.batch, 20)
+
+    def test_poll_events_updates_controller(self):
+        vxg_client = MockVXGClient()
+        vxg_client.events = generate_events(50)
+        queue = Queue(maxsize=100)
+        src = PollingImageSource(vxg_client, queue, controller=self.controller)
+        self.assertTrue(src.poll_events())
+        self.assertEqual(queue.qsize(), 20)
+        self.assertEqual(src.batch_size, 40)
+        self.assertEqual(self.controller.status()['backlog'], 50)
@@ -0,0 +1,60 @@
+from io import BytesIO
+from random import Random
+from unittest import TestCase, skipUnless
+from unittest.mock import patch
+
+from rekognition_face_search.quality import FaceRejected, Image, ImageFilter, QualityGate
+
+FACE_BOX = {'Left': 0.25, 'Top': 0.25, 'Width': 0.5, 'Height': 0.5}
+
+
+def make_image(size: int, blur: float = 0) -> bytes:
+    rnd = Random(1)
+    img = Image.new('L', (size, size))
+    img.putdata([rnd.choice((0, 255)) for _ in range(size * size)])
+    if blur:
+        img = img.filter(ImageFilter.GaussianBlur(blur))
+    out = BytesIO()
+    img.save(out, format='PNG')
+    return out.getvalue()
+
+
+class TestQualityGate(TestCase):
+    def test_check_indexed(self):
+        gate = QualityGate()
+        gate.check_indexed({'FaceRecords': [{'Face': {'FaceId': 'a'}}], 'UnindexedFaces': [{'Reasons': ['SMALL']}]})
+        with self.assertRaises(FaceRejected) as ctx:
+            gate.check_indexed({'FaceRecords': [], 'UnindexedFaces': [{'Reasons': ['LOW_SHARPNESS', 'SMALL_FACE']},
+                                                                     {'Reasons': ['LOW_SHARPNESS']}]})
+        self.assertEqual(ctx.exception.reason, 'quality_filter:LOW_SHARPNESS,SMALL_FACE')
+        self.assertEqual(gate.stats()['rejected'], {'quality_filter': 1})
+
+    @skipUnless(Image, 'Pillow is required for local checks')
+    def test_face_size(self):
+        gate = QualityGate(min_face_size=40)
+        gate.check(make_image(100), {'SearchedFaceBoundingBox': FACE_BOX})
+        with self.assertRaises(FaceRejected) as ctx:
+            gate.check(make_image(60), {'SearchedFaceBoundingBox': FACE_BOX})
+        self.assertEqual(ctx.exception.reason, 'face_too_small')
+
+    @skipUnless(Image, 'Pillow is required for local checks')
+    def test_sharpness(self):
+        gate = QualityGate(min_sharpness=100)
+        gate.check(make_image(100), {'SearchedFaceBoundingBox': FACE_BOX})
+        with self.assertRaises(FaceRejected) as ctx:
+            gate.check(make_image(100, blur=3), {'SearchedFaceBoundingBox': FACE_BOX})
+        self.assertEqual(ctx.exception.reason, 'face_blurry')
+        self.assertEqual(gate.stats(), {'local_checks': True, 'checked': 2, 'rejected': {'face_blurry': 1}})
+
+    def test_no_face_box(self):
+        gate = QualityGate(min_face_size=40, min_sharpness=100)
+        gate.check(b'not an image', {})
+        gate.check(b'not an image', {'SearchedFaceBoundingBox': FACE_BOX})
+
+    def test_no_pillow(self):
+        with patch('rekognition_face_search.quality.Image', None):
+            gate = QualityGate(min_face_size=40)
+        # Shown at /status/ rather than passing every face unnoticed
+        self.assertFalse(gate.stats()['local_checks'])
+        gate.check(b'not an image', {'SearchedFaceBoundingBox': FACE_BOX})
+        self.assertFalse(QualityGate().stats()['local_checks'])
@@ -0,0 +1,274 @@
+import asyncio
+from queue import Queue
+from threading import Thread
+from time import monotonic, sleep
+from unittest import TestCase
+from unittest.mock import Mock
+
+from rekognition_face_search.async_worker import AsyncWorker
+from rekognition_face_search.image import ImageError, ImageLoader
+from rekognition_face_search.pipeline import PipelineWorker
+from rekognition_face_search.resilience import (CircuitBreaker, CircuitOpen, DependencyError, RetryQueue,
+                                                create_breakers)
+from rekognition_face_search.worker import Worker
+from tests.test_async_worker import MockAsyncVXGClient
+from tests.test_worker import MockAWSClient, MockHTTPPool, MockVXGClient
+
+
+class FlakyAWSClient(MockAWSClient):
+    """
+    Fails the first `failures` searches
+    """
+    def __init__(self, failures: int):
+        super(FlakyAWSClient, self).__init__()
+        self.failures = failures
+
+    def search_face(self, image):
+        if self.failures > 0:
+            self.failures -= 1
+            self.calls.append('failed')
+            raise ConnectionError('AWS Rekognition is down')
+        return super(FlakyAWSClient, self).search_face(image)
+
+
+def fail():
+    raise ConnectionError('down')
+
+
+class TestCircuitBreaker(TestCase):
+    def test_open_and_close(self):
+        breaker = CircuitBreaker('vxg', failure_threshold=2, reset_timeout=0.1)
+        for _ in range(2):
+            with self.assertRaises(DependencyError) as ctx:
+                breaker.call(fail)
+            self.assertIsInstance(ctx.exception.__cause__, ConnectionError)
+        self.assertEqual(breaker.stats()['state'], CircuitBreaker.OPEN)
+        with self.assertRaises(CircuitOpen) as ctx:
+            breaker.call(lambda: 1)
+        self.assertGreater(ctx.exception.retry_in, 0)
+        self.assertEqual(ctx.exception.reason, 'vxg_unavailable')
+        sleep(0.15)
+        # Failed probe opens the circuit again right away
+        with self.assertRaises(DependencyError):
+            breaker.call(fail)
+        with self.assertRaises(CircuitOpen):
+            breaker.call(lambda: 1)
+        sleep(0.15)
+        self.assertEqual(breaker.call(lambda: 1), 1)
+        stats = breaker.stats()
+        self.assertEqual(stats['state'], CircuitBreaker.CLOSED)
+        self.assertEqual(stats['opened'], 1)
+        self.assertEqual(stats['rejected'], 2)
+
+    def test_ignored_errors(self):
+        breaker = create_breakers(failure_threshold=1)['download']
+
+        def too_large():
+            raise ImageError('image_too_large')
+
+        for _ in range(3):
+            with self.assertRaises(ImageError):
+                breaker.call(too_large)
+        self.assertEqual(breaker.stats()['state'], CircuitBreaker.CLOSED)
+
+
+class TestRetryQueue(TestCase):
+    def test_requeue(self):
+        queue = Queue()
+        retry = RetryQueue(queue, max_attempts=3, base_delay=0.05)
+        thread = Thread(target=retry.routine)
+        thread.start()
+        try:
+            error = DependencyError('rekognition', 'rekognition_failed: ConnectionError')
+            self.assertTrue(retry.schedule({'id': 1}, error))
+            item = queue.get(timeout=1)
+            self.assertEqual(item['attempts'], 1)
+            self.assertIn('queued_at', item)
+            self.assertTrue(retry.schedule(item, error))
+            item = queue.get(timeout=1)
+            self.assertFalse(retry.schedule(item, error))
+            # Calls not made at all are not attempts
+            started = monotonic()
+            self.assertTrue(retry.schedule(item, CircuitOpen('rekognition', 0.2)))
+            self.assertEqual(queue.get(timeout=1)['attempts'], 2)
+            self.assertGreaterEqual(monotonic() - started, 0.2)
+        finally:
+            retry.stop()
+            thread.join(timeout=2)
+        self.assertEqual(retry.stats()['given_up'], 1)
+        self.assertEqual(retry.stats()['requeued'], 3)
+
+    def test_full(self):
+        retry = RetryQueue(Queue(), max_size=1, base_delay=10)
+        self.assertTrue(retry.schedule({'id': 1}, ValueError()))
+        self.assertFalse(retry.schedule({'id': 2}, ValueError()))
+        self.assertEqual(retry.pending(), 1)
+
+
+class TestWorkerFailures(TestCase):
+    def setUp(self):
+        super(TestWorkerFailures, self).setUp()
+        self.queue = Queue()
+        self.vxg = MockVXGClient()
+        self.breakers = create_breakers(failure_threshold=2, reset_timeout=0.2)
+        self.retry = RetryQueue(self.queue, max_attempts=3, base_delay=0.01)
+        self.retry_thread = Thread(target=self.retry.routine)
+        self.retry_thread.start()
+
+    def tearDown(self):
+        self.retry.stop()
+        self.retry_thread.join(timeout=2)
+        super(TestWorkerFailures, self).tearDown()
+
+    def create_worker(self, aws: MockAWSClient) -> Worker:
+        worker = Worker(self.queue, aws, self.vxg, http=MockHTTPPool(), breakers=self.breakers, retry=self.retry)
+        worker.QUEUE_TIMEOUT = 1
+        return worker
+
+    def test_retried(self):
+        aws = FlakyAWSClient(failures=1)
+        worker = self.create_worker(aws)
+        self.queue.put({'id': 0, 'url': 'http://dummy/a'})
+        started = monotonic()
+        worker.process()
+        self.assertNotIn(0, self.vxg.events)
+        worker.process()
+        self.assertEqual(self.vxg.events[0], [{'FaceId': 'a', 'Similarity': 99}])
+        self.assertEqual(aws.calls, ['failed', 'search_face'])
+        # Worker doesn't sleep on failures
+        self.assertLess(monotonic() - started, 0.5)
+
+    def test_given_up(self):
+        aws = FlakyAWSClient(failures=3)
+        worker = self.create_worker(aws)
+        self.breakers['rekognition'].failure_threshold = 10
+        self.queue.put({'id': 0, 'url': 'http://dummy/a'})
+        for _ in range(3):
+            worker.process()
+        self.assertEqual(self.vxg.events[0], 'rekognition_failed: ConnectionError')
+        self.assertTrue(self.queue.empty())
+        self.assertEqual(self.retry.pending(), 0)
+
+    def test_circuit_open(self):
+        aws = FlakyAWSClient(failures=2)
+        worker = self.create_worker(aws)
+        for idx in range(4):
+            self.queue.put({'id': idx, 'url': 'http://dummy/%d' % idx})
+        # Two failures open the circuit, other events are not sent to AWS Rekognition until it's probed again
+        for _ in range(4):
+            worker.process()
+        self.assertEqual(aws.calls, ['failed', 'failed'])
+        self.assertEqual(self.breakers['rekognition'].stats()['state'], CircuitBreaker.OPEN)
+        self.assertEqual(self.vxg.events, {})
+        # Events are retried as the probe closes the circuit
+        for _ in range(10):
+            if len(self.vxg.events) == 4:
+                break
+            worker.process()
+        self.assertEqual(sorted(self.vxg.events), [0, 1, 2, 3])
+        self.assertEqual(aws.calls.count('failed'), 2)
+        self.assertEqual(self.breakers['rekognition'].stats()['state'], CircuitBreaker.CLOSED)
+
+    def test_local_failures(self):
+        worker = self.create_worker(MockAWSClient())
+        worker.local = Mock(embed=Mock(side_effect=ValueError('cannot decode')))
+        for idx in range(3):
+            self.queue.put({'id': idx, 'url': 'http://dummy/%d' % idx})
+            worker.process()
+        # Failures of local processing are not AWS Rekognition ones
+        stats = self.breakers['rekognition'].stats()
+        self.assertEqual((stats['state'], stats['failures']), (CircuitBreaker.CLOSED, 0))
+
+    def test_no_retry(self):
+        worker = Worker(self.queue, FlakyAWSClient(failures=1), self.vxg, http=MockHTTPPool())
+        self.queue.put({'id': 0, 'url': 'http://dummy/a'})
+        worker.process()
+        self.assertEqual(self.vxg.events[0], 'failed: ConnectionError')
+
+
+class FlakyAsyncVXGClient(MockAsyncVXGClient):
+    """
+    Fails the first `failures` writes
+    """
+    def __init__(self, failures: int):
+        super(FlakyAsyncVXGClient, self).__init__()
+        self.failures = failures
+
+    async def set_event_processed(self, event_id: int, faces: list, clear_processing: bool = False):
+        if self.failures > 0:
+            self.failures -= 1
+            raise ConnectionError('VXG Server is down')
+        await super(FlakyAsyncVXGClient, self).set_event_processed(event_id, faces, clear_processing)
+
+    async def set_event_processed_error(self, event_id: int, message: str, clear_processing: bool = False):
+        self.events[event_id] = message
+
+
+class TestOtherModesFailures(TestCase):
+    """
+    Asyncio and pipeline workers retry and give up failed events the same way
+    """
+    def setUp(self):
+        super(TestOtherModesFailures, self).setUp()
+        self.queue = Queue()
+        self.retry = RetryQueue(self.queue, max_attempts=2, base_delay=0.01)
+        self.retry_thread = Thread(target=self.retry.routine)
+        self.retry_thread.start()
+
+    def tearDown(self):
+        self.retry.stop()
+        self.retry_thread.join(timeout=2)
+        super(TestOtherModesFailures, self).tearDown()
+
+    def run_async(self, vxg: MockAsyncVXGClient, count: int):
+        worker = AsyncWorker(self.queue, FlakyAWSClient(failures=0), vxg, retry=self.retry,
+                             breakers=create_breakers(failure_threshold=10))
+        worker.QUEUE_TIMEOUT = 0.05
+
+        async def stop_when_processed():
+            while len(vxg.events) < count:
+                await asyncio.sleep(0.01)
+            worker.stop()
+
+        async def run():
+            await asyncio.wait_for(asyncio.gather(worker.routine(), stop_when_processed()), timeout=5)
+
+        loop = asyncio.new_event_loop()
+        try:
+            loop.run_until_complete(run())
+        finally:
+            loop.close()
+
+    def test_async_retried(self):
+        vxg = FlakyAsyncVXGClient(failures=1)
+        self.queue.put({'id': 0, 'url': 'http://dummy/a'})
+        self.run_async(vxg, 1)
+        self.assertEqual(vxg.events[0], [{'FaceId': 'http://dummy/a', 'Similarity': 99}])
+        self.assertEqual(self.retry.stats()['requeued'], 1)
+
+    def test_async_given_up(self):
+        vxg = FlakyAsyncVXGClient(failures=2)
+        self.queue.put({'id': 0, 'url': 'http://dummy/a'})
+        self.run_async(vxg, 1)
+        self.assertEqual(vxg.events[0], 'vxg_failed: ConnectionError')
+
+    def test_pipeline(self):
+        aws = FlakyAWSClient(failures=3)
+        vxg = MockVXGClient()
+        worker = PipelineWorker(self.queue, aws, vxg, download_workers=1, recognize_workers=1, write_workers=1,
+                                loader=ImageLoader(MockHTTPPool()), retry=self.retry)
+        self.queue.put({'id': 0, 'url': 'http://dummy/a'})
+        self.queue.put({'id': 1, 'url': 'http://dummy/b'})
+        worker.start()
+        try:
+            started = monotonic()
+            while len(vxg.events) < 2 and monotonic() - started < 5:
+                sleep(0.01)
+        finally:
+            worker.stop()
+            for thread in worker.threads:
+                thread.join(timeout=1)
+        # Three failures: one event fails both attempts and is given up, the other one succeeds at the second one
+        self.assertEqual(sorted(vxg.events), [0, 1])
+        self.assertEqual(sorted(str(result) for result in vxg.events.values())[1], 'failed: ConnectionError')
+        self.assertEqual(self.retry.stats()['given_up'], 1)
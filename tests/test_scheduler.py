@@ -0,0 +1,95 @@
+from datetime import datetime, timedelta
+from queue import Empty
+from unittest import TestCase
+
+from rekognition_face_search.scheduler import FairQueue, event_timestamp
+
+
+def make_item(event_id: int, camid: int, age: float = 0) -> dict:
+    return {'id': event_id, 'url': 'http://dummy/%d' % event_id, 'camid': camid,
+            'time': (datetime.utcnow() - timedelta(seconds=age)).isoformat()}
+
+
+def drain(queue: FairQueue) -> list:
+    ids = []
+    while not queue.empty():
+        ids.append(queue.get_nowait()['id'])
+        queue.task_done()
+    return ids
+
+
+class TestFairQueue(TestCase):
+    def test_round_robin(self):
+        queue = FairQueue()
+        for idx in range(6):
+            queue.put(make_item(idx, camid=1))
+        queue.put(make_item(10, camid=2))
+        queue.put(make_item(11, camid=2))
+        self.assertEqual(queue.stats()['cameras'], {'1': 6, '2': 2})
+        self.assertEqual(drain(queue), [0, 10, 1, 11, 2, 3, 4, 5])
+        self.assertEqual(queue.stats()['cameras'], {})
+
+    def test_weights(self):
+        queue = FairQueue(weights={'2': 3})
+        for idx in range(8):
+            queue.put(make_item(idx, camid=1))
+            queue.put(make_item(10 + idx, camid=2))
+        ids = drain(queue)
+        self.assertEqual(sum(event_id >= 10 for event_id in ids[:8]), 6)
+        # Order within a camera is kept
+        self.assertEqual([event_id for event_id in ids if event_id < 10], list(range(8)))
+
+    def test_deadline_defer(self):
+        queue = FairQueue(deadline=60)
+        queue.put(make_item(0, camid=1, age=120))
+        queue.put(make_item(1, camid=1, age=90))
+        queue.put(make_item(2, camid=1))
+        queue.put(make_item(3, camid=2))
+        ids = drain(queue)
+        self.assertEqual(sorted(ids[:2]), [2, 3])
+        self.assertEqual(ids[2:], [0, 1])
+        self.assertEqual(queue.stats()['deferred'], 2)
+
+    def test_stale_share(self):
+        queue = FairQueue(deadline=60)
+        for idx in range(4):
+            queue.put(make_item(idx, camid=1, age=120))
+        for idx in range(10, 20):
+            queue.put(make_item(idx, camid=2))
+        # Stale events are served in turn with fresh ones instead of waiting for all of them
+        self.assertEqual([queue.get_nowait()['id'] for _ in range(6)], [10, 0, 11, 1, 12, 2])
+        queue = FairQueue(deadline=60, stale_weight=0)
+        queue.put(make_item(0, camid=1, age=120))
+        queue.put(make_item(1, camid=1))
+        queue.put(make_item(2, camid=2))
+        self.assertEqual(drain(queue)[-1], 0)
+
+    def test_deadline_drop(self):
+        dropped = []
+        queue = FairQueue(deadline=60, drop_expired=True, on_drop=dropped.append)
+        queue.put(make_item(0, camid=1, age=120))
+        queue.put(make_item(1, camid=1))
+        self.assertEqual(queue.get(timeout=0.1)['id'], 1)
+        queue.task_done()
+        # Released apart from getting events
+        self.assertEqual(dropped, [])
+        self.assertEqual(queue.stats()['dropped_pending'], 1)
+        queue.step()
+        self.assertEqual([item['id'] for item in dropped], [0])
+        self.assertEqual(queue.stats()['dropped'], 1)
+        # Dropped events are done, so nothing is left to wait for
+        queue.join()
+        queue.put(make_item(2, camid=1, age=120))
+        with self.assertRaises(Empty):
+            queue.get(timeout=0.1)
+
+    def test_maxsize(self):
+        queue = FairQueue(maxsize=2)
+        queue.put(make_item(0, camid=1))
+        queue.put(make_item(1, camid=2))
+        self.assertTrue(queue.full())
+        self.assertEqual(queue.qsize(), 2)
+
+    def test_event_timestamp(self):
+        self.assertEqual(event_timestamp({'time': '2020-01-01T00:00:00.000000'}), 1577836800)
+        self.assertEqual(event_timestamp({'time': None, 'queued_at': 5}), 5)
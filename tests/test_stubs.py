@@ -0,0 +1,62 @@
+from unittest import TestCase
+
+from botocore.exceptions import ClientError
+
+from rekognition_face_search.aws_client import AWSClient
+from rekognition_face_search.stubs import Fault, StubRekognition, StubServers, StubVXGServer
+from rekognition_face_search.throttle import RateLimiter
+from rekognition_face_search.vxg_client import VXGClient
+
+
+class TestFault(TestCase):
+    def test_outcome(self):
+        self.assertEqual(Fault(error_rate=1).outcome(), 'error')
+        self.assertEqual(Fault(throttle_rate=1).outcome(), 'throttle')
+        fault = Fault(max_rate=2)
+        self.assertEqual([fault.outcome() for _ in range(3)], ['ok', 'ok', 'throttle'])
+        self.assertEqual(Fault(latency=0.1).delay(), 0.1)
+        self.assertLessEqual(Fault(latency=0.1, jitter=0.1).delay(), 0.2)
+
+
+class TestStubRekognition(TestCase):
+    """
+    Real boto3 client against the stand-in
+    """
+    def setUp(self):
+        self.vxg = StubVXGServer(events=2, people=1, face_share=1, image_size=100)
+        self.rekognition = StubRekognition()
+        self.servers = StubServers(self.vxg, self.rekognition)
+        self.servers.start()
+        self.vxg.add_event(1)
+
+    def tearDown(self):
+        self.servers.stop()
+
+    def test_search_and_index(self):
+        aws = AWSClient('faces', 'key', 'secret', endpoint_url=self.rekognition.uri)
+        aws.ensure_collection_exist()
+        image = self.vxg.image(1)
+        self.assertEqual(aws.search_face(image)['FaceMatches'], [])
+        face_id = aws.index_faces(image)['FaceRecords'][0]['Face']['FaceId']
+        self.assertEqual(aws.search_face(image)['FaceMatches'][0]['Face']['FaceId'], face_id)
+        self.assertEqual(self.rekognition.stats()['faces'], 1)
+
+    def test_throttling(self):
+        self.rekognition.fault = Fault(throttle_rate=1)
+        aws = AWSClient('faces', 'key', 'secret', endpoint_url=self.rekognition.uri,
+                        limiters={'search': RateLimiter('search', rate=100, max_concurrency=1, retries=1,
+                                                        base_delay=0.01)})
+        with self.assertRaises(ClientError) as ctx:
+            aws.search_face(self.vxg.image(1))
+        self.assertEqual(ctx.exception.response['Error']['Code'], 'ThrottlingException')
+        self.assertEqual(self.rekognition.stats()['throttled'], 2)
+
+    def test_events_with_meta(self):
+        vxg = VXGClient(self.vxg.uri, 'token')
+        vxg.set_event_processed(1, [])
+        events, total = vxg.get_events_since('2000-01-01T00:00:00', limit=10, include_meta=True)
+        self.assertEqual(total, 1)
+        self.assertEqual(events[0]['meta'], {VXGClient.TAG_NO_FACE: ''})
+        self.assertEqual(vxg.get_events_since('2000-01-01T00:00:00', limit=10, end='2000-01-02T00:00:00'), ([], 0))
+        self.vxg.add_event(2)
+        self.assertEqual(vxg.get_latest_event()['id'], 2)
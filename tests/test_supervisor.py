@@ -0,0 +1,114 @@
+import os
+from queue import Queue
+from tempfile import TemporaryDirectory
+from threading import Thread
+from time import sleep, time
+from unittest import TestCase
+
+from rekognition_face_search.hygiene import FaceAliasMap
+from rekognition_face_search.metrics import REGISTRY
+from rekognition_face_search.supervisor import ProcessSupervisor
+
+CONFIG = {
+    'server_uri': 'http://127.0.0.1:1',
+    'token': 'token',
+    'collection': 'collection',
+    'access_key': 'key',
+    'secret_key': 'secret',
+    'threshold': 0.8,
+    'workers': 2,
+    'aws_pool_size': 3,
+    'grace_stop_timeout': 2,
+    'http_pool_size': 3,
+    'http_pool_hosts': 2,
+    'http_keep_alive': True,
+    'http_pool_block': False,
+    'aws_rates': {'search': 25, 'index': 25},
+    'aws_concurrency': 2,
+    'aws_retries': 1,
+    'image': {'max_bytes': 1024, 'timeout': 1, 'max_side': 0, 'quality': 90},
+    'gate': {'min_face_size': 0, 'min_sharpness': 0, 'quality_filter': 'AUTO', 'max_faces': None},
+    'dedup': None,
+    'journal_path': None,
+    'identity_store_path': None,
+    'multi_face': None,
+    'endpoint_url': None,
+    'breakers': {'failure_threshold': 5, 'reset_timeout': 30},
+    'retry': {'max_attempts': 3, 'base_delay': 1, 'max_delay': 10, 'max_size': 100},
+    'aliases': None,
+}
+
+
+class TestProcessSupervisor(TestCase):
+    def test_forward(self):
+        queue = Queue()
+        supervisor = ProcessSupervisor(queue, 0, CONFIG, queue_size=3)
+        for idx in range(5):
+            queue.put({'id': idx})
+        supervisor.start()
+        sleep(0.5)
+        # Process queue is full, the rest waits at the local queue
+        self.assertEqual(supervisor.forwarded_count, 3)
+        self.assertEqual(queue.qsize(), 1)
+        self.assertEqual([supervisor.process_queue.get(timeout=1)['id'] for _ in range(3)], [0, 1, 2])
+        supervisor.stop()
+        supervisor.join(timeout=1)
+        self.assertFalse(supervisor.forward_thread.is_alive())
+
+    def test_processes_report_stats(self):
+        supervisor = ProcessSupervisor(Queue(), 2, CONFIG)
+        supervisor.start()
+        try:
+            for _ in range(100):
+                if len(supervisor.process_stats) == 2:
+                    break
+                sleep(0.1)
+            stats = supervisor.stats()
+            self.assertEqual(stats['processes'], 2)
+            self.assertEqual(stats['alive'], 2)
+            self.assertEqual(sorted(stats['per_process']), [0, 1])
+            self.assertEqual(stats['per_process'][0]['workers'], 2)
+            self.assertNotIn('metrics', stats['per_process'][0])
+            self.assertEqual(stats['per_process'][0]['breakers']['rekognition']['state'], 'closed')
+            self.assertEqual(stats['per_process'][0]['retry']['pending'], 0)
+            self.assertIn(ProcessSupervisor.metrics_source(0), REGISTRY.remote)
+        finally:
+            supervisor.stop()
+            supervisor.join(timeout=5)
+        self.assertEqual(supervisor.stats()['alive'], 0)
+        self.assertNotIn(ProcessSupervisor.metrics_source(0), REGISTRY.remote)
+
+    def test_seen_faces(self):
+        aliases = FaceAliasMap(None)
+        supervisor = ProcessSupervisor(Queue(), 0, CONFIG, aliases=aliases)
+        now = time()
+        supervisor.stats_queue.put((0, {'metrics': {}, 'events': {}, 'seen_faces': {'a': now}}))
+        thread = Thread(target=supervisor.collect_stats)
+        thread.start()
+        for _ in range(50):
+            if supervisor.process_stats:
+                break
+            sleep(0.1)
+        supervisor.need_stop.set()
+        thread.join(timeout=5)
+        # Faces seen by worker processes are not stale for the collection maintainer
+        self.assertEqual(aliases.info('a')['last_seen'], now)
+        self.assertNotIn('seen_faces', supervisor.process_stats[0])
+
+    def test_processes_load_aliases(self):
+        with TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'aliases.json')
+            aliases = FaceAliasMap(path)
+            aliases.merge('b', 'a')
+            aliases.save()
+            supervisor = ProcessSupervisor(Queue(), 1, dict(CONFIG, aliases={'path': path}), aliases=aliases)
+            supervisor.start()
+            try:
+                for _ in range(100):
+                    if supervisor.process_stats:
+                        break
+                    sleep(0.1)
+                self.assertEqual(supervisor.process_stats[0]['aliases']['aliases'], 1)
+            finally:
+                supervisor.stop()
+                supervisor.join(timeout=5)
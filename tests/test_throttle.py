@@ -0,0 +1,100 @@
+from threading import Thread
+from time import monotonic, sleep
+from unittest import TestCase
+
+from botocore.exceptions import ClientError, EndpointConnectionError
+
+from rekognition_face_search.throttle import AIMDLimiter, RateLimiter, TokenBucket
+
+
+def throttling_error() -> ClientError:
+    return ClientError({'Error': {'Code': 'ThrottlingException', 'Message': 'Rate exceeded'}}, 'SearchFacesByImage')
+
+
+class TestTokenBucket(TestCase):
+    def test_rate(self):
+        bucket = TokenBucket(rate=100, burst=5)
+        started = monotonic()
+        for _ in range(15):
+            bucket.acquire()
+        self.assertGreaterEqual(monotonic() - started, 0.09)
+
+
+class TestAIMDLimiter(TestCase):
+    def test_decrease_and_increase(self):
+        limiter = AIMDLimiter(8, min_limit=1, max_limit=8)
+        limiter.acquire()
+        limiter.release(throttled=True)
+        self.assertEqual(limiter.limit, 4)
+        for _ in range(4):
+            limiter.acquire()
+            limiter.release()
+        self.assertAlmostEqual(limiter.limit, 5, delta=0.2)
+        for _ in range(100):
+            limiter.acquire()
+            limiter.release()
+        self.assertEqual(limiter.limit, 8)
+
+    def test_limit_concurrency(self):
+        limiter = AIMDLimiter(2)
+        limiter.acquire()
+        limiter.acquire()
+        acquired = []
+        thread = Thread(target=lambda: acquired.append(limiter.acquire()))
+        thread.start()
+        sleep(0.05)
+        self.assertEqual(acquired, [])
+        limiter.release()
+        thread.join(timeout=1)
+        self.assertEqual(len(acquired), 1)
+
+
+class TestRateLimiter(TestCase):
+    def setUp(self):
+        super(TestRateLimiter, self).setUp()
+        self.limiter = RateLimiter('search', rate=1000, max_concurrency=4, retries=2, base_delay=0.001)
+        self.calls = 0
+
+    def flaky(self, failures: int, error: Exception = None):
+        self.calls += 1
+        if self.calls <= failures:
+            raise error or throttling_error()
+        return 'ok'
+
+    def test_retry_throttled(self):
+        self.assertEqual(self.limiter.call(self.flaky, 2), 'ok')
+        self.assertEqual(self.calls, 3)
+        stats = self.limiter.stats()
+        self.assertEqual(stats['throttles'], 2)
+        self.assertEqual(stats['calls'], 3)
+        self.assertEqual(stats['concurrency_limit'], 2)
+        self.assertEqual(stats['in_flight'], 0)
+
+    def test_give_up(self):
+        with self.assertRaises(ClientError):
+            self.limiter.call(self.flaky, 3)
+        self.assertEqual(self.calls, 3)
+
+    def test_no_retry_other_errors(self):
+        with self.assertRaises(ValueError):
+            self.limiter.call(self.flaky, 1, ValueError())
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(self.limiter.stats()['throttles'], 0)
+
+    def test_retry_transient_errors(self):
+        server_error = ClientError({'Error': {'Code': 'InternalServerError', 'Message': 'Internal error'},
+                                    'ResponseMetadata': {'HTTPStatusCode': 500}}, 'SearchFacesByImage')
+        self.assertEqual(self.limiter.call(self.flaky, 1, server_error), 'ok')
+        self.calls = 0
+        self.assertEqual(self.limiter.call(self.flaky, 2, EndpointConnectionError(endpoint_url='http://aws')), 'ok')
+        stats = self.limiter.stats()
+        self.assertEqual((stats['transient_errors'], stats['throttles']), (3, 0))
+        # Service is fine, so the concurrency isn't lowered
+        self.assertEqual(stats['concurrency_limit'], 4)
+        # Client errors are not retried
+        self.calls = 0
+        bad_request = ClientError({'Error': {'Code': 'InvalidParameterException', 'Message': 'Bad image'},
+                                   'ResponseMetadata': {'HTTPStatusCode': 400}}, 'SearchFacesByImage')
+        with self.assertRaises(ClientError):
+            self.limiter.call(self.flaky, 1, bad_request)
+        self.assertEqual(self.calls, 1)
@@ -1,8 +1,11 @@
 import os
 from random import random
+from threading import Lock
+from time import sleep
 from unittest import TestCase, skipUnless
 from uuid import uuid4
 
+from rekognition_face_search.http_pool import HTTPPool
 from rekognition_face_search.vxg_client import VXGClient
 
 VXG_TEST_CREDENTIALS = {
@@ -23,6 +26,64 @@ def generate_sample_faces(count: int) -> list:
     } for _ in range(count)]
 
 
+class MockResponse:
+    def raise_for_status(self):
+        pass
+
+
+class MockHTTPPool(HTTPPool):
+    """
+    Records requests instead of sending them
+    """
+    def __init__(self, delay: float = 0):
+        super(MockHTTPPool, self).__init__(pool_size=10)
+        self.delay = delay
+        self.requests = []
+        self.requests_lock = Lock()
+
+    def request(self, method: str, url: str, **kwargs):
+        sleep(self.delay)
+        with self.requests_lock:
+            self.requests.append((method, url.split('?')[0], kwargs.get('json')))
+        return MockResponse()
+
+
+class TestVXGClientSetEventProcessed(TestCase):
+    def setUp(self):
+        super(TestVXGClientSetEventProcessed, self).setUp()
+        self.http = MockHTTPPool()
+        self.vxg = VXGClient(server_uri='http://vxg', token='token', http=self.http)
+
+    def tearDown(self):
+        self.http.close()
+        super(TestVXGClientSetEventProcessed, self).tearDown()
+
+    def test_has_faces(self):
+        sample_faces = generate_sample_faces(3)
+        self.vxg.set_event_processed(1, sample_faces, clear_processing=True)
+        self.assertEqual(len(self.http.requests), 5)
+        posted_tags = [data['tag'] for method, _, data in self.http.requests if method == 'POST']
+        self.assertIn(VXGClient.TAG_HAS_FACE, posted_tags)
+        for face in sample_faces:
+            self.assertIn('FaceId', face)
+            self.assertIn(VXGClient.TAG_FACE_FMT % face['FaceId'], posted_tags)
+        self.assertIn(('DELETE', 'http://vxg/api/v2/storage/events/1/meta/%s/' % VXGClient.TAG_PROCESSING, None),
+                      self.http.requests)
+
+    def test_no_faces_keep_processing(self):
+        self.vxg.set_event_processed(1, [])
+        self.assertEqual(self.http.requests, [
+            ('POST', 'http://vxg/api/v2/storage/events/1/meta/', {'data': '', 'tag': VXGClient.TAG_NO_FACE})
+        ])
+
+    def test_processing_cleared_after_service_tag(self):
+        self.http.delay = 0.01
+        self.vxg.set_event_processed(1, generate_sample_faces(5), clear_processing=True)
+        methods_and_tags = [(method, data['tag'] if data else None) for method, _, data in self.http.requests]
+        self.assertLess(methods_and_tags.index(('POST', VXGClient.TAG_HAS_FACE)),
+                        methods_and_tags.index(('DELETE', None)))
+
+
 @skipUnless(all((VXG_TEST_CREDENTIALS['server_uri'],
                  VXG_TEST_CREDENTIALS['token'])),
             'Valid credentials from environment variables are required to run integration tests')
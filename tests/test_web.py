@@ -13,6 +13,12 @@ class MockApplication:
         self.collection = None
         self.access_key = None
         self.secret_key = None
+        self.threshold = 0.8
+        self.workers_count = 20
+        self.applied = []
+
+    def apply_settings(self, settings: dict):
+        self.applied.append(settings)
 
 
 class TestWebApplicationRoutine(TestCase):
@@ -27,3 +33,29 @@ class TestWebApplicationRoutine(TestCase):
         self.assertEqual(resp.status_code, 200)
         self.web.stop()
         self.thread.join(timeout=1)
+
+    def test_web_application_apply_settings(self):
+        self.thread.start()
+        sleep(0.1)
+        form = {'server_uri': 'http://vxg', 'token': 'token', 'collection': 'faces', 'access_key': 'key',
+                'secret_key': 'secret', 'threshold': '90', 'workers_count': '5'}
+        resp = requests.post('http://127.0.0.1:%d/settings/' % self.web.port, data=form)
+        self.assertEqual(resp.status_code, 200)
+        resp = requests.post('http://127.0.0.1:%d/settings/' % self.web.port, data=dict(form, workers_count='0'))
+        self.assertIn('positive integer', resp.text)
+        self.web.stop()
+        self.thread.join(timeout=1)
+        self.assertEqual(self.web.app.applied, [dict(form, threshold=90.0, workers_count=5)])
+
+    def test_web_application_add_callback_before_start(self):
+        called = []
+
+        async def callback():
+            called.append(True)
+
+        self.web.add_callback(callback)
+        self.thread.start()
+        sleep(0.1)
+        self.assertEqual(called, [True])
+        self.web.stop()
+        self.thread.join(timeout=1)
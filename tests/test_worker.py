@@ -1,8 +1,15 @@
 import os
 from queue import Queue, Empty
+from tempfile import TemporaryDirectory
 from unittest import TestCase, skipUnless
 
 from rekognition_face_search.aws_client import AWSClient
+from rekognition_face_search.dedup import DedupCache
+from rekognition_face_search.http_pool import HTTPPool
+from rekognition_face_search.hygiene import FaceAliasMap
+from rekognition_face_search.image import ImageLoader
+from rekognition_face_search.journal import WorkJournal
+from rekognition_face_search.quality import QualityGate
 from rekognition_face_search.vxg_client import VXGClient
 from rekognition_face_search.worker import Worker
 
@@ -18,17 +25,66 @@ class MockVXGClient(VXGClient):
     def __init__(self):
         self.events = {}
 
-    def set_event_processed(self, event_id: int, faces: list):
+    def set_event_processed(self, event_id: int, faces: list, clear_processing: bool = False):
         self.events[event_id] = faces
 
-    def clear_event_processing(self, event_id: int):
-        pass
+    def set_event_processed_error(self, event_id: int, message: str, clear_processing: bool = False):
+        self.events[event_id] = message
+
+    def set_event_rejected(self, event_id: int, reason: str, clear_processing: bool = False):
+        self.events[event_id] = 'rejected:' + reason
 
 
 class MockAWSClient(AWSClient):
+    def __init__(self):
+        self.calls = []
+
+    def search_face(self, image):
+        self.calls.append('search_face')
+        return {'FaceMatches': [{'Similarity': 99, 'Face': {'FaceId': image.decode()}}]}
+
+
+class MockNewFacesAWSClient(MockAWSClient):
+    """
+    Finds nothing, indexes a face unless the image is "blurry"
+    """
+    def search_face(self, image):
+        self.calls.append('search_face')
+        return {'FaceMatches': [], 'SearchedFaceBoundingBox': {'Left': 0, 'Top': 0, 'Width': 1, 'Height': 1}}
+
+    def index_faces(self, image, quality_filter: str = None, max_faces: int = None):
+        self.calls.append(('index_faces', quality_filter, max_faces))
+        if image == b'blurry':
+            return {'FaceRecords': [], 'UnindexedFaces': [{'Reasons': ['LOW_SHARPNESS']}]}
+        return {'FaceRecords': [{'Face': {'FaceId': image.decode()}}]}
+
+
+class MockResponse:
+    def __init__(self, content: bytes):
+        self.content = content
+        self.headers = {'Content-Length': str(len(content))}
+
+    def raise_for_status(self):
+        pass
+
+    def iter_content(self, chunk_size: int):
+        for idx in range(0, len(self.content), chunk_size):
+            yield self.content[idx:idx + chunk_size]
+
+    def close(self):
+        pass
+
+
+class MockHTTPPool(HTTPPool):
+    """
+    Image content is the last part of the URL
+    """
     def __init__(self):
         pass
 
+    def get(self, url: str, **kwargs):
+        return MockResponse(url.split('/')[-1].encode())
+
 
 class TestWorkerProcess(TestCase):
     def setUp(self):
@@ -43,6 +99,73 @@ class TestWorkerProcess(TestCase):
         with self.assertRaises(Empty):
             self.worker.process()
 
+    def test_process_dedup(self):
+        self.worker = Worker(self.queue, self.aws, self.vxg, http=MockHTTPPool(), dedup=DedupCache(max_distance=0))
+        self.queue.put({'id': 0, 'url': 'http://dummy/a', 'camid': 1})
+        self.queue.put({'id': 1, 'url': 'http://dummy/a', 'camid': 1})
+        self.queue.put({'id': 2, 'url': 'http://dummy/a', 'camid': 2})
+        self.queue.put({'id': 3, 'url': 'http://dummy/b', 'camid': 1})
+        for _ in range(4):
+            self.worker.process()
+        self.assertEqual(len(self.aws.calls), 3)
+        self.assertEqual(self.vxg.events[1], [{'FaceId': 'a', 'Similarity': 99}])
+        self.assertEqual(self.vxg.events[3], [{'FaceId': 'b', 'Similarity': 99}])
+
+    def test_process_image_too_large(self):
+        http = MockHTTPPool()
+        self.worker = Worker(self.queue, self.aws, self.vxg, http=http, loader=ImageLoader(http, max_bytes=3))
+        self.queue.put({'id': 0, 'url': 'http://dummy/abc'})
+        self.queue.put({'id': 1, 'url': 'http://dummy/abcd'})
+        self.worker.process()
+        self.worker.process()
+        self.assertEqual(self.vxg.events[0], [{'FaceId': 'abc', 'Similarity': 99}])
+        self.assertEqual(self.vxg.events[1], 'image_too_large')
+
+    def test_process_group(self):
+        self.worker = Worker(self.queue, self.aws, self.vxg, http=MockHTTPPool())
+        self.queue.put({'id': 0, 'url': 'http://dummy/a', 'camid': 1, 'group': [
+            {'id': 1, 'url': 'http://dummy/a', 'camid': 1},
+            {'id': 2, 'url': 'http://dummy/b', 'camid': 1},
+        ]})
+        self.worker.process()
+        self.assertEqual(len(self.aws.calls), 2)
+        self.assertEqual(self.vxg.events[0], [{'FaceId': 'a', 'Similarity': 99}])
+        self.assertEqual(self.vxg.events[1], [{'FaceId': 'a', 'Similarity': 99}])
+        self.assertEqual(self.vxg.events[2], [{'FaceId': 'b', 'Similarity': 99}])
+
+    def test_process_quality_gate(self):
+        aws = MockNewFacesAWSClient()
+        self.worker = Worker(self.queue, aws, self.vxg, http=MockHTTPPool(),
+                             gate=QualityGate(quality_filter='HIGH', max_faces=1))
+        self.queue.put({'id': 0, 'url': 'http://dummy/sharp'})
+        self.queue.put({'id': 1, 'url': 'http://dummy/blurry'})
+        self.worker.process()
+        self.worker.process()
+        self.assertEqual(self.vxg.events[0], [{'FaceId': 'sharp'}])
+        self.assertEqual(self.vxg.events[1], 'rejected:quality_filter:LOW_SHARPNESS')
+        self.assertIn(('index_faces', 'HIGH', 1), aws.calls)
+
+    def test_process_aliases(self):
+        aliases = FaceAliasMap()
+        aliases.merge('b', 'a')
+        self.worker = Worker(self.queue, self.aws, self.vxg, http=MockHTTPPool(), aliases=aliases)
+        self.queue.put({'id': 0, 'url': 'http://dummy/b'})
+        self.worker.process()
+        self.assertEqual(self.vxg.events[0], [{'FaceId': 'a', 'Similarity': 99}])
+        self.assertIsNotNone(aliases.info('a'))
+
+    def test_process_completes_journal(self):
+        with TemporaryDirectory() as tmp_dir:
+            journal = WorkJournal(os.path.join(tmp_dir, 'journal.db'))
+            journal.enqueue([{'id': 0}, {'id': 1}])
+            self.worker = Worker(self.queue, self.aws, self.vxg, http=MockHTTPPool(), journal=journal)
+            self.queue.put({'id': 0, 'url': 'http://dummy/a'})
+            self.worker.process()
+            journal.close()
+            journal = WorkJournal(journal.path)
+            self.assertEqual(journal.recover(), [{'id': 1}])
+            journal.close()
+
 
 @skipUnless(all((AWS_TEST_CREDENTIALS['collection_id'],
                  AWS_TEST_CREDENTIALS['access_key'],